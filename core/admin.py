@@ -1,6 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html_join
+from .models import ProfileReport, User
 
 
 class UserAdmin(BaseUserAdmin):
@@ -11,3 +15,51 @@ class UserAdmin(BaseUserAdmin):
 
 
 admin.site.register(User, UserAdmin)
+
+
+@admin.register(ProfileReport)
+class ProfileReportAdmin(admin.ModelAdmin):
+    """Profiled requests (core.profiling), with their report files for download."""
+    DOWNLOADS = {
+        # field: (file suffix, label)
+        'collapsed': ('folded', 'Collapsed stacks'),
+        'sql': ('sql.txt', 'SQL with stacks'),
+        'stats': ('stats.txt', 'Profile table'),
+    }
+
+    list_display = ("created_at", "method", "path", "status", "duration_ms", "query_count", "mode", "user")
+    list_filter = ("mode", "view_name")
+    search_fields = ("path", "view_name")
+    list_select_related = ("user",)
+    fields = ("created_at", "user", "method", "path", "view_name", "status", "mode",
+              "duration_ms", "query_count", "query_ms", "downloads", "stats")
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description="Download")
+    def downloads(self, obj):
+        return format_html_join(
+            " | ", '<a href="{}">{}</a>',
+            ((reverse('admin:core_profilereport_download', args=[obj.pk, field]), label)
+             for field, (_, label) in self.DOWNLOADS.items()),
+        )
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/<str:field>/', self.admin_site.admin_view(self.download),
+                 name='core_profilereport_download'),
+            *super().get_urls(),
+        ]
+
+    def download(self, request, pk, field):
+        if field not in self.DOWNLOADS or not self.has_view_permission(request):
+            raise Http404
+        report = get_object_or_404(ProfileReport, pk=pk)
+        response = HttpResponse(getattr(report, field), content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{report.pk}.{self.DOWNLOADS[field][0]}"'
+        return response
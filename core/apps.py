@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from . import metrics
+        # Before any connection opens, so every connection gets the query hook (core.db.hooks)
+        metrics.instrument_connections()
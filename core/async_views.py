@@ -0,0 +1,142 @@
+"""Native async versions of the small JSON endpoints.
+
+Under ASGI a sync view is run in a worker thread, which stays blocked for
+as long as the view waits on the database. These views run on the event
+loop instead, so one process can hold thousands of concurrent pollers:
+
+- typing: ``update_typing_status``, ``get_typing_users``
+- presence: ``conversation_statuses``
+- messages: ``edit_message``, ``delete_message``
+- ``block_user``
+
+They answer exactly like their counterparts in ``core.views`` and are
+routed instead of them when ``ASYNC_VIEWS`` is on, which ``friendproject.asgi``
+does by default (under WSGI each async view would need an event loop of
+its own per request). Queries use the async ORM and the cache (typing
+state, presence, participant ids, blocks) its async methods.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, JsonResponse
+from django.utils import timezone
+from django.utils.dateformat import format as date_format
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_http_methods
+
+from . import blocking, fragments, polling, presence, realtime, typing_state, unread
+from .models import Conversation, Message, User
+
+
+@login_required
+async def update_typing_status(request, conversation_id):
+    """Update the typing status of a user in a conversation."""
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            is_typing = data.get('is_typing', False)
+
+            user = await request.auser()
+            participant_ids = await Conversation.aparticipant_ids_for(conversation_id)
+            if user.pk not in participant_ids:
+                raise Http404
+
+            await typing_state.aset_typing(conversation_id, participant_ids, user, is_typing)
+            result = await typing_state.atyping_users(conversation_id, participant_ids, exclude_user_id=user.pk)
+
+            return JsonResponse({'status': 'ok', 'typing_users': result})
+
+        except json.JSONDecodeError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+
+    return JsonResponse({'status': 'error', 'message': 'Invalid method'}, status=405)
+
+
+@cache_control(private=True, no_cache=True)
+@polling.acondition(polling.atyping_etag)
+@login_required
+async def get_typing_users(request, conversation_id):
+    """Get the list of users currently typing in a conversation"""
+    user = await request.auser()
+    participant_ids = await Conversation.aparticipant_ids_for(conversation_id)
+    if user.pk not in participant_ids:
+        raise Http404
+    result = await typing_state.atyping_users(conversation_id, participant_ids, exclude_user_id=user.pk)
+
+    return JsonResponse({'status': 'ok', 'typing_users': result})
+
+
+@cache_control(private=True, no_cache=True)
+@polling.acondition(polling.astatuses_etag)
+@login_required
+async def conversation_statuses(request, conversation_id):
+    """Return online status for participants in a conversation."""
+    user = await request.auser()
+    if not await Conversation.objects.filter(pk=conversation_id, participants=user).aexists():
+        raise Http404
+    participants = [u async for u in User.objects.filter(conversations__pk=conversation_id)]
+    status_by_id = await presence.astatuses(participants)
+    statuses = [{'id': u.id, 'username': u.username, 'status': status_by_id[u.pk]} for u in participants]
+
+    return JsonResponse({'status': 'ok', 'participants': statuses})
+
+
+async def _own_message(request, message_id):
+    user = await request.auser()
+    try:
+        return await Message.objects.select_related('sender').aget(id=message_id, sender=user)
+    except Message.DoesNotExist:
+        raise Http404
+
+
+@login_required
+async def delete_message(request, message_id):
+    message = await _own_message(request, message_id)
+    message.is_deleted = True
+    await message.asave()
+    await sync_to_async(unread.message_deleted)(message)
+    await fragments.amessages_changed(message.conversation_id)
+    await realtime.apublish_message(message, 'message_deleted')
+    return JsonResponse({'status': 'ok'})
+
+
+@login_required
+async def edit_message(request, message_id):
+    message = await _own_message(request, message_id)
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            new_content = data.get('content', '').strip()
+            if new_content:
+                message.content = new_content
+                message.edited_at = timezone.now()
+                await message.asave()
+                await fragments.amessages_changed(message.conversation_id)
+                await realtime.apublish_message(message, 'message_edited')
+                return JsonResponse({
+                    'status': 'ok',
+                    'message': {
+                        'content': message.content,
+                        'edited_at': date_format(message.edited_at, 'g:i A')
+                    }
+                })
+            return JsonResponse({'status': 'error', 'message': 'Content cannot be empty'}, status=400)
+        except json.JSONDecodeError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+    return JsonResponse({'status': 'error', 'message': 'Invalid method'}, status=405)
+
+
+@login_required
+@require_http_methods(["POST"])
+async def block_user(request, pk):
+    """Toggle blocking of a user. Returns JSON {'status':'blocked'|'unblocked'}"""
+    user = await request.auser()
+    try:
+        target = await User.objects.aget(pk=pk)
+    except User.DoesNotExist:
+        raise Http404
+    if target == user:
+        return JsonResponse({'status': 'error', 'message': 'Cannot block yourself'}, status=400)
+
+    return JsonResponse({'status': await blocking.atoggle(user, target)})
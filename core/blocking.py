@@ -0,0 +1,96 @@
+"""Block relationships with cached id sets.
+
+Each user's "has blocked" and "is blocked by" id sets are cached, so the
+checks done on every send, search and profile view are cache lookups; a
+miss costs one query on the ``blocked_users`` through table. ``toggle``
+invalidates both sides; blocks changed any other way (the admin, the ORM,
+deleting a user) are caught by the receivers in ``core.models``.
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Q
+
+BLOCKED_KEY = 'blocks:blocked:{}'
+BLOCKED_BY_KEY = 'blocks:blocked_by:{}'
+
+
+def _through():
+    return get_user_model().blocked_users.through
+
+
+def _cached_ids(key, **lookup):
+    ids = cache.get(key)
+    if ids is None:
+        column = 'to_user_id' if 'from_user_id' in lookup else 'from_user_id'
+        ids = set(_through().objects.filter(**lookup).values_list(column, flat=True))
+        cache.set(key, ids, 3600)
+    return ids
+
+
+def blocked_ids(user_id):
+    """Ids of users that ``user_id`` has blocked."""
+    return _cached_ids(BLOCKED_KEY.format(user_id), from_user_id=user_id)
+
+
+def blocked_by_ids(user_id):
+    """Ids of users that have blocked ``user_id``."""
+    return _cached_ids(BLOCKED_BY_KEY.format(user_id), to_user_id=user_id)
+
+
+def hidden_ids(user_id):
+    """Ids hidden from ``user_id`` in listings: blocked in either direction."""
+    return blocked_ids(user_id) | blocked_by_ids(user_id)
+
+
+def is_blocked_by_any(user_id, other_ids):
+    """True if any of ``other_ids`` has blocked ``user_id``."""
+    return not blocked_by_ids(user_id).isdisjoint(other_ids)
+
+
+def related_ids(user_id):
+    """``(ids user_id has blocked, ids that have blocked user_id)``, uncached."""
+    blocked, blocked_by = set(), set()
+    rows = _through().objects.filter(Q(from_user_id=user_id) | Q(to_user_id=user_id))
+    for from_id, to_id in rows.values_list('from_user_id', 'to_user_id'):
+        if from_id == user_id:
+            blocked.add(to_id)
+        if to_id == user_id:
+            blocked_by.add(from_id)
+    return blocked, blocked_by
+
+
+def forget(blocker_ids=(), blocked_ids=()):
+    """Drop the cached sets of users whose blocks (or blockers) changed."""
+    cache.delete_many(_keys(blocker_ids, blocked_ids))
+
+
+async def aforget(blocker_ids=(), blocked_ids=()):
+    """Async version of ``forget``."""
+    await cache.adelete_many(_keys(blocker_ids, blocked_ids))
+
+
+def _keys(blocker_ids, blocked_ids):
+    return [BLOCKED_KEY.format(pk) for pk in blocker_ids] + [BLOCKED_BY_KEY.format(pk) for pk in blocked_ids]
+
+
+def toggle(user, target):
+    """Block ``target`` for ``user``, or unblock if already blocked.
+
+    Returns ``'blocked'`` or ``'unblocked'``.
+    """
+    through = _through()
+    removed, _ = through.objects.filter(from_user_id=user.pk, to_user_id=target.pk).delete()
+    if not removed:
+        through.objects.bulk_create([through(from_user_id=user.pk, to_user_id=target.pk)], ignore_conflicts=True)
+    forget([user.pk], [target.pk])
+    return 'unblocked' if removed else 'blocked'
+
+
+async def atoggle(user, target):
+    """Async version of ``toggle``."""
+    through = _through()
+    removed, _ = await through.objects.filter(from_user_id=user.pk, to_user_id=target.pk).adelete()
+    if not removed:
+        await through.objects.abulk_create([through(from_user_id=user.pk, to_user_id=target.pk)], ignore_conflicts=True)
+    await aforget([user.pk], [target.pk])
+    return 'unblocked' if removed else 'blocked'
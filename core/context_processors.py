@@ -1,21 +1,16 @@
-from django.db.models import Q
-from .models import Message
+from functools import cache
+
+from . import unread
 
 
 def unread_messages_count(request):
     """Context processor that returns count of unread messages for the authenticated user.
 
-    Count criteria:
-    - Message.read is False
-    - Message.conversation includes the current user
-    - Message.sender is not the current user
+    The value is a memoized callable, so the lookup only happens if a template
+    actually renders ``unread_messages_count``; it is then read from the
+    per-user cached total of the denormalized counters in ``core.unread``.
     """
     if not request.user.is_authenticated:
         return {}
 
-    count = Message.objects.filter(
-        conversation__participants=request.user,
-        read=False
-    ).exclude(sender=request.user).count()
-
-    return {'unread_messages_count': count}
+    return {'unread_messages_count': cache(lambda: unread.total_for(request.user))}
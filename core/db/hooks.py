@@ -0,0 +1,39 @@
+"""Query hooks installed on every connection.
+
+``connection.execute_wrapper`` only wraps the calling thread's connection,
+but under ASGI an async view's queries run on a worker thread with a
+connection of its own. ``install`` adds a hook to every connection, those
+already open in this thread and every one created later, so per-request
+instrumentation sees them all. ``core.metrics`` installs its hook (which
+also serves ``core.profiling``) in ``CoreConfig.ready``, before any
+connection opens.
+
+A hook finds the current request through a ``ContextVar``, which asgiref
+copies into the worker thread, and passes the query straight through when
+there is none.
+"""
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+_hooks = []
+
+
+def install(hook):
+    """Wrap every query on every connection with ``hook`` (an execute wrapper)."""
+    if hook in _hooks:
+        return
+    _hooks.append(hook)
+    connection_created.connect(_connection_created, dispatch_uid='core.db.hooks')
+    for connection in connections.all(initialized_only=True):
+        _add_hooks(connection)
+
+
+def _connection_created(sender, connection, **kwargs):
+    _add_hooks(connection)
+
+
+def _add_hooks(connection):
+    for hook in _hooks:
+        if hook not in connection.execute_wrappers:
+            # In front, so a temporary execute_wrapper() popping the last entry leaves it alone
+            connection.execute_wrappers.insert(0, hook)
@@ -0,0 +1,144 @@
+"""A small thread-safe connection pool for database backends without one.
+
+Django only pools PostgreSQL connections natively. For MySQL (and SQLite,
+used as a stand-in in benchmarks) ``PooledDatabaseWrapperMixin`` makes the
+backend borrow its DB-API connection from a process-wide pool in
+``get_new_connection`` and hand it back in ``_close``. Under ASGI, request
+code runs on changing threads, so persistent per-thread connections
+(``CONN_MAX_AGE``) are unsafe there. Use the pool with ``CONN_MAX_AGE = 0``
+instead: Django "closes" the connection at the end of every request and
+the pool keeps the socket open for the next one.
+
+Pool options live under a ``POOL`` key of the database settings::
+
+    'POOL': {
+        'SIZE': 10,          # idle connections kept per process
+        'RECYCLE': 1800,     # seconds before a connection is replaced
+        'PING_AFTER': 30,    # idle seconds after which a borrowed connection is pinged
+    }
+
+Connections are never shared: a burst beyond ``SIZE`` opens extra
+connections, which are closed when returned to a full pool.
+"""
+import queue
+import threading
+import time
+
+DEFAULTS = {'SIZE': 10, 'RECYCLE': 1800, 'PING_AFTER': 30}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    def __init__(self, connect, is_usable, size, recycle, ping_after):
+        self._connect = connect
+        self._is_usable = is_usable
+        self.recycle = recycle
+        self.ping_after = ping_after
+        # LIFO keeps the most recently used connections warm
+        self._idle = queue.LifoQueue(maxsize=size)
+        # raw connection id -> creation time
+        self._born = {}
+
+    def acquire(self):
+        while True:
+            try:
+                conn, returned_at = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new()
+            now = time.monotonic()
+            if now - self._born.get(id(conn), now) >= self.recycle:
+                self._discard(conn)
+                continue
+            if now - returned_at >= self.ping_after and not self._is_usable(conn):
+                self._discard(conn)
+                continue
+            return conn
+
+    def release(self, conn):
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            self._discard(conn)
+
+    def discard(self, conn):
+        self._discard(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def _new(self):
+        conn = self._connect()
+        self._born[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def get_pool(key, connect, is_usable, options):
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            opts = {**DEFAULTS, **(options or {})}
+            pool = _pools[key] = ConnectionPool(
+                connect, is_usable, opts['SIZE'], opts['RECYCLE'], opts['PING_AFTER']
+            )
+        return pool
+
+
+def close_all():
+    """Close every idle pooled connection (e.g. before dropping a test database)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
+class PooledDatabaseWrapperMixin:
+    """Borrow connections from a pool instead of opening and closing them."""
+
+    def raw_is_usable(self, conn):
+        raise NotImplementedError
+
+    def _pool(self, conn_params):
+        key = (self.alias, repr(sorted(conn_params.items())))
+        return get_pool(
+            key,
+            lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params),
+            self.raw_is_usable,
+            self.settings_dict.get('POOL'),
+        )
+
+    def get_new_connection(self, conn_params):
+        pool = self._pool(conn_params)
+        conn = pool.acquire()
+        self._borrowed_from = pool
+        return conn
+
+    def _close(self):
+        conn, pool = self.connection, getattr(self, '_borrowed_from', None)
+        if conn is None or pool is None:
+            return super()._close()
+        self._borrowed_from = None
+        # Only hand back connections in a clean state; anything doubtful is dropped
+        if self.in_atomic_block or self.errors_occurred or self.get_autocommit() != self.settings_dict['AUTOCOMMIT']:
+            pool.discard(conn)
+            return
+        try:
+            if not self.get_autocommit():
+                conn.rollback()
+        except Exception:
+            pool.discard(conn)
+            return
+        pool.release(conn)
@@ -0,0 +1,13 @@
+"""MySQL backend that borrows connections from ``core.db.pool``."""
+from django.db.backends.mysql import base
+
+from ..pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    def raw_is_usable(self, conn):
+        try:
+            conn.ping()
+        except base.Database.Error:
+            return False
+        return True
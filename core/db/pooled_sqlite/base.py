@@ -0,0 +1,18 @@
+"""SQLite backend that borrows connections from ``core.db.pool``.
+
+Only meant as a local stand-in for benchmarking the pool; SQLite itself
+gains little from pooling.
+"""
+from django.db.backends.sqlite3 import base
+
+from ..pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    def raw_is_usable(self, conn):
+        try:
+            conn.execute('SELECT 1')
+        except base.Database.Error:
+            return False
+        return True
+
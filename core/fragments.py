@@ -0,0 +1,54 @@
+"""Template fragment caching for the message list and profile cards.
+
+Fragments are cached with Django's ``{% cache %}`` tag and expire by key
+rather than by deletion: a change produces a new key and the old fragment
+simply ages out.
+
+- The message list varies on the conversation, its ``last_message_id``, a
+  per-conversation change stamp, the participants' profile stamps and the
+  viewer. ``messages_changed`` bumps the stamp on send, edit and delete.
+- Profile cards vary on the user and ``User.profile_updated_at``, which a
+  full ``User.save()`` refreshes; background updates call
+  ``profile_changed``.
+
+``FRAGMENT_CACHE_TTL`` (seconds, default 600) bounds how long an unused
+fragment is kept.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+MESSAGES_STAMP_KEY = 'fragments:messages:{}'
+
+
+def ttl():
+    return getattr(settings, 'FRAGMENT_CACHE_TTL', 600)
+
+
+def messages_changed(conversation_id):
+    """Invalidate every viewer's cached message list for the conversation."""
+    cache.set(MESSAGES_STAMP_KEY.format(conversation_id), time.time_ns(), None)
+
+
+async def amessages_changed(conversation_id):
+    """Async version of ``messages_changed``."""
+    await cache.aset(MESSAGES_STAMP_KEY.format(conversation_id), time.time_ns(), None)
+
+
+def messages_stamp(conversation_id):
+    """Current change stamp of the conversation's messages."""
+    return cache.get_or_set(MESSAGES_STAMP_KEY.format(conversation_id), time.time_ns, None)
+
+
+def message_list_version(conversation, participants):
+    """Cache key part for ``conversation``'s message list (the viewer is added in the template)."""
+    profiles = max((p.profile_updated_at for p in participants), default=None)
+    return f"{conversation.last_message_id}.{messages_stamp(conversation.pk)}.{profiles.timestamp() if profiles else 0}"
+
+
+def profile_changed(user_id):
+    """Invalidate the user's profile card after an update that bypasses ``save()``."""
+    from .models import User
+    User.objects.filter(pk=user_id).update(profile_updated_at=timezone.now())
@@ -0,0 +1,61 @@
+"""Keyset pagination over a conversation's messages.
+
+Pages are anchored on a message id and seek on ``(timestamp, id)``, so
+fetching page N costs the same as page 1 however long the conversation is.
+The cursor message is resolved with a primary-key lookup.
+
+``MESSAGES_PAGE_SIZE`` (default 50) sets the page size.
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Message
+
+
+def page_size():
+    return getattr(settings, 'MESSAGES_PAGE_SIZE', 50)
+
+
+def _base(conversation):
+    return Message.objects.filter(conversation=conversation).select_related('sender')
+
+
+def _anchor(conversation, message_id):
+    return Message.objects.filter(conversation=conversation, pk=message_id).values_list('timestamp', 'pk').first()
+
+
+def latest(conversation, limit=None):
+    """Return ``(messages, has_more)`` for the newest page, oldest first."""
+    limit = limit or page_size()
+    rows = list(_base(conversation).order_by('-timestamp', '-id')[:limit + 1])
+    return rows[:limit][::-1], len(rows) > limit
+
+
+def before(conversation, message_id, limit=None):
+    """Return ``(messages, has_more)`` older than ``message_id``, oldest first."""
+    limit = limit or page_size()
+    anchor = _anchor(conversation, message_id)
+    if anchor is None:
+        return [], False
+    ts, pk = anchor
+    rows = list(
+        _base(conversation)
+        .filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=pk))
+        .order_by('-timestamp', '-id')[:limit + 1]
+    )
+    return rows[:limit][::-1], len(rows) > limit
+
+
+def after(conversation, message_id, limit=None):
+    """Return ``(messages, has_more)`` newer than ``message_id``, oldest first."""
+    limit = limit or page_size()
+    anchor = _anchor(conversation, message_id)
+    if anchor is None:
+        return [], False
+    ts, pk = anchor
+    rows = list(
+        _base(conversation)
+        .filter(Q(timestamp__gt=ts) | Q(timestamp=ts, id__gt=pk))
+        .order_by('timestamp', 'id')[:limit + 1]
+    )
+    return rows[:limit], len(rows) > limit
@@ -0,0 +1,85 @@
+"""Inbox summaries for ``conversations_list`` and the inbox JSON endpoint.
+
+A page is built from the viewer's ``ConversationReadState`` rows (created
+whenever a participant is added, see ``core.models``) joined to their
+conversation and its denormalized ``last_message``, plus one query for
+the other participants: two queries per page no matter how many
+conversations the user has. Pages seek on ``(last_activity_at, id)``,
+newest first; ``INBOX_PAGE_SIZE`` (default 20) sets the page size.
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Conversation, ConversationReadState
+
+
+def page_size():
+    return getattr(settings, 'INBOX_PAGE_SIZE', 20)
+
+
+def record_message(message):
+    """Point the conversation at its newest message and bump its activity time."""
+    Conversation.objects.filter(pk=message.conversation_id).update(
+        last_message=message, last_activity_at=message.timestamp
+    )
+
+
+def page(user, before=None, limit=None):
+    """Return ``(conversations, has_more)`` for ``user``'s inbox.
+
+    Each conversation carries ``other_participant``, ``unread_count`` and the
+    selected ``last_message``. ``before`` is the id of the last conversation
+    of the previous page.
+    """
+    limit = limit or page_size()
+    states = ConversationReadState.objects.filter(user=user).select_related(
+        'conversation__last_message'
+    ).order_by('-conversation__last_activity_at', '-conversation_id')
+    if before is not None:
+        anchor = Conversation.objects.filter(pk=before).values_list('last_activity_at', 'pk').first()
+        if anchor is None:
+            return [], False
+        ts, pk = anchor
+        states = states.filter(
+            Q(conversation__last_activity_at__lt=ts) | Q(conversation__last_activity_at=ts, conversation_id__lt=pk)
+        )
+    states = list(states[:limit + 1])
+    has_more = len(states) > limit
+    states = states[:limit]
+
+    others = {}
+    participants = Conversation.participants.through.objects.filter(
+        conversation_id__in=[state.conversation_id for state in states]
+    ).exclude(user=user).select_related('user')
+    for row in participants:
+        others.setdefault(row.conversation_id, row.user)
+
+    conversations = []
+    for state in states:
+        conv = state.conversation
+        conv.other_participant = others.get(conv.pk)
+        conv.unread_count = state.unread_count
+        conversations.append(conv)
+    return conversations, has_more
+
+
+def to_dict(conv):
+    """JSON shape of one inbox entry."""
+    other = conv.other_participant
+    last = conv.last_message
+    return {
+        'id': conv.pk,
+        'other': {
+            'id': other.pk,
+            'username': other.username,
+            'photo': other.avatar_url,
+        } if other else None,
+        'last_message': {
+            'id': last.pk,
+            'sender_id': last.sender_id,
+            'preview': '' if last.is_deleted else last.content[:80],
+            'is_deleted': last.is_deleted,
+        } if last else None,
+        'last_activity_at': conv.last_activity_at.isoformat(),
+        'unread_count': conv.unread_count,
+    }
@@ -0,0 +1,73 @@
+"""Count-free keyset pagination for user listings.
+
+Pages seek on the primary key inside an already filtered queryset, so with
+``user_gender_id_idx`` a deep page costs the same as the first one and no
+``COUNT(*)`` is issued. ``?after=<id>`` moves forward from the last row of
+a page, ``?before=<id>`` back from its first row. Listings that want to
+show a total use ``approx_total``, a count cached for ``LISTING_TOTAL_TTL``
+seconds (default 300).
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+TOTAL_KEY = 'listing:total:{}'
+
+
+class Page:
+    """One page of a keyset listing, oldest id first."""
+
+    def __init__(self, items, has_next, has_previous):
+        self.object_list = items
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_cursor(self):
+        return self.object_list[-1].pk if self.has_next and self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return self.object_list[0].pk if self.has_previous and self.object_list else None
+
+
+def cursor_from(params):
+    """Return ``(after, before)`` ids from a QueryDict, ignoring malformed values."""
+    def as_int(name):
+        try:
+            return int(params[name])
+        except (KeyError, ValueError):
+            return None
+
+    return as_int('after'), as_int('before')
+
+
+def paginate(qs, after=None, before=None, limit=20):
+    """Return the :class:`Page` of ``qs`` after or before the given id."""
+    if before is not None:
+        rows = list(qs.filter(pk__lt=before).order_by('-pk')[:limit + 1])
+        has_previous = len(rows) > limit
+        return Page(rows[:limit][::-1], has_next=True, has_previous=has_previous)
+    if after is not None:
+        qs = qs.filter(pk__gt=after)
+    rows = list(qs.order_by('pk')[:limit + 1])
+    return Page(rows[:limit], has_next=len(rows) > limit, has_previous=after is not None)
+
+
+def page_link(params, **cursor):
+    """Query string for ``params`` with the pagination keys replaced by ``cursor``."""
+    params = params.copy()
+    for key in ('after', 'before', 'page'):
+        params.pop(key, None)
+    params.update(cursor)
+    return '?' + params.urlencode()
+
+
+def approx_total(name, qs):
+    """Cached ``qs.count()``; good enough for "about N users" labels."""
+    return cache.get_or_set(TOTAL_KEY.format(name), qs.count, getattr(settings, 'LISTING_TOTAL_TTL', 300))
@@ -0,0 +1,272 @@
+import asyncio
+import io
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection, connections
+from django.test import override_settings
+from django.urls import reverse
+
+from core import async_views, views
+from core.db import hooks
+from core.management.commands import bench_views
+from core.urls import urlconf_with
+
+# The polling endpoints, weighted as in bench_views
+SCENARIOS = {name: bench_views.SCENARIOS[name] for name in (
+    'get_typing_users', 'update_typing_status', 'conversation_statuses',
+)}
+# mode: (server interface, view implementations)
+MODES = {
+    'wsgi-sync': ('wsgi', views),
+    'asgi-sync': ('asgi', views),
+    'asgi-async': ('asgi', async_views),
+}
+# Sent as both the CSRF cookie and header so the POSTs pass CsrfViewMiddleware
+CSRF_TOKEN = 'b' * 32
+
+_queries = ContextVar('bench_queries', default=None)
+
+
+def _count_queries(execute, sql, params, many, context):
+    counter = _queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+class Command(bench_views.Command):
+    help = (
+        "Compare the polling endpoints served three ways: sync views behind the WSGI handler "
+        "(a thread per request), sync views behind the ASGI handler (a worker thread hop per "
+        "request) and the native async views in core.async_views on the event loop. Requests "
+        "go straight to Django's real handlers in process, as users created by seed_data, and "
+        "each mode reports p50/p95/p99 latency, throughput and queries per request. Use "
+        "DB_POOL=1: the ASGI handler runs sync code on a fresh thread, and so a fresh "
+        "connection, for every request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5_000, help="Measured requests per mode.")
+        parser.add_argument('--concurrency', type=int, default=200, help="Requests in flight under ASGI.")
+        parser.add_argument('--threads', type=int, default=8, help="Server threads under WSGI.")
+        parser.add_argument('--users', type=int, default=200, help="Seeded users to log in and act as.")
+        parser.add_argument('--prefix', default='seed', help="Username prefix used by seed_data.")
+        parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+        parser.add_argument('--only', nargs='+', choices=sorted(SCENARIOS), help="Run only these scenarios.")
+        parser.add_argument('--warmup', type=int, default=200, help="Unmeasured requests run first in each mode.")
+        parser.add_argument('--host', help="Host header; defaults to the first ALLOWED_HOSTS entry.")
+        parser.add_argument('--output', help="Where to save the results (default bench-results/asgi-<timestamp>.json).")
+        parser.add_argument('--compare', help="Earlier results file to compare against.")
+
+    def handle(self, *args, **options):
+        self.set_up_actors(options)
+        hooks.install(_count_queries)
+        names = options['only'] or list(SCENARIOS)
+        weights = [SCENARIOS[name] for name in names]
+
+        results = {
+            'meta': {
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'vendor': connection.vendor,
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'threads': options['threads'],
+                'users': len(self.sessions),
+            },
+            'modes': {},
+        }
+        for mode in options['modes']:
+            interface, endpoints = MODES[mode]
+            # Build it before overriding ROOT_URLCONF, which it includes
+            urlconf = urlconf_with(endpoints)
+            with override_settings(ROOT_URLCONF=urlconf):
+                if interface == 'wsgi':
+                    run = lambda plan: self.run_wsgi(plan, options['threads'])
+                else:
+                    run = lambda plan: asyncio.run(self.run_asgi(plan, options['concurrency']))
+                run(random.choices(names, weights, k=options['warmup']))
+                samples, elapsed = run(random.choices(names, weights, k=options['requests']))
+            mode_results = self.summarize(samples, elapsed)
+            mode_results['meta'] = {**results['meta'], 'mode': mode}
+            self.stdout.write(self.style.MIGRATE_HEADING(mode))
+            self.report(mode_results)
+            del mode_results['meta']
+            results['modes'][mode] = mode_results
+
+        self.report_modes(results)
+        if options['compare']:
+            self.compare_modes(results, json.loads(Path(options['compare']).read_text()))
+        self.save(results, options['output'] or Path(settings.BASE_DIR) / 'bench-results' / f"asgi-{datetime.now():%Y%m%d-%H%M%S}.json")
+
+    def describe_concurrency(self, meta):
+        if MODES[meta['mode']][0] == 'wsgi':
+            return f"{meta['threads']} threads"
+        return f"{meta['concurrency']} requests in flight"
+
+    def next_request(self, name):
+        """``(name, method, path, body, cookie)`` for one request by a random actor."""
+        user_id, gender, conv_id = random.choice(self.actors)
+        method, path, body = getattr(self, name)(gender, conv_id)
+        cookie = (
+            f"{settings.SESSION_COOKIE_NAME}={self.sessions[user_id]}; "
+            f"{settings.CSRF_COOKIE_NAME}={CSRF_TOKEN}"
+        )
+        return name, method, path, body, cookie
+
+    # Scenarios: (method, path, body)
+
+    def get_typing_users(self, gender, conv_id):
+        return 'GET', reverse('get_typing_users', args=[conv_id]), b''
+
+    def update_typing_status(self, gender, conv_id):
+        body = json.dumps({'is_typing': random.random() < 0.5}).encode()
+        return 'POST', reverse('update_typing_status', args=[conv_id]), body
+
+    def conversation_statuses(self, gender, conv_id):
+        return 'GET', reverse('conversation_statuses', args=[conv_id]), b''
+
+    # WSGI: a pool of server threads sharing one handler
+
+    def run_wsgi(self, plan, threads):
+        handler = WSGIHandler()
+        samples = []
+
+        def request(name):
+            name, method, path, body, cookie = self.next_request(name)
+            environ = {
+                'REQUEST_METHOD': method,
+                'SCRIPT_NAME': '',
+                'PATH_INFO': path,
+                'QUERY_STRING': '',
+                'SERVER_NAME': self.host,
+                'SERVER_PORT': '80',
+                'SERVER_PROTOCOL': 'HTTP/1.1',
+                'REMOTE_ADDR': '127.0.0.1',
+                'HTTP_HOST': self.host,
+                'HTTP_COOKIE': cookie,
+                'HTTP_X_CSRFTOKEN': CSRF_TOKEN,
+                'CONTENT_TYPE': 'application/json',
+                'CONTENT_LENGTH': str(len(body)),
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(body),
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': True,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            status = []
+            counter = [0]
+            token = _queries.set(counter)
+            start = time.perf_counter()
+            try:
+                response = handler(environ, lambda s, headers, exc_info=None: status.append(int(s[:3])))
+                try:
+                    for _ in response:
+                        pass
+                finally:
+                    response.close()
+            finally:
+                _queries.reset(token)
+            samples.append((name, (time.perf_counter() - start) * 1000, status[0], counter[0]))
+
+        def worker(names):
+            try:
+                for name in names:
+                    request(name)
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(worker, [plan[i::threads] for i in range(threads)]))
+        return samples, time.perf_counter() - start
+
+    # ASGI: one event loop with ``concurrency`` requests in flight
+
+    async def run_asgi(self, plan, concurrency):
+        handler = ASGIHandler()
+        samples = []
+
+        async def request(name):
+            name, method, path, body, cookie = self.next_request(name)
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': '1.1',
+                'method': method,
+                'scheme': 'http',
+                'path': path,
+                'raw_path': path.encode(),
+                'query_string': b'',
+                'root_path': '',
+                'headers': [
+                    (b'host', self.host.encode()),
+                    (b'cookie', cookie.encode()),
+                    (b'x-csrftoken', CSRF_TOKEN.encode()),
+                    (b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode()),
+                ],
+                'client': ('127.0.0.1', 50000),
+                'server': (self.host, 80),
+            }
+            received = False
+
+            async def receive():
+                nonlocal received
+                if not received:
+                    received = True
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                # The client never disconnects; Django cancels this once it has responded
+                await asyncio.get_running_loop().create_future()
+
+            status = []
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            counter = [0]
+            token = _queries.set(counter)
+            start = time.perf_counter()
+            try:
+                await handler(scope, receive, send)
+            finally:
+                _queries.reset(token)
+            samples.append((name, (time.perf_counter() - start) * 1000, status[0], counter[0]))
+
+        async def worker(names):
+            for name in names:
+                await request(name)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(plan[i::concurrency]) for i in range(concurrency)))
+        return samples, time.perf_counter() - start
+
+    def report_modes(self, results):
+        self.stdout.write(self.style.MIGRATE_HEADING("Modes"))
+        self.stdout.write(f"  {'mode':<14}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+        for mode, row in results['modes'].items():
+            total = row['total']
+            self.stdout.write(
+                f"  {mode:<14}{total['rps']:>9.1f}{total['p50_ms']:>9.1f}{total['p95_ms']:>9.1f}"
+                f"{total['p99_ms']:>9.1f}{total['queries_mean']:>9.1f}"
+            )
+
+    def compare_modes(self, results, previous):
+        for mode, row in results['modes'].items():
+            old = previous['modes'].get(mode)
+            if old is None:
+                continue
+            self.stdout.write(self.style.MIGRATE_HEADING(mode))
+            self.compare(row, {**old, 'meta': previous['meta']})
@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.utils import load_backend
+
+from core.db import pool
+
+POOLED_ENGINES = {
+    'mysql': ('django.db.backends.mysql', 'core.db.pooled_mysql'),
+    'sqlite': ('django.db.backends.sqlite3', 'core.db.pooled_sqlite'),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare request throughput with a new connection per request, persistent "
+        "connections and the connection pool, against the configured database. "
+        "Each simulated request runs Django's request_started/request_finished "
+        "connection handling around a few small queries."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2_000)
+        parser.add_argument('--concurrency', type=int, default=8, help="Worker threads issuing requests.")
+        parser.add_argument('--queries', type=int, default=3, help="Queries per request.")
+        parser.add_argument(
+            '--handshake-ms', type=float, default=0,
+            help="Extra delay added to every new connection, to make a local SQLite stand-in "
+                 "behave like a networked MySQL handshake.",
+        )
+
+    def handle(self, *args, **options):
+        base = connections['default'].settings_dict
+        vendor = connections['default'].vendor
+        if vendor not in POOLED_ENGINES:
+            raise CommandError(f"No pooled backend for {vendor}.")
+        plain, pooled = POOLED_ENGINES[vendor]
+        modes = {
+            'new connection per request': {'ENGINE': plain, 'CONN_MAX_AGE': 0},
+            'persistent (CONN_MAX_AGE)': {'ENGINE': plain, 'CONN_MAX_AGE': 600},
+            'pooled': {'ENGINE': pooled, 'CONN_MAX_AGE': 0},
+        }
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{options['requests']} requests x {options['queries']} queries on {vendor}, "
+            f"{options['concurrency']} threads, +{options['handshake_ms']} ms per connect"
+        ))
+        results = {}
+        for label, overrides in modes.items():
+            settings_dict = {**base, **overrides}
+            with counting_connects(plain, options['handshake_ms']) as opened:
+                rate = self.run(settings_dict, options)
+                pool.close_all()
+            results[label] = rate
+            self.stdout.write(f"  {label:<28} {rate:>9.0f} req/s   {len(opened):>6} connections opened")
+
+        baseline = results['new connection per request']
+        for label, rate in results.items():
+            self.stdout.write(f"  {label:<28} {rate / baseline:>8.2f}x")
+
+    def run(self, settings_dict, options):
+        backend = load_backend(settings_dict['ENGINE'])
+        local = threading.local()
+        wrappers = []
+
+        def request(_):
+            wrapper = getattr(local, 'wrapper', None)
+            if wrapper is None:
+                wrapper = local.wrapper = backend.DatabaseWrapper(settings_dict, alias='bench')
+                wrapper.inc_thread_sharing()
+                wrappers.append(wrapper)
+            # What django.db.close_old_connections does on request_started/finished
+            wrapper.close_if_unusable_or_obsolete()
+            with wrapper.cursor() as cursor:
+                for _ in range(options['queries']):
+                    cursor.execute('SELECT 1')
+                    cursor.fetchone()
+            wrapper.close_if_unusable_or_obsolete()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            list(executor.map(request, range(options['requests'])))
+        elapsed = time.perf_counter() - start
+        for wrapper in wrappers:
+            wrapper.close()
+        return options['requests'] / elapsed
+
+
+@contextmanager
+def counting_connects(engine, handshake_ms):
+    """Count (and optionally slow down) new DB-API connections made by ``engine``
+    and the pooled backend built on it."""
+    module = load_backend(engine).Database
+    original = module.connect
+    opened = []
+
+    def connect(*args, **kwargs):
+        opened.append(1)
+        if handshake_ms:
+            time.sleep(handshake_ms / 1000)
+        return original(*args, **kwargs)
+
+    module.connect = connect
+    try:
+        yield opened
+    finally:
+        module.connect = original
@@ -0,0 +1,148 @@
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from core.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Show query plans and timings for the message hot paths with and without "
+        "the composite indexes. Use --seed to first fill the database with synthetic data. "
+        "Drops and recreates the message indexes, so it only runs with DEBUG on or "
+        "with --yes and --database naming a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help="Insert synthetic users, conversations and messages first.")
+        parser.add_argument('--keep-seed', action='store_true', help="Keep the seeded rows instead of deleting them at the end.")
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--conversations', type=int, default=10_000)
+        parser.add_argument('--users', type=int, default=2_000)
+        parser.add_argument('--repeat', type=int, default=20, help="Runs per query when timing.")
+        parser.add_argument('--database', help="Alias of the (scratch) database to run against.")
+        parser.add_argument('--yes', action='store_true', help="Confirm that --database may be altered without DEBUG.")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not (options['yes'] and options['database']):
+            raise CommandError(
+                "This drops indexes on the message table and may seed millions of rows. "
+                "Run it with DEBUG on, or pass --yes with --database pointing at a scratch database."
+            )
+        self.using = options['database'] or DEFAULT_DB_ALIAS
+        seeded = None
+        if options['seed']:
+            seeded = self.seed(options['users'], options['conversations'], options['messages'])
+        try:
+            self.bench(options['repeat'])
+        finally:
+            if seeded and not options['keep_seed']:
+                self.unseed(*seeded)
+
+    def bench(self, repeat):
+        connection = connections[self.using]
+        messages = Message.objects.using(self.using)
+        conv = Conversation.objects.using(self.using).order_by('-pk').first()
+        if conv is None:
+            raise CommandError("No conversations found; run with --seed.")
+        user_id = conv.participants.values_list('pk', flat=True).first()
+        # Mark-read recounts the messages after the reader's cursor; bench a cursor
+        # a few messages behind the newest
+        cursor = messages.filter(conversation=conv).order_by('-pk').values_list('pk', flat=True)[5:6].first() or 0
+
+        queries = {
+            'history page': lambda: messages.filter(conversation=conv).order_by('-timestamp', '-id')[:51],
+            # COUNT drops the default ordering, so compare it unordered
+            'unread after cursor': lambda: messages.filter(
+                conversation=conv, pk__gt=cursor
+            ).exclude(sender_id=user_id).order_by().values('pk'),
+        }
+
+        indexes = Message._meta.indexes
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{messages.count()} messages on {connection.vendor}; dropping {len(indexes)} indexes"
+        ))
+        with connection.schema_editor() as editor:
+            for index in indexes:
+                editor.remove_index(Message, index)
+        try:
+            before = self.report('without indexes', queries, repeat)
+        finally:
+            with connection.schema_editor() as editor:
+                for index in indexes:
+                    editor.add_index(Message, index)
+        after = self.report('with indexes', queries, repeat)
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Summary (ms per query)"))
+        for name in queries:
+            self.stdout.write(f"  {name:<20} {before[name]:>10.2f} -> {after[name]:>10.2f}")
+
+    def report(self, label, queries, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Plans {label}"))
+        timings = {}
+        for name, build in queries.items():
+            self.stdout.write(self.style.MIGRATE_LABEL(f"  {name}"))
+            for line in build().explain().splitlines():
+                self.stdout.write(f"    {line}")
+            start = time.perf_counter()
+            for _ in range(repeat):
+                list(build())
+            timings[name] = (time.perf_counter() - start) * 1000 / repeat
+        return timings
+
+    def seed(self, n_users, n_conversations, n_messages):
+        """Insert the synthetic rows; returns ``(first user pk, conversation pks)`` for ``unseed``."""
+        User = get_user_model()
+        users_qs = User.objects.using(self.using)
+        self.stdout.write(f"Seeding {n_users} users, {n_conversations} conversations, {n_messages} messages...")
+        start_pk = (users_qs.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+        with transaction.atomic(using=self.using):
+            users_qs.bulk_create(
+                [User(username=f'bench_{start_pk + i}', gender='MF'[i % 2], age=18 + i % 40)
+                 for i in range(n_users)],
+                batch_size=5_000,
+            )
+            Conversation.objects.using(self.using).bulk_create(
+                [Conversation() for _ in range(n_conversations)], batch_size=5_000,
+            )
+            # Re-read rather than rely on bulk_create setting pks (MySQL does not)
+            users = list(users_qs.filter(username__startswith='bench_', pk__gte=start_pk).only('pk'))
+            conversations = list(Conversation.objects.using(self.using).order_by('-pk')[:n_conversations])
+            through = Conversation.participants.through
+            pairs = {}
+            links = []
+            for conv in conversations:
+                a, b = random.sample(users, 2)
+                pairs[conv.pk] = (a.pk, b.pk)
+                links += [through(conversation_id=conv.pk, user_id=a.pk), through(conversation_id=conv.pk, user_id=b.pk)]
+            through.objects.using(self.using).bulk_create(links, batch_size=10_000)
+
+        conv_ids = list(pairs)
+        now = timezone.now()
+        batch = []
+        for i in range(n_messages):
+            conv_id = random.choice(conv_ids)
+            batch.append(Message(
+                conversation_id=conv_id,
+                sender_id=random.choice(pairs[conv_id]),
+                content='lorem ipsum',
+                timestamp=now - timedelta(seconds=n_messages - i),
+            ))
+            if len(batch) == 10_000:
+                Message.objects.using(self.using).bulk_create(batch)
+                batch = []
+        Message.objects.using(self.using).bulk_create(batch)
+        return start_pk, conv_ids
+
+    def unseed(self, start_pk, conv_ids):
+        """Delete what ``seed`` inserted: its conversations (with their messages) and users."""
+        self.stdout.write("Deleting the seeded rows...")
+        for i in range(0, len(conv_ids), 1_000):
+            Conversation.objects.using(self.using).filter(pk__in=conv_ids[i:i + 1_000]).delete()
+        get_user_model().objects.using(self.using).filter(username__startswith='bench_', pk__gte=start_pk).delete()
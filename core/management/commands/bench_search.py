@@ -0,0 +1,78 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from core import search
+
+WORDS = (
+    'music travel coffee hiking books movies football guitar cooking yoga '
+    'photography painting dancing gaming running cycling swimming poetry'
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the old icontains username/email search with core.search on the "
+        "current database. Use --seed to first insert synthetic users."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help="Insert synthetic users first.")
+        parser.add_argument('--users', type=int, default=500_000)
+        parser.add_argument('--repeat', type=int, default=20, help="Runs per query when timing.")
+        parser.add_argument('queries', nargs='*', default=['bench_12', 'guitar', 'coffee hik', 'zzz'])
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.seed(options['users'])
+
+        User = get_user_model()
+        if not User.objects.exists():
+            raise CommandError("No users found; run with --seed.")
+        base = User.objects.filter(gender='F')
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{User.objects.count()} users on {connection.vendor}, {options['repeat']} runs per query"
+        ))
+
+        for q in options['queries']:
+            old = lambda: list(base.filter(Q(username__icontains=q) | Q(email__icontains=q)))
+            new = lambda: search.search(base, q=q)
+            old_ms, old_rows = self.time(old, options['repeat'])
+            new_ms, (new_rows, _) = self.time(new, options['repeat'])
+            self.stdout.write(
+                f"  {q!r:<14} icontains {old_ms:>9.2f} ms ({len(old_rows)} rows)"
+                f"  ->  search {new_ms:>8.2f} ms ({len(new_rows)} rows, first page)"
+            )
+
+    def time(self, fn, repeat):
+        result = fn()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        return (time.perf_counter() - start) * 1000 / repeat, result
+
+    def seed(self, n_users):
+        User = get_user_model()
+        self.stdout.write(f"Seeding {n_users} users...")
+        start_pk = (User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+        batch = []
+        with transaction.atomic():
+            for i in range(n_users):
+                user = User(
+                    username=f'bench_{start_pk + i}',
+                    email=f'bench_{start_pk + i}@example.com',
+                    gender='MF'[i % 2],
+                    age=18 + i % 40,
+                    bio=' '.join(random.sample(WORDS, 3)),
+                )
+                # bulk_create skips save(), so fill the search column here
+                user.search_text = search.search_text_for(user)
+                batch.append(user)
+                if len(batch) == 5_000:
+                    User.objects.bulk_create(batch)
+                    batch = []
+            User.objects.bulk_create(batch)
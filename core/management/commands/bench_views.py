@@ -0,0 +1,243 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.urls import reverse
+
+from core.management.commands.seed_data import SENTENCES, WORDS
+from core.models import ConversationReadState
+
+# name: relative weight in the default mix
+SCENARIOS = {
+    'conversation_detail': 10,
+    'conversations_list': 8,
+    'search_opposite': 4,
+    'random_profile': 3,
+    'users_by_gender': 4,
+    'get_typing_users': 15,
+    'update_typing_status': 8,
+    'conversation_statuses': 15,
+    'send_message': 5,
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the core views concurrently, in process through the full middleware stack, "
+        "as users created by seed_data, and report p50/p95/p99 latency, throughput and "
+        "queries per request for each. Results are saved as JSON; pass --compare to diff "
+        "against an earlier run. Threads share the GIL, so absolute throughput is a lower "
+        "bound; compare runs on the same machine."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5_000)
+        parser.add_argument('--concurrency', type=int, default=8, help="Worker threads issuing requests.")
+        parser.add_argument('--users', type=int, default=200, help="Seeded users to log in and act as.")
+        parser.add_argument('--prefix', default='seed', help="Username prefix used by seed_data.")
+        parser.add_argument('--only', nargs='+', choices=sorted(SCENARIOS), help="Run only these scenarios.")
+        parser.add_argument('--warmup', type=int, default=200, help="Unmeasured requests run first.")
+        parser.add_argument('--host', help="Host header; defaults to the first ALLOWED_HOSTS entry.")
+        parser.add_argument('--output', help="Where to save the results (default bench-results/<timestamp>.json).")
+        parser.add_argument('--compare', help="Earlier results file to compare against.")
+
+    def handle(self, *args, **options):
+        self.set_up_actors(options)
+
+        names = options['only'] or list(SCENARIOS)
+        weights = [SCENARIOS[name] for name in names]
+        self.run(random.choices(names, weights, k=options['warmup']), options['concurrency'])
+        plan = random.choices(names, weights, k=options['requests'])
+        samples, elapsed = self.run(plan, options['concurrency'])
+
+        results = self.summarize(samples, elapsed)
+        results['meta'] = {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'vendor': connection.vendor,
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'users': len(self.sessions),
+        }
+        self.report(results)
+        if options['compare']:
+            self.compare(results, json.loads(Path(options['compare']).read_text()))
+        self.save(results, options['output'])
+
+    def set_up_actors(self, options):
+        """Pick seeded users with a conversation to act as, and log them in."""
+        actors = list(
+            ConversationReadState.objects.filter(user__username__startswith=f"{options['prefix']}_")
+            .order_by('?').values_list('user_id', 'user__gender', 'conversation_id')[:options['users']]
+        )
+        if not actors:
+            raise CommandError(f"No conversations between {options['prefix']}_* users; run seed_data first.")
+        self.host = options['host'] or next((h for h in settings.ALLOWED_HOSTS if h != '*'), 'localhost').lstrip('.')
+        self.sessions = self.log_in({user_id for user_id, _, _ in actors})
+        self.actors = actors
+
+    def log_in(self, user_ids):
+        """Create a session per user up front so the measured requests skip the login."""
+        sessions = {}
+        for user in get_user_model().objects.filter(pk__in=user_ids):
+            client = Client(HTTP_HOST=self.host)
+            client.force_login(user)
+            sessions[user.pk] = client.cookies[settings.SESSION_COOKIE_NAME].value
+        return sessions
+
+    def run(self, plan, concurrency):
+        """Run every scenario in ``plan``; returns ``([(name, ms, status, queries)], seconds)``."""
+        local = threading.local()
+        samples = []
+
+        def request(name):
+            user_id, gender, conv_id = random.choice(self.actors)
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client(HTTP_HOST=self.host, raise_request_exception=False)
+            client.cookies[settings.SESSION_COOKIE_NAME] = self.sessions[user_id]
+            queries = []
+            start = time.perf_counter()
+            with connection.execute_wrapper(lambda execute, *args: queries.append(1) or execute(*args)):
+                response = getattr(self, name)(client, gender, conv_id)
+            samples.append((name, (time.perf_counter() - start) * 1000, response.status_code, len(queries)))
+
+        def worker(names):
+            try:
+                for name in names:
+                    request(name)
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(worker, [plan[i::concurrency] for i in range(concurrency)]))
+        return samples, time.perf_counter() - start
+
+    # Scenarios: one request each
+
+    def conversation_detail(self, client, gender, conv_id):
+        return client.get(reverse('conversation_detail', args=[conv_id]))
+
+    def conversations_list(self, client, gender, conv_id):
+        return client.get(reverse('conversations_list'))
+
+    def search_opposite(self, client, gender, conv_id):
+        return client.get(reverse('search'), {'q': random.choice(WORDS)})
+
+    def random_profile(self, client, gender, conv_id):
+        return client.get(reverse('random'))
+
+    def users_by_gender(self, client, gender, conv_id):
+        return client.get(reverse('users_by_gender', args=['F' if gender == 'M' else 'M']))
+
+    def get_typing_users(self, client, gender, conv_id):
+        return client.get(reverse('get_typing_users', args=[conv_id]))
+
+    def update_typing_status(self, client, gender, conv_id):
+        return client.post(
+            reverse('update_typing_status', args=[conv_id]),
+            json.dumps({'is_typing': random.random() < 0.5}),
+            content_type='application/json',
+        )
+
+    def conversation_statuses(self, client, gender, conv_id):
+        return client.get(reverse('conversation_statuses', args=[conv_id]))
+
+    def send_message(self, client, gender, conv_id):
+        return client.post(
+            reverse('conversation_detail', args=[conv_id]),
+            json.dumps({'content': random.choice(SENTENCES)}),
+            content_type='application/json',
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+
+    def summarize(self, samples, elapsed):
+        by_name = {}
+        for name, ms, status, queries in samples:
+            by_name.setdefault(name, []).append((ms, status, queries))
+        views = {}
+        for name in sorted(by_name):
+            rows = by_name[name]
+            latencies = sorted(ms for ms, _, _ in rows)
+            queries = [q for _, _, q in rows]
+            views[name] = {
+                'requests': len(rows),
+                'errors': sum(1 for _, status, _ in rows if status >= 500),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'rps': len(rows) / elapsed,
+                'queries_mean': sum(queries) / len(queries),
+                'queries_max': max(queries),
+            }
+        latencies = sorted(ms for _, ms, _, _ in samples)
+        return {
+            'total': {
+                'requests': len(samples),
+                'seconds': elapsed,
+                'rps': len(samples) / elapsed,
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'queries_mean': sum(q for _, _, _, q in samples) / max(len(samples), 1),
+            },
+            'views': views,
+        }
+
+    def report(self, results):
+        meta, total = results['meta'], results['total']
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{total['requests']} requests, {self.describe_concurrency(meta)}, {meta['users']} users on {meta['vendor']}"
+        ))
+        self.stdout.write(
+            f"  {'view':<24}{'reqs':>7}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}{'max q':>7}"
+        )
+        for name, row in results['views'].items():
+            self.stdout.write(
+                f"  {name:<24}{row['requests']:>7}{row['errors']:>5}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+                f"{row['p99_ms']:>9.1f}{row['rps']:>9.1f}{row['queries_mean']:>9.1f}{row['queries_max']:>7}"
+            )
+        self.stdout.write(
+            f"  {'total':<24}{total['requests']:>7}{'':>5}{total['p50_ms']:>9.1f}{total['p95_ms']:>9.1f}"
+            f"{total['p99_ms']:>9.1f}{total['rps']:>9.1f}{total['queries_mean']:>9.1f}"
+        )
+
+    def describe_concurrency(self, meta):
+        return f"{meta['concurrency']} threads"
+
+    def compare(self, results, previous):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Compared with {previous['meta']['date']}"))
+        self.stdout.write(f"  {'view':<24}{'p95 ms':>20}{'req/s':>20}{'queries':>16}")
+        rows = {**results['views'], 'total': results['total']}
+        old_rows = {**previous['views'], 'total': previous['total']}
+        for name, row in rows.items():
+            old = old_rows.get(name)
+            if old is None:
+                continue
+            self.stdout.write(
+                f"  {name:<24}{old['p95_ms']:>9.1f} ->{row['p95_ms']:>7.1f}{old['rps']:>10.1f} ->{row['rps']:>7.1f}"
+                f"{old.get('queries_mean', 0):>7.1f} ->{row.get('queries_mean', 0):>5.1f}"
+            )
+
+    def save(self, results, output):
+        path = Path(output or Path(settings.BASE_DIR) / 'bench-results' / f"{datetime.now():%Y%m%d-%H%M%S}.json")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(results, indent=2))
+        self.stdout.write(f"Saved results to {path}")
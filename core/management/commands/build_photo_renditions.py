@@ -0,0 +1,25 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from core import renditions
+
+
+class Command(BaseCommand):
+    help = "Render avatar/profile variants for photos that have none (e.g. uploaded before renditions existed)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Re-render every photo, not just missing ones.")
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.exclude(photo='').exclude(photo__isnull=True)
+        if not options['all']:
+            users = users.filter(photo_renditions={})
+        done = failed = 0
+        for pk in users.values_list('pk', flat=True).iterator():
+            try:
+                renditions.generate(pk)
+                done += 1
+            except Exception as exc:
+                failed += 1
+                self.stderr.write(f"User {pk}: {exc}")
+        self.stdout.write(self.style.SUCCESS(f"Rendered photos for {done} user(s); {failed} failed."))
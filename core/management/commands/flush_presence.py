@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core import presence
+
+
+class Command(BaseCommand):
+    help = "Flush buffered presence heartbeats and mark idle users offline. Run from cron."
+
+    def handle(self, *args, **options):
+        written = presence.flush()
+        swept = presence.sweep_offline()
+        self.stdout.write(self.style.SUCCESS(
+            f"Flushed {written} heartbeat(s); marked {swept} idle user(s) offline."
+        ))
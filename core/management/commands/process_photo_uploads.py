@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core import uploads
+
+
+class Command(BaseCommand):
+    help = "Process photo uploads left pending (e.g. after a restart). Safe to run from cron."
+
+    def handle(self, *args, **options):
+        job_ids = uploads.recover()
+        for job_id in job_ids:
+            uploads.process(job_id)
+        self.stdout.write(self.style.SUCCESS(f"Processed {len(job_ids)} pending photo upload(s)."))
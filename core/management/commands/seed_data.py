@@ -0,0 +1,205 @@
+import io
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core import renditions, search, unread
+from core.models import Conversation, ConversationReadState, Message
+
+WORDS = (
+    'music travel coffee hiking books movies football guitar cooking yoga '
+    'photography painting dancing gaming running cycling swimming poetry'
+).split()
+SENTENCES = (
+    'hey, how are you?', 'what are you up to this weekend?', 'haha same here',
+    'did you see that match yesterday?', 'I just got back from a trip', 'sounds great!',
+    'let me know when you are free', 'good night', 'that photo is amazing',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with a large synthetic dataset for load tests (see bench_views): "
+        "users with genders, ages and photos, 1:1 conversations with their read states, "
+        "messages and block relationships, all bulk inserted. Seeded users are named "
+        "<prefix>_<n> and share the --password."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200_000)
+        parser.add_argument('--conversations', type=int, default=100_000)
+        parser.add_argument('--messages', type=int, default=2_000_000)
+        parser.add_argument('--blocks', type=int, default=20_000)
+        parser.add_argument('--photos', type=int, default=20, help="Distinct placeholder photos (0 for none).")
+        parser.add_argument('--photo-ratio', type=float, default=0.6, help="Share of users with a photo.")
+        parser.add_argument('--unread-ratio', type=float, default=0.1, help="Share of read states left with unread messages.")
+        parser.add_argument('--prefix', default='seed')
+        parser.add_argument('--password', default='seed')
+        parser.add_argument('--batch-size', type=int, default=5_000)
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError("Need at least two users.")
+        User = get_user_model()
+        if User.objects.filter(username__startswith=f"{options['prefix']}_").exists():
+            raise CommandError(f"Users named {options['prefix']}_* already exist; pick another --prefix.")
+        self.batch_size = options['batch_size']
+
+        users = self.step('users', self.seed_users, options)
+        conv_ids = self.step('conversations', self.seed_conversations, users, options['conversations'])
+        self.step('messages', self.seed_messages, conv_ids, options['messages'])
+        self.step('read states', self.seed_read_states, conv_ids, options['unread_ratio'])
+        self.step('blocks', self.seed_blocks, users, options['blocks'])
+
+    def step(self, label, fn, *args):
+        self.stdout.write(f"Seeding {label}...", ending='')
+        self.stdout.flush()
+        start = time.perf_counter()
+        result = fn(*args)
+        self.stdout.write(f" {time.perf_counter() - start:.1f}s")
+        return result
+
+    def photos(self, count):
+        """Store ``count`` placeholder photos with their renditions; returns ``[(name, renditions)]``."""
+        from PIL import Image
+
+        photos = []
+        for i in range(count):
+            out = io.BytesIO()
+            colour = tuple(random.randrange(256) for _ in range(3))
+            Image.new('RGB', (640, 640), colour).save(out, 'JPEG')
+            source = out.getvalue()
+            name = default_storage.save(f'user_photos/seed-{i}.jpg', ContentFile(source))
+            photos.append((name, renditions.build(source)))
+        return photos
+
+    def seed_users(self, options):
+        """Returns ``{gender: [user ids]}``."""
+        User = get_user_model()
+        photos = self.photos(options['photos']) if options['photo_ratio'] > 0 else []
+        password = make_password(options['password'])
+        start_pk = (User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+        now = timezone.now()
+        batch = []
+        for i in range(options['users']):
+            user = User(
+                username=f"{options['prefix']}_{start_pk + i}",
+                email=f"{options['prefix']}_{start_pk + i}@example.com",
+                password=password,
+                gender='MF'[i % 2],
+                age=random.randint(18, 60),
+                bio=' '.join(random.sample(WORDS, 3)),
+                last_activity=now - timedelta(seconds=random.randrange(7 * 24 * 3600)),
+            )
+            if photos and random.random() < options['photo_ratio']:
+                user.photo, user.photo_renditions = random.choice(photos)
+            # bulk_create skips save(), so fill the search column here
+            user.search_text = search.search_text_for(user)
+            batch.append(user)
+            if len(batch) == self.batch_size:
+                User.objects.bulk_create(batch)
+                batch = []
+        User.objects.bulk_create(batch)
+
+        # Re-read rather than rely on bulk_create setting pks (MySQL does not)
+        by_gender = {'M': [], 'F': []}
+        rows = User.objects.filter(username__startswith=f"{options['prefix']}_", pk__gte=start_pk)
+        for pk, gender in rows.values_list('pk', 'gender').iterator():
+            by_gender[gender].append(pk)
+        return by_gender
+
+    def seed_conversations(self, users, count):
+        """Create ``count`` 1:1 conversations between opposite-gender users; returns their ids."""
+        men, women = users['M'], users['F']
+        count = min(count, len(men) * len(women))
+        pairs = set()
+        while len(pairs) < count:
+            pairs.add(Conversation.pair_key_for(random.choice(men), random.choice(women)))
+
+        through = Conversation.participants.through
+        now = timezone.now()
+        conv_ids = []
+        pairs = list(pairs)
+        for start in range(0, len(pairs), self.batch_size):
+            keys = pairs[start:start + self.batch_size]
+            with transaction.atomic():
+                Conversation.objects.bulk_create([
+                    Conversation(pair_key=key, created_at=now - timedelta(days=30)) for key in keys
+                ])
+                created = dict(Conversation.objects.filter(pair_key__in=keys).values_list('pair_key', 'pk'))
+                links = []
+                states = []
+                for key, conv_id in created.items():
+                    for user_id in map(int, key.split(':')):
+                        links.append(through(conversation_id=conv_id, user_id=user_id))
+                        states.append(ConversationReadState(conversation_id=conv_id, user_id=user_id))
+                through.objects.bulk_create(links)
+                ConversationReadState.objects.bulk_create(states)
+            conv_ids += created.values()
+        return conv_ids
+
+    def seed_messages(self, conv_ids, count):
+        """Spread ``count`` messages over the conversations, skewed towards a busy few."""
+        through = Conversation.participants.through
+        participants = {conv_id: [] for conv_id in conv_ids}
+        rows = through.objects.filter(conversation_id__gte=min(conv_ids), conversation_id__lte=max(conv_ids))
+        for conv_id, user_id in rows.values_list('conversation_id', 'user_id').iterator():
+            if conv_id in participants:
+                participants[conv_id].append(user_id)
+
+        weights = [random.paretovariate(1.2) for _ in conv_ids]
+        now = timezone.now()
+        batch = []
+        # Insert in timestamp order so ids and timestamps agree, as in production
+        for i, conv_id in enumerate(random.choices(conv_ids, weights, k=count)):
+            batch.append(Message(
+                conversation_id=conv_id,
+                sender_id=random.choice(participants[conv_id]),
+                content=random.choice(SENTENCES),
+                timestamp=now - timedelta(seconds=(count - i) * 2),
+            ))
+            if len(batch) == self.batch_size * 2:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+
+        # Denormalized inbox columns (see core.inbox), one UPDATE per batch of conversations
+        newest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-pk')
+        for start in range(0, len(conv_ids), self.batch_size):
+            Conversation.objects.filter(pk__in=conv_ids[start:start + self.batch_size]).update(
+                last_message_id=Subquery(newest.values('pk')[:1]),
+                last_activity_at=Coalesce(Subquery(newest.values('timestamp')[:1]), F('created_at')),
+            )
+
+    def seed_read_states(self, conv_ids, unread_ratio):
+        """Put most cursors on the newest message and leave a few a couple of messages behind."""
+        newest = Conversation.objects.filter(pk=OuterRef('conversation_id')).values('last_message_id')
+        behind = Message.objects.filter(conversation=OuterRef('conversation_id')).order_by('-pk').values('pk')
+        now = timezone.now()
+        for start in range(0, len(conv_ids), self.batch_size):
+            states = ConversationReadState.objects.filter(conversation_id__in=conv_ids[start:start + self.batch_size])
+            states.update(last_read_id=Subquery(newest), read_at=now)
+            lagging = [pk for pk in states.values_list('pk', flat=True) if random.random() < unread_ratio]
+            lagging = ConversationReadState.objects.filter(pk__in=lagging)
+            lagging.update(last_read_id=Subquery(behind[random.randint(1, 5):][:1]))
+            unread.recount_states(lagging)
+
+    def seed_blocks(self, users, count):
+        through = get_user_model().blocked_users.through
+        everyone = users['M'] + users['F']
+        pairs = {tuple(random.sample(everyone, 2)) for _ in range(count)}
+        through.objects.bulk_create(
+            [through(from_user_id=a, to_user_id=b) for a, b in pairs],
+            batch_size=self.batch_size,
+            ignore_conflicts=True,
+        )
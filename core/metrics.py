@@ -0,0 +1,343 @@
+"""Per-view request metrics in Prometheus text format.
+
+``RequestMetricsMiddleware`` (core.middleware) records, per URL name:
+
+- request count by status class and a latency histogram
+- DB queries and time spent in them
+- cache hits and misses (``get``/``get_many`` on the configured caches)
+- response bytes
+
+Counters live in per-thread dicts that only their own thread writes, so
+recording takes no locks; ``render`` sums them when ``/metrics`` is
+scraped. Counts of threads that exit are folded into a shared total. Each
+process keeps its own numbers, so scrape every worker (or run one). The
+request being measured is tracked in a ``ContextVar`` and queries are
+counted by a hook on every connection (``core.db.hooks``), so async views
+and their worker-thread queries are covered too. The same hook hands each
+query to ``query_recorder`` when one is set (``core.profiling``), so
+profiling needs no wrapper of its own.
+
+Requests slower than ``METRICS_SLOW_REQUEST_MS`` (default 500) are logged
+to the ``core.metrics.slow`` logger. A ``METRICS_SQL_SAMPLE_RATE`` share of
+requests (default 0.01) also keeps the text and timing of every statement,
+which is included when such a request is slow.
+
+``/metrics`` is served to staff and to scrapers that send
+``Authorization: Bearer <METRICS_TOKEN>``. The source address is not
+trusted by default: behind a reverse proxy every request comes from
+localhost.
+
+Settings: ``METRICS_ENABLED`` (default True), ``METRICS_TOKEN`` (default
+unset), ``METRICS_ALLOWED_IPS`` (addresses that may scrape without either,
+default none), plus the two above.
+"""
+import functools
+import logging
+import random
+import threading
+import time
+import weakref
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from django.utils.module_loading import import_string
+
+from .db import hooks
+
+slow_logger = logging.getLogger('core.metrics.slow')
+
+PREFIX = 'friendproject'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Statements kept per sampled request
+SQL_SAMPLE_LIMIT = 200
+_MISSING = object()
+
+
+def enabled():
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+def can_scrape(request):
+    """Whether ``request`` may read ``/metrics``."""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    if token and scheme.lower() == 'bearer' and constant_time_compare(credentials, token):
+        return True
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', []):
+        return True
+    return request.user.is_staff
+
+
+def slow_request_seconds():
+    return getattr(settings, 'METRICS_SLOW_REQUEST_MS', 500) / 1000
+
+
+def sql_sample_rate():
+    return getattr(settings, 'METRICS_SQL_SAMPLE_RATE', 0.01)
+
+
+class ViewStats:
+    __slots__ = ('statuses', 'buckets', 'seconds', 'queries', 'query_seconds', 'cache_hits', 'cache_misses', 'bytes')
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes = 0
+
+    def merge(self, other):
+        for status, count in list(other.statuses.items()):
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.seconds += other.seconds
+        self.queries += other.queries
+        self.query_seconds += other.query_seconds
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        self.bytes += other.bytes
+
+
+class RequestStats:
+    """What one request did; filled in by the query and cache hooks."""
+    __slots__ = ('queries', 'query_seconds', 'cache_hits', 'cache_misses', 'statements', 'in_cache')
+
+    def __init__(self, sample_sql):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.statements = [] if sample_sql else None
+        self.in_cache = False
+
+    def __call__(self, execute, sql, params, many, context):
+        """``connection.execute_wrapper`` hook."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.query_seconds += elapsed
+            if self.statements is not None and len(self.statements) < SQL_SAMPLE_LIMIT:
+                self.statements.append((elapsed, sql))
+
+
+class _ThreadViews:
+    """Holder for one thread's ``{view: ViewStats}``; retired when the thread exits."""
+
+    def __init__(self):
+        self.views = {}
+        with _registry_lock:
+            _live[id(self.views)] = self.views
+        weakref.finalize(self, _retire, self.views)
+
+
+_local = threading.local()
+_request = ContextVar('metrics_request', default=None)
+# An extra execute wrapper for the current request, e.g. the profiler's SQL recorder
+query_recorder = ContextVar('query_recorder', default=None)
+_registry_lock = threading.Lock()
+# id -> views of running threads, and the merged views of finished ones
+_live = {}
+_retired = {}
+
+
+def _thread_views():
+    holder = getattr(_local, 'holder', None)
+    if holder is None:
+        holder = _local.holder = _ThreadViews()
+    return holder.views
+
+
+def _retire(views):
+    with _registry_lock:
+        _live.pop(id(views), None)
+        for name, stats in views.items():
+            _retired.setdefault(name, ViewStats()).merge(stats)
+
+
+def begin_request():
+    """Start collecting for the current request.
+
+    Returns ``(stats, hooks)``; the request must run inside ``with hooks``.
+    """
+    stats = RequestStats(sample_sql=random.random() < sql_sample_rate())
+    stack = ExitStack()
+    stack.callback(_request.reset, _request.set(stats))
+    return stats, stack
+
+
+def _query_hook(execute, sql, params, many, context):
+    recorder = query_recorder.get()
+    if recorder is not None:
+        execute = functools.partial(recorder, execute)
+    stats = _request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+def instrument_connections():
+    hooks.install(_query_hook)
+
+
+def record(view, status, seconds, stats, response_bytes):
+    """Add one finished request to the current thread's counters."""
+    views = _thread_views()
+    view_stats = views.get(view)
+    if view_stats is None:
+        view_stats = views[view] = ViewStats()
+    status_class = f'{status // 100}xx'
+    view_stats.statuses[status_class] = view_stats.statuses.get(status_class, 0) + 1
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            view_stats.buckets[i] += 1
+            break
+    else:
+        view_stats.buckets[-1] += 1
+    view_stats.seconds += seconds
+    view_stats.queries += stats.queries
+    view_stats.query_seconds += stats.query_seconds
+    view_stats.cache_hits += stats.cache_hits
+    view_stats.cache_misses += stats.cache_misses
+    view_stats.bytes += response_bytes
+
+    if seconds >= slow_request_seconds():
+        log_slow(view, status, seconds, stats)
+
+
+def log_slow(view, status, seconds, stats):
+    message = (
+        f"Slow request: {view} {status} in {seconds * 1000:.0f} ms, "
+        f"{stats.queries} queries ({stats.query_seconds * 1000:.0f} ms), "
+        f"cache {stats.cache_hits} hits / {stats.cache_misses} misses"
+    )
+    if stats.statements:
+        message += ''.join(f"\n  {elapsed * 1000:8.2f} ms  {sql}" for elapsed, sql in stats.statements)
+    slow_logger.warning(message)
+
+
+# Cache hooks: wrap get/get_many on the configured backend classes once
+
+_instrumented = set()
+
+
+def instrument_caches():
+    for alias in settings.CACHES:
+        cls = import_string(settings.CACHES[alias]['BACKEND'])
+        if cls in _instrumented:
+            continue
+        _instrumented.add(cls)
+        cls.get = _counting_get(cls.get)
+        cls.get_many = _counting_get_many(cls.get_many)
+
+
+def _current():
+    stats = _request.get()
+    # Only the outermost call counts (BaseCache.get_many is built on get)
+    if stats is None or stats.in_cache:
+        return None
+    return stats
+
+
+def _counting_get(get):
+    def wrapper(self, key, default=None, version=None):
+        stats = _current()
+        if stats is None:
+            return get(self, key, default, version)
+        stats.in_cache = True
+        try:
+            value = get(self, key, _MISSING, version)
+        finally:
+            stats.in_cache = False
+        if value is _MISSING:
+            stats.cache_misses += 1
+            return default
+        stats.cache_hits += 1
+        return value
+    return wrapper
+
+
+def _counting_get_many(get_many):
+    def wrapper(self, keys, version=None):
+        stats = _current()
+        if stats is None:
+            return get_many(self, keys, version)
+        keys = list(keys)
+        stats.in_cache = True
+        try:
+            found = get_many(self, keys, version)
+        finally:
+            stats.in_cache = False
+        stats.cache_hits += len(found)
+        stats.cache_misses += len(keys) - len(found)
+        return found
+    return wrapper
+
+
+# Exposition
+
+def snapshot():
+    """Sum every thread's counters into ``{view: ViewStats}``."""
+    total = {}
+    with _registry_lock:
+        # Copy under the lock so a retiring thread cannot change them mid-iteration
+        sources = [list(views.items()) for views in (_retired, *_live.values())]
+    for items in sources:
+        for name, stats in items:
+            total.setdefault(name, ViewStats()).merge(stats)
+    return total
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """Current metrics in the Prometheus text exposition format."""
+    views = sorted(snapshot().items())
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+        for suffix, labels, value in samples:
+            label_text = ','.join(f'{k}="{_label(v)}"' for k, v in labels.items())
+            lines.append(f'{PREFIX}_{name}{suffix}{{{label_text}}} {value}')
+
+    metric('http_requests_total', 'counter', 'Requests by view and status class.', [
+        ('', {'view': view, 'status': status}, count)
+        for view, stats in views for status, count in sorted(stats.statuses.items())
+    ])
+    histogram = []
+    for view, stats in views:
+        cumulative = 0
+        for bound, count in zip((*BUCKETS, '+Inf'), stats.buckets):
+            cumulative += count
+            histogram.append(('_bucket', {'view': view, 'le': bound}, cumulative))
+        histogram.append(('_sum', {'view': view}, round(stats.seconds, 6)))
+        histogram.append(('_count', {'view': view}, cumulative))
+    metric('http_request_duration_seconds', 'histogram', 'Request latency by view.', histogram)
+    metric('db_queries_total', 'counter', 'SQL statements executed by view.', [
+        ('', {'view': view}, stats.queries) for view, stats in views
+    ])
+    metric('db_query_seconds_total', 'counter', 'Time spent in SQL by view.', [
+        ('', {'view': view}, round(stats.query_seconds, 6)) for view, stats in views
+    ])
+    metric('cache_hits_total', 'counter', 'Cache lookups that found a value, by view.', [
+        ('', {'view': view}, stats.cache_hits) for view, stats in views
+    ])
+    metric('cache_misses_total', 'counter', 'Cache lookups that found nothing, by view.', [
+        ('', {'view': view}, stats.cache_misses) for view, stats in views
+    ])
+    metric('http_response_bytes_total', 'counter', 'Response body bytes by view.', [
+        ('', {'view': view}, stats.bytes) for view, stats in views
+    ])
+    return '\n'.join(lines) + '\n'
+
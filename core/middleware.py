@@ -1,17 +1,107 @@
-from django.utils import timezone
-from django.conf import settings
+import time
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import metrics, presence, profiling
+from .polling import asession_user_id, session_user_id
+
+
+class DualModeMiddleware:
+    """Base for middleware that runs natively under both WSGI and ASGI.
+
+    Django adapts a sync-only middleware under ASGI by running it, and
+    everything after it, in a worker thread, which would take the async
+    views off the event loop. Subclasses implement ``__call__`` for sync
+    requests and ``__acall__`` for async ones.
+    """
+    sync_capable = True
+    async_capable = True
 
-class UserActivityMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        raise NotImplementedError
+
+    async def __acall__(self, request):
+        raise NotImplementedError
+
+
+class RequestMetricsMiddleware(DualModeMiddleware):
+    """Per-view latency, query, cache and response size metrics (see core.metrics).
+
+    Goes first in MIDDLEWARE so the timings cover the whole stack.
+    """
+    def __init__(self, get_response):
+        if not metrics.enabled():
+            raise MiddlewareNotUsed
+        metrics.instrument_caches()
+        super().__init__(get_response)
 
     def __call__(self, request):
-        if request.user.is_authenticated:
-            # Update last activity timestamp and online status
-            request.user.last_activity = timezone.now()
-            request.user.is_online = True
-            request.user.save(update_fields=['last_activity', 'is_online'])
+        if self.async_mode:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        stats, hooks = metrics.begin_request()
+        with hooks:
+            response = self.get_response(request)
+        self.record(request, response, start, stats)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        stats, hooks = metrics.begin_request()
+        with hooks:
+            response = await self.get_response(request)
+        self.record(request, response, start, stats)
+        return response
+
+    def record(self, request, response, start, stats):
+        match = request.resolver_match
+        view = match.view_name if match else '<unresolved>'
+        size = 0 if response.streaming else len(response.content)
+        metrics.record(view, response.status_code, time.perf_counter() - start, stats, size)
+
+
+class ProfilingMiddleware(DualModeMiddleware):
+    """Profile a request when a staff user asks for it (see core.profiling).
+
+    Must come after AuthenticationMiddleware.
+    """
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        mode = profiling.requested_mode(request)
+        if mode is None or not request.user.is_staff:
+            return self.get_response(request)
+        return profiling.profile(request, self.get_response, mode)
+
+    async def __acall__(self, request):
+        mode = profiling.requested_mode(request)
+        if mode is None or not (await request.auser()).is_staff:
+            return await self.get_response(request)
+        return await profiling.aprofile(request, self.get_response, mode)
+
+
+class UserActivityMiddleware(DualModeMiddleware):
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        # Record a heartbeat; the DB row is only written in throttled batches.
+        # The id comes from the session so polls answered with a 304 never load the user
+        user_id = session_user_id(request)
+        if user_id is not None:
+            presence.record_heartbeat_for_id(user_id)
         
         response = self.get_response(request)
-        return response
\ No newline at end of file
+        return response
+
+    async def __acall__(self, request):
+        user_id = await asession_user_id(request)
+        if user_id is not None:
+            await presence.arecord_heartbeat_for_id(user_id)
+        return await self.get_response(request)
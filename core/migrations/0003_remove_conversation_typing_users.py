@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:49
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_user_blocked_users'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='conversation',
+            name='typing_users',
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill(apps, schema_editor):
+    Conversation = apps.get_model('core', 'Conversation')
+    Message = apps.get_model('core', 'Message')
+    ConversationReadState = apps.get_model('core', 'ConversationReadState')
+    Participant = Conversation.participants.through
+
+    unread = (
+        Message.objects.filter(conversation=OuterRef('conversation_id'), read=False)
+        .exclude(sender=OuterRef('user_id'))
+        .order_by()
+        .values('conversation')
+        .annotate(n=Count('pk'))
+        .values('n')
+    )
+    rows = Participant.objects.annotate(unread=Coalesce(Subquery(unread), 0)).values_list(
+        'conversation_id', 'user_id', 'unread'
+    )
+    ConversationReadState.objects.bulk_create(
+        [ConversationReadState(conversation_id=c, user_id=u, unread_count=n) for c, u, n in rows.iterator()],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_conversationreadstate'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_direct_conversations(apps, schema_editor):
+    """Set pair_key on 1:1 conversations, folding duplicates into the oldest one."""
+    Conversation = apps.get_model('core', 'Conversation')
+    ConversationReadState = apps.get_model('core', 'ConversationReadState')
+    Message = apps.get_model('core', 'Message')
+    Participant = Conversation.participants.through
+
+    direct_ids = (
+        Conversation.objects.annotate(n=Count('participants')).filter(n=2).values_list('pk', flat=True)
+    )
+    pairs = {}
+    for conversation_id, user_id in Participant.objects.filter(
+        conversation_id__in=list(direct_ids)
+    ).values_list('conversation_id', 'user_id').order_by('conversation_id'):
+        pairs.setdefault(conversation_id, []).append(user_id)
+
+    by_key = {}
+    for conversation_id, user_ids in pairs.items():
+        low, high = sorted(user_ids)
+        by_key.setdefault(f"{low}:{high}", []).append(conversation_id)
+
+    for key, conversation_ids in by_key.items():
+        keeper, duplicates = conversation_ids[0], conversation_ids[1:]
+        if duplicates:
+            Message.objects.filter(conversation_id__in=duplicates).update(conversation_id=keeper)
+            for user_id in map(int, key.split(':')):
+                unread = ConversationReadState.objects.filter(
+                    conversation_id__in=conversation_ids, user_id=user_id
+                ).aggregate(n=Sum('unread_count'))['n'] or 0
+                ConversationReadState.objects.filter(conversation_id=keeper, user_id=user_id).update(unread_count=unread)
+            latest = Message.objects.filter(conversation_id=keeper).order_by('-timestamp', '-id').first()
+            if latest is not None:
+                Conversation.objects.filter(pk=keeper).update(
+                    last_message_id=latest.pk, last_activity_at=latest.timestamp
+                )
+            Conversation.objects.filter(pk__in=duplicates).delete()
+        Conversation.objects.filter(pk=keeper).update(pair_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_conversation_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=41, null=True),
+        ),
+        migrations.RunPython(merge_direct_conversations, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='conversation',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=41, null=True, unique=True),
+        ),
+    ]
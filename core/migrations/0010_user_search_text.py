@@ -0,0 +1,58 @@
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+
+def normalize(text):
+    # Frozen copy of core.search.normalize
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+def backfill(apps, schema_editor):
+    User = apps.get_model('core', 'User')
+    batch = []
+    for user in User.objects.only('pk', 'username', 'bio').iterator(chunk_size=2000):
+        user.search_text = normalize(f"{user.username} {user.bio}")
+        batch.append(user)
+        if len(batch) == 2000:
+            User.objects.bulk_update(batch, ['search_text'])
+            batch = []
+    User.objects.bulk_update(batch, ['search_text'])
+
+
+def create_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute('CREATE FULLTEXT INDEX user_search_ft ON core_user (search_text)')
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX user_search_ft ON core_user USING gin (to_tsvector('simple', search_text))"
+        )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute('DROP INDEX user_search_ft ON core_user')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX user_search_ft')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_user_gender_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
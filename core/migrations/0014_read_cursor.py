@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:14
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill(apps, schema_editor):
+    """Place each cursor just before the participant's oldest unread message."""
+    Conversation = apps.get_model('core', 'Conversation')
+    Message = apps.get_model('core', 'Message')
+    ConversationReadState = apps.get_model('core', 'ConversationReadState')
+
+    # Nothing unread: the cursor sits on the newest message
+    newest = Conversation.objects.filter(pk=OuterRef('conversation_id')).values('last_message_id')
+    ConversationReadState.objects.filter(unread_count=0).update(last_read_id=Subquery(newest))
+
+    for state in ConversationReadState.objects.exclude(unread_count=0).iterator():
+        messages = Message.objects.filter(conversation_id=state.conversation_id).order_by('-pk')
+        first_unread = (
+            messages.filter(read=False).exclude(sender_id=state.user_id)
+            .order_by('pk').values_list('pk', flat=True).first()
+        )
+        if first_unread is not None:
+            messages = messages.filter(pk__lt=first_unread)
+        state.last_read_id = messages.values_list('pk', flat=True).first()
+        state.save(update_fields=['last_read_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_user_profile_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationreadstate',
+            name='last_read_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationreadstate',
+            name='read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_conv_read_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_unread_idx',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='read',
+        ),
+    ]
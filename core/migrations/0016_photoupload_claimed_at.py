@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:07
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill(apps, schema_editor):
+    # Jobs already in flight count as claimed when they were created, as before
+    PhotoUpload = apps.get_model('core', 'PhotoUpload')
+    PhotoUpload.objects.filter(status='processing').update(claimed_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_profile_report'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photoupload',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
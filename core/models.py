@@ -1,6 +1,9 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 
@@ -18,6 +21,41 @@ class User(AbstractUser):
     is_online = models.BooleanField(default=False)
     # Users this user has blocked (they won't be able to message or see each other depending on business rules)
     blocked_users = models.ManyToManyField('self', symmetrical=False, related_name='blocked_by', blank=True)
+    # Normalized username + bio, maintained in save() and full-text indexed (see core.search)
+    search_text = models.TextField(blank=True, default='', editable=False)
+    # Storage names of the resized photo variants (see core.renditions)
+    photo_renditions = models.JSONField(default=dict, blank=True, editable=False)
+    # Bumped whenever the public profile changes; keys cached profile cards (see core.fragments)
+    profile_updated_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Seek within one gender by id (random picks, listings)
+            models.Index(fields=['gender', 'id'], name='user_gender_id_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        from .search import search_text_for
+        self.search_text = search_text_for(self)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            # Full saves come from signup, profile edit and the admin
+            self.profile_updated_at = timezone.now()
+        elif {'username', 'bio'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'search_text'}
+        super().save(*args, **kwargs)
+
+    @property
+    def avatar_url(self):
+        """Small square photo for avatars, or '' without a photo"""
+        from .renditions import url_for
+        return url_for(self, 'avatar')
+
+    @property
+    def profile_photo_url(self):
+        """Profile-page sized photo, or '' without a photo"""
+        from .renditions import url_for
+        return url_for(self, 'profile')
 
     def is_adult(self):
         """Check if the user is 18 or older"""
@@ -28,30 +66,18 @@ class User(AbstractUser):
         return 'F' if self.gender == 'M' else 'M'
 
     def update_last_activity(self):
-        """Update user's last activity timestamp and online status"""
-        self.last_activity = timezone.now()
-        self.is_online = True
-        self.save(update_fields=['last_activity', 'is_online'])
+        """Record a presence heartbeat (written to the DB in throttled batches)"""
+        from .presence import record_heartbeat
+        record_heartbeat(self)
 
     def get_online_status(self):
         """
         Get user's online status.
-        Returns a tuple of (status, duration) where status is either 'online', 'away', or 'offline'
+        Returns a tuple of (status, duration) where status is either 'online', 'away', or 'offline'.
+        Read-only: idle users are marked offline by the flush_presence command.
         """
-        if not self.last_activity:
-            return 'offline', None
-        
-        now = timezone.now()
-        delta = now - self.last_activity
-        
-        if delta.total_seconds() < 300:  # 5 minutes
-            return 'online', None
-        elif delta.total_seconds() < 900:  # 15 minutes
-            return 'away', delta
-        else:
-            self.is_online = False
-            self.save(update_fields=['is_online'])
-            return 'offline', delta
+        from .presence import last_seen, status_from
+        return status_from(last_seen(self))
 
     def __str__(self):
         return f"{self.username} ({self.get_gender_display()})"
@@ -61,20 +87,61 @@ class Conversation(models.Model):
     """A simple conversation between two or more users."""
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='conversations')
     created_at = models.DateTimeField(default=timezone.now)
-    typing_users = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='typing_in_conversations', blank=True)
+    # Denormalized for the inbox: latest message and when the conversation last changed
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_activity_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # "<low user id>:<high user id>" for 1:1 conversations, NULL for groups
+    pair_key = models.CharField(max_length=41, null=True, blank=True, unique=True)
+
+    PARTICIPANTS_KEY = 'conversation:{}:participants'
 
     def __str__(self):
         return f"Conversation {self.pk} ({', '.join(p.username for p in self.participants.all())})"
 
     def other_participant(self, user):
-        return self.participants.exclude(pk=user.pk).first()
+        # Iterate participants.all() so a prefetch_related('participants') is reused
+        for participant in self.participants.all():
+            if participant.pk != user.pk:
+                return participant
+        return None
+
+    @staticmethod
+    def pair_key_for(user_a_id, user_b_id):
+        """Canonical key of the direct conversation between two users"""
+        low, high = sorted((user_a_id, user_b_id))
+        return f"{low}:{high}"
+
+    @classmethod
+    def participant_ids_for(cls, conversation_id):
+        """Return participant ids, cached because membership almost never changes"""
+        key = cls.PARTICIPANTS_KEY.format(conversation_id)
+        ids = cache.get(key)
+        if ids is None:
+            ids = list(cls.participants.through.objects.filter(
+                conversation_id=conversation_id
+            ).values_list('user_id', flat=True))
+            cache.set(key, ids, 3600)
+        return ids
+
+    @classmethod
+    async def aparticipant_ids_for(cls, conversation_id):
+        """Async version of ``participant_ids_for`` for async views."""
+        key = cls.PARTICIPANTS_KEY.format(conversation_id)
+        ids = await cache.aget(key)
+        if ids is None:
+            ids = [pk async for pk in cls.participants.through.objects.filter(
+                conversation_id=conversation_id
+            ).values_list('user_id', flat=True)]
+            await cache.aset(key, ids, 3600)
+        return ids
+
+    def participant_ids(self):
+        return Conversation.participant_ids_for(self.pk)
 
     def get_typing_users(self, exclude_user=None):
-        """Get users who are currently typing, optionally excluding a specific user"""
-        qs = self.typing_users.all()
-        if exclude_user:
-            qs = qs.exclude(pk=exclude_user.pk)
-        return qs
+        """Get payloads of users currently typing, optionally excluding a specific user"""
+        from .typing_state import typing_users
+        return typing_users(self.pk, self.participant_ids(), exclude_user.pk if exclude_user else None)
 
 
 class Message(models.Model):
@@ -82,16 +149,184 @@ class Message(models.Model):
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='sent_messages', on_delete=models.CASCADE)
     content = models.TextField()
     timestamp = models.DateTimeField(default=timezone.now)
-    read = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
     is_deleted = models.BooleanField(default=False)
 
+    class Meta:
+        ordering = ['timestamp', 'id']
+        indexes = [
+            # History pages and the default ordering: seek within one conversation
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conv_ts_idx'),
+        ]
+
     def __str__(self):
         return f"Message {self.pk} from {self.sender.username} at {self.timestamp}"
 
+    def to_dict(self):
+        """JSON-friendly representation shared by the AJAX and realtime endpoints"""
+        from django.utils.dateformat import format as date_format
+        sender = self.sender
+        return {
+            'id': self.pk,
+            'content': '' if self.is_deleted else self.content,
+            'timestamp': date_format(self.timestamp, 'g:i A'),
+            'sender': sender.username,
+            'sender_id': sender.pk,
+            'sender_photo': sender.avatar_url,
+            'edited_at': date_format(self.edited_at, 'g:i A') if self.edited_at else None,
+            'is_deleted': self.is_deleted,
+        }
+
+
+class ConversationReadState(models.Model):
+    """Per-participant read cursor for a conversation.
+
+    ``last_read_id`` is the newest message the participant has seen; every
+    message after it (from someone else) is unread. ``unread_count`` is
+    maintained on send and recomputed from the cursor on mark-read so the
+    unread badge never has to count messages.
+    """
+    conversation = models.ForeignKey(Conversation, related_name='read_states', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='read_states', on_delete=models.CASCADE)
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_id = models.PositiveBigIntegerField(null=True, blank=True)
+    read_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='read_state_user_conversation_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} in conversation {self.conversation_id}: {self.unread_count} unread"
+
+
+class PhotoUpload(models.Model):
+    """A profile photo spooled to disk and waiting to be processed off the request (see core.uploads)."""
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='photo_uploads', on_delete=models.CASCADE)
+    spool_path = models.CharField(max_length=500)
+    original_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    error = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    # When a worker took the job; recovery only resets jobs claimed long ago
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Latest upload of a user, for the profile status
+            models.Index(fields=['user', '-id'], name='photo_upload_user_idx'),
+            # Recovery sweep of unfinished jobs
+            models.Index(fields=['status', 'created_at'], name='photo_upload_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"Photo upload {self.pk} for {self.user_id}: {self.status}"
+
+
+class ProfileReport(models.Model):
+    """One profiled request, triggered by a staff user (see core.profiling)."""
+    SAMPLE = 'sample'
+    CPROFILE = 'cprofile'
+    MODE_CHOICES = (
+        (SAMPLE, 'Stack sampling'),
+        (CPROFILE, 'cProfile'),
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, related_name='+', on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(default=timezone.now)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    view_name = models.CharField(max_length=200, blank=True)
+    status = models.PositiveSmallIntegerField()
+    mode = models.CharField(max_length=10, choices=MODE_CHOICES, default=SAMPLE)
+    duration_ms = models.FloatField()
+    query_count = models.PositiveIntegerField()
+    query_ms = models.FloatField()
+    # Flamegraph input: "frame;frame;frame count" per line
+    collapsed = models.TextField(blank=True)
+    # Every statement with its timing and calling frames; parameters are not kept
+    sql = models.TextField(blank=True)
+    # cProfile table, or the hottest functions by sample count
+    stats = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-id']
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def forget_participant_ids(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop cached participant ids when membership changes"""
+    if action == 'pre_clear' and reverse:
+        # user.conversations.clear() has no pk_set: note the conversations before they go
+        instance._cleared_conversation_ids = list(instance.conversations.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        conversation_ids = [instance.pk]
+    elif action == 'post_clear':
+        conversation_ids = instance.__dict__.pop('_cleared_conversation_ids', [])
+    else:
+        conversation_ids = pk_set
+    cache.delete_many([Conversation.PARTICIPANTS_KEY.format(pk) for pk in conversation_ids])
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def create_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    """Give new participants a read state, which is what lists the conversation in their inbox"""
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        states = [ConversationReadState(conversation_id=pk, user=instance) for pk in pk_set]
+    else:
+        states = [ConversationReadState(conversation=instance, user_id=pk) for pk in pk_set]
+    ConversationReadState.objects.bulk_create(states, ignore_conflicts=True)
 
 
+@receiver(m2m_changed, sender=User.blocked_users.through)
+def forget_blocks(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop cached block id sets when blocks change outside ``blocking.toggle``"""
+    from . import blocking
+    if action == 'pre_clear':
+        # clear() has no pk_set: note the other side before the rows go
+        related = instance.blocked_by if reverse else instance.blocked_users
+        instance._cleared_block_ids = set(related.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    others = instance.__dict__.pop('_cleared_block_ids', set()) if action == 'post_clear' else pk_set
+    if reverse:
+        blocking.forget(blocker_ids=others, blocked_ids=[instance.pk])
+    else:
+        blocking.forget(blocker_ids=[instance.pk], blocked_ids=others)
 
 
+@receiver(pre_delete, sender=User)
+def note_blocks_of_deleted_user(sender, instance, **kwargs):
+    """Remember who a user blocked and was blocked by; the rows cascade away with them"""
+    from . import blocking
+    instance._block_ids = blocking.related_ids(instance.pk)
 
 
+@receiver(post_delete, sender=User)
+def forget_blocks_of_deleted_user(sender, instance, **kwargs):
+    """Drop the deleted user's block id sets and those of everyone on either side"""
+    from . import blocking
+    blocked, blocked_by = instance.__dict__.pop('_block_ids', ((), ()))
+    blocking.forget(blocker_ids=[instance.pk, *blocked_by], blocked_ids=[instance.pk, *blocked])
@@ -0,0 +1,134 @@
+"""Conditional GET for the polling endpoints.
+
+The chat page polls typing users, participant statuses and new messages
+when its event stream is unavailable. Each of those answers carries an
+ETag built only from cache lookups, so an unchanged poll is turned into a
+``304 Not Modified`` by ``django.views.decorators.http.condition`` before
+the view runs, without loading the user or touching the database:
+
+- typing: the typing entries currently in the cache (so TTL expiry changes
+  the tag too)
+- statuses: the participants' presence statuses from the presence store
+  (a participant missing from the store costs one query)
+- messages after a cursor: the conversation's change stamp from
+  ``core.fragments``, bumped on send, edit and delete
+
+The viewer is identified from the session rather than ``request.user``.
+The ETag functions return ``None`` (no conditional handling) for anonymous
+users and non-participants, so those fall through to the normal view.
+
+Async views (``core.async_views``) use ``acondition`` with the ``a``-prefixed
+ETag functions instead, since Django's ``condition`` calls the ETag function
+synchronously and the session and participant lookups may hit the database.
+"""
+import functools
+import hashlib
+import json
+
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from . import fragments, presence, typing_state
+from .models import Conversation
+
+
+def session_user_id(request):
+    """The logged-in user's id from the session, without loading the user."""
+    session = getattr(request, 'session', None)
+    return _user_id(session.get(SESSION_KEY) if session is not None else None)
+
+
+async def asession_user_id(request):
+    """Async version of ``session_user_id``."""
+    session = getattr(request, 'session', None)
+    return _user_id(await session.aget(SESSION_KEY) if session is not None else None)
+
+
+def _user_id(raw):
+    if raw is None:
+        return None
+    try:
+        return get_user_model()._meta.pk.to_python(raw)
+    except Exception:
+        return None
+
+
+def _participant(request, conversation_id):
+    """``(viewer id, participant ids)`` if the viewer belongs to the conversation."""
+    user_id = session_user_id(request)
+    if user_id is None:
+        return None, None
+    participant_ids = Conversation.participant_ids_for(conversation_id)
+    if user_id not in participant_ids:
+        return None, None
+    return user_id, participant_ids
+
+
+async def _aparticipant(request, conversation_id):
+    user_id = await asession_user_id(request)
+    if user_id is None:
+        return None, None
+    participant_ids = await Conversation.aparticipant_ids_for(conversation_id)
+    if user_id not in participant_ids:
+        return None, None
+    return user_id, participant_ids
+
+
+def _digest(prefix, value):
+    return f'{prefix}-' + hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def typing_etag(request, conversation_id):
+    user_id, participant_ids = _participant(request, conversation_id)
+    if user_id is None:
+        return None
+    return _digest('t', typing_state.typing_users(conversation_id, participant_ids, exclude_user_id=user_id))
+
+
+async def atyping_etag(request, conversation_id):
+    user_id, participant_ids = await _aparticipant(request, conversation_id)
+    if user_id is None:
+        return None
+    return _digest('t', await typing_state.atyping_users(conversation_id, participant_ids, exclude_user_id=user_id))
+
+
+def statuses_etag(request, conversation_id):
+    user_id, participant_ids = _participant(request, conversation_id)
+    if user_id is None:
+        return None
+    return _digest('p', sorted(presence.statuses_for_ids(participant_ids).items()))
+
+
+async def astatuses_etag(request, conversation_id):
+    user_id, participant_ids = await _aparticipant(request, conversation_id)
+    if user_id is None:
+        return None
+    return _digest('p', sorted((await presence.astatuses_for_ids(participant_ids)).items()))
+
+
+def messages_after_etag(request, pk):
+    """ETag for ``conversation_detail?after=<id>``; other requests are not conditional."""
+    if request.method != 'GET' or 'after' not in request.GET or 'before' in request.GET:
+        return None
+    user_id, _ = _participant(request, pk)
+    if user_id is None:
+        return None
+    return f'm{fragments.messages_stamp(pk)}'
+
+
+def acondition(etag_func):
+    """``condition(etag_func=...)`` for async views with an async ``etag_func``."""
+    def decorator(view):
+        @functools.wraps(view)
+        async def inner(request, *args, **kwargs):
+            etag = await etag_func(request, *args, **kwargs)
+            etag = quote_etag(etag) if etag is not None else None
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            if etag and request.method in ('GET', 'HEAD'):
+                response.headers.setdefault('ETag', etag)
+            return response
+        return inner
+    return decorator
@@ -0,0 +1,315 @@
+"""Write-behind presence tracking.
+
+Heartbeats are recorded in a Django cache (``PRESENCE_CACHE_ALIAS``) so reads
+always see the latest activity, while the ``last_activity``/``is_online``
+columns are written at most once per ``PRESENCE_WRITE_INTERVAL`` seconds per
+user, in batched bulk updates from a background flusher thread.
+
+Settings (all optional):
+
+- ``PRESENCE_CACHE_ALIAS``: cache used as the presence store (default ``'default'``)
+- ``PRESENCE_WRITE_INTERVAL``: minimum seconds between DB writes per user (default 60)
+- ``PRESENCE_FLUSH_INTERVAL``: seconds between background flushes; ``0`` writes
+  through on the request thread instead (default 10)
+- ``PRESENCE_STORE_TTL``: how long a heartbeat is kept in the store (default 3600)
+- ``PRESENCE_ONLINE_SECONDS``: idle time after which a user is 'away' (default 300)
+- ``PRESENCE_AWAY_SECONDS``: idle time after which a user is 'offline' (default 900)
+
+Status is computed here and nowhere else: ``status_from`` for one timestamp,
+``statuses`` for a batch of loaded users (one store multi-get) and
+``statuses_for_ids`` for bare ids (one multi-get plus at most one query).
+Reading status never writes. The ``a``-prefixed functions are the versions
+for async code and use the store's async methods.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+SEEN_KEY = 'presence:seen:{}'
+THROTTLE_KEY = 'presence:throttle:{}'
+
+ONLINE = 'online'
+AWAY = 'away'
+OFFLINE = 'offline'
+
+# Bootstrap text classes used for the status dots
+STATUS_CLASSES = {
+    ONLINE: 'text-success',
+    AWAY: 'text-warning',
+    OFFLINE: 'text-danger',
+}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def thresholds():
+    """Return ``(online_seconds, away_seconds)``."""
+    return (
+        _setting('PRESENCE_ONLINE_SECONDS', 300),
+        _setting('PRESENCE_AWAY_SECONDS', 900),
+    )
+
+
+def get_store():
+    """Return the cache backend used to hold heartbeats."""
+    return caches[_setting('PRESENCE_CACHE_ALIAS', 'default')]
+
+
+class PresenceBuffer:
+    """Thread-safe map of user id -> latest heartbeat waiting to be written."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, user_id, when):
+        with self._lock:
+            self._pending[user_id] = when
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        """Put back drained heartbeats unless a newer one was added since."""
+        with self._lock:
+            for user_id, when in pending.items():
+                self._pending.setdefault(user_id, when)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+_buffer = PresenceBuffer()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def record_heartbeat(user, now=None):
+    """Record activity for ``user`` and update the loaded instance to match."""
+    now = record_heartbeat_for_id(user.pk, now)
+    # Keep the in-memory instance consistent for the rest of the request
+    user.last_activity = now
+    user.is_online = True
+
+
+def record_heartbeat_for_id(user_id, now=None):
+    """Record activity for ``user_id`` without necessarily touching the database.
+
+    The store is always updated; a DB write is queued only when the per-user
+    throttle window has elapsed. Returns the recorded time.
+    """
+    now = now or timezone.now()
+    if _queue_heartbeat(user_id, now):
+        flush()
+    return now
+
+
+async def arecord_heartbeat_for_id(user_id, now=None):
+    """Async version of ``record_heartbeat_for_id``; only a write-through flush leaves the loop."""
+    now = now or timezone.now()
+    if await _aqueue_heartbeat(user_id, now):
+        await sync_to_async(flush)()
+    return now
+
+
+def _queue_heartbeat(user_id, now):
+    """Store the heartbeat and queue the DB write if due; True if it must be flushed now."""
+    store = get_store()
+    store.set(SEEN_KEY.format(user_id), now, timeout=_setting('PRESENCE_STORE_TTL', 3600))
+
+    interval = _setting('PRESENCE_WRITE_INTERVAL', 60)
+    if not store.add(THROTTLE_KEY.format(user_id), 1, timeout=interval):
+        return False
+    return _buffer_heartbeat(user_id, now)
+
+
+async def _aqueue_heartbeat(user_id, now):
+    store = get_store()
+    await store.aset(SEEN_KEY.format(user_id), now, timeout=_setting('PRESENCE_STORE_TTL', 3600))
+
+    interval = _setting('PRESENCE_WRITE_INTERVAL', 60)
+    if not await store.aadd(THROTTLE_KEY.format(user_id), 1, timeout=interval):
+        return False
+    return _buffer_heartbeat(user_id, now)
+
+
+def _buffer_heartbeat(user_id, now):
+    _buffer.add(user_id, now)
+    if _setting('PRESENCE_FLUSH_INTERVAL', 10) <= 0:
+        return True
+    _ensure_flusher()
+    return False
+
+
+def last_seen(user):
+    """Return the freshest known activity time for ``user``."""
+    return get_store().get(SEEN_KEY.format(user.pk)) or user.last_activity
+
+
+def last_seen_many(users):
+    """Return ``{user.pk: last activity}`` for ``users`` with one store lookup."""
+    users = list(users)
+    keys = {SEEN_KEY.format(u.pk): u for u in users}
+    found = get_store().get_many(keys.keys())
+    return {u.pk: found.get(key) or u.last_activity for key, u in keys.items()}
+
+
+async def alast_seen_many(users):
+    """Async version of ``last_seen_many``."""
+    users = list(users)
+    keys = {SEEN_KEY.format(u.pk): u for u in users}
+    found = await get_store().aget_many(keys.keys())
+    return {u.pk: found.get(key) or u.last_activity for key, u in keys.items()}
+
+
+def status_from(last_activity, now=None):
+    """Return ``(status, idle timedelta)`` for a last-activity timestamp.
+
+    The delta is ``None`` for online users and users never seen.
+    """
+    if not last_activity:
+        return OFFLINE, None
+    online_seconds, away_seconds = thresholds()
+    delta = (now or timezone.now()) - last_activity
+    idle = delta.total_seconds()
+    if idle < online_seconds:
+        return ONLINE, None
+    if idle < away_seconds:
+        return AWAY, delta
+    return OFFLINE, delta
+
+
+def status_of(user, now=None):
+    """Return the status string for a single loaded user."""
+    return status_from(last_seen(user), now)[0]
+
+
+def statuses(users, now=None):
+    """Return ``{user.pk: status}`` for already loaded users without any query."""
+    now = now or timezone.now()
+    return {pk: status_from(seen, now)[0] for pk, seen in last_seen_many(users).items()}
+
+
+async def astatuses(users, now=None):
+    """Async version of ``statuses``."""
+    now = now or timezone.now()
+    return {pk: status_from(seen, now)[0] for pk, seen in (await alast_seen_many(users)).items()}
+
+
+def _stored_seen(user_ids):
+    found = get_store().get_many([SEEN_KEY.format(pk) for pk in user_ids])
+    return _by_id(user_ids, found)
+
+
+async def _astored_seen(user_ids):
+    found = await get_store().aget_many([SEEN_KEY.format(pk) for pk in user_ids])
+    return _by_id(user_ids, found)
+
+
+def _by_id(user_ids, found):
+    return {pk: found[SEEN_KEY.format(pk)] for pk in user_ids if SEEN_KEY.format(pk) in found}
+
+
+def statuses_for_ids(user_ids, now=None):
+    """Return ``{user_id: status}``; ids missing from the store cost one query."""
+    now = now or timezone.now()
+    user_ids = set(user_ids)
+    seen = _stored_seen(user_ids)
+    missing = user_ids - seen.keys()
+    if missing:
+        seen.update(
+            get_user_model().objects.filter(pk__in=missing).values_list('pk', 'last_activity')
+        )
+    return {pk: status_from(seen.get(pk), now)[0] for pk in user_ids}
+
+
+async def astatuses_for_ids(user_ids, now=None):
+    """Async version of ``statuses_for_ids``."""
+    now = now or timezone.now()
+    user_ids = set(user_ids)
+    seen = await _astored_seen(user_ids)
+    missing = user_ids - seen.keys()
+    if missing:
+        rows = get_user_model().objects.filter(pk__in=missing).values_list('pk', 'last_activity')
+        seen.update([row async for row in rows])
+    return {pk: status_from(seen.get(pk), now)[0] for pk in user_ids}
+
+
+def flush():
+    """Write all pending heartbeats to the database. Returns the number of rows.
+
+    If the write fails the heartbeats go back in the buffer for the next
+    flush: their throttle keys are set, so nothing else would queue them.
+    """
+    pending = _buffer.drain()
+    if not pending:
+        return 0
+    User = get_user_model()
+    rows = [User(pk=pk, last_activity=when, is_online=True) for pk, when in pending.items()]
+    try:
+        User.objects.bulk_update(rows, ['last_activity', 'is_online'], batch_size=500)
+    except Exception:
+        _buffer.restore(pending)
+        raise
+    return len(rows)
+
+
+def _flush_at_exit():
+    # The database may be gone by now, e.g. a test database after the run
+    try:
+        flush()
+    except DatabaseError:
+        logger.warning('Dropped %d presence heartbeats at exit', len(_buffer), exc_info=True)
+
+
+def sweep_offline(now=None):
+    """Mark users that have been idle past the away threshold as offline."""
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=thresholds()[1])
+    return get_user_model().objects.filter(
+        is_online=True, last_activity__lt=cutoff
+    ).update(is_online=False)
+
+
+class PresenceFlusher(threading.Thread):
+    """Daemon thread that periodically flushes the heartbeat buffer."""
+
+    def __init__(self, interval):
+        super().__init__(name='presence-flusher', daemon=True)
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                flush()
+            except Exception:
+                logger.exception('Presence flush failed')
+            finally:
+                connection.close()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = PresenceFlusher(_setting('PRESENCE_FLUSH_INTERVAL', 10))
+            _flusher.start()
+            atexit.register(_flush_at_exit)
@@ -0,0 +1,239 @@
+"""On-demand profiling of single requests.
+
+A staff user adds an ``X-Profile: 1`` header (or ``?_profile=1``) to any
+request. ``ProfilingMiddleware`` then runs it under a stack sampler, and
+with ``X-Profile: cprofile`` (``?_profile=cprofile``) also under cProfile,
+records every SQL statement with the application frames that issued it,
+and stores a ``ProfileReport``. Statements are kept with their placeholders
+only: parameters carry password hashes, session keys and message text, and
+any admin can download a report. Reports are listed in the admin, where the
+collapsed stacks (for flamegraph.pl, speedscope or inferno), the SQL and
+the profile table can be downloaded. The response carries the report id
+in ``X-Profile-Report``.
+
+Requests without the header or query flag cost one dict lookup and one
+substring test in the middleware. Statements are recorded through the
+metrics query hook (``core.metrics.query_recorder``) rather than a hook of
+their own, so unprofiled queries only pay that hook's one extra
+``ContextVar`` lookup.
+
+Async views are profiled on the event loop thread, so samples and the
+cProfile table also include other requests served concurrently. Their
+queries run on a worker thread, so the SQL report lists them without the
+calling view frames.
+
+Settings: ``PROFILE_SAMPLE_INTERVAL`` (seconds between stack samples,
+default 0.001) and ``PROFILE_REPORTS_KEEP`` (newest reports kept, default
+100).
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+
+HEADER = 'HTTP_X_PROFILE'
+PARAM = '_profile'
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+# Application frames kept per SQL statement
+SQL_STACK_DEPTH = 8
+# The query hook that sits between the caller and the database
+_HOOK_FILES = {__file__, metrics.__file__}
+
+
+def requested_mode(request):
+    """The profiling mode asked for by ``request``, or ``None`` (the cheap check)."""
+    value = request.META.get(HEADER)
+    if value is None:
+        if f'{PARAM}=' not in request.META.get('QUERY_STRING', ''):
+            return None
+        value = request.GET.get(PARAM)
+    if not value or value == '0':
+        return None
+    return CPROFILE if value == CPROFILE else SAMPLE
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _short_path(filename):
+    base = str(settings.BASE_DIR)
+    if filename.startswith(base):
+        return os.path.relpath(filename, base)
+    marker = 'site-packages' + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return filename
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                self.counts[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.counts.most_common())
+
+    def top(self, limit=40):
+        """Leaf functions by sample count, a plain-text stand-in for a cProfile table."""
+        total = sum(self.counts.values()) or 1
+        leaves = Counter()
+        for stack, count in self.counts.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        lines = [f'{sum(self.counts.values())} samples every {self.interval * 1000:g} ms\n', '  self%  samples  function']
+        lines += [f'{count * 100 / total:6.1f}% {count:8}  {name}' for name, count in leaves.most_common(limit)]
+        return '\n'.join(lines) + '\n'
+
+
+class SqlRecorder:
+    """Query hook keeping each statement, its timing and its caller, but not its parameters."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.statements.append((elapsed, sql, len(params or ()), self._app_frames()))
+
+    @staticmethod
+    def _app_frames():
+        base = str(settings.BASE_DIR)
+        frames = [
+            f'{_short_path(f.filename)}:{f.lineno} in {f.name}'
+            for f in traceback.extract_stack()
+            if f.filename.startswith(base) and 'site-packages' not in f.filename and f.filename not in _HOOK_FILES
+        ]
+        return frames[-SQL_STACK_DEPTH:]
+
+    @property
+    def seconds(self):
+        return sum(elapsed for elapsed, _, _, _ in self.statements)
+
+    def report(self):
+        out = []
+        for i, (elapsed, sql, param_count, frames) in enumerate(self.statements, 1):
+            out.append(f'-- {i}. {elapsed * 1000:.2f} ms, {param_count} parameters (not recorded)')
+            out.append(sql)
+            out += [f'--   at {frame}' for frame in reversed(frames)]
+            out.append('')
+        return '\n'.join(out)
+
+
+class _Run:
+    """The profilers attached to one request, started on creation."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.sampler = StackSampler(threading.get_ident(), getattr(settings, 'PROFILE_SAMPLE_INTERVAL', 0.001))
+        self.recorder = SqlRecorder()
+        self.profiler = cProfile.Profile() if mode == CPROFILE else None
+        self._token = metrics.query_recorder.set(self.recorder)
+        self.sampler.start()
+        self.start = time.perf_counter()
+        if self.profiler:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.profiler:
+            self.profiler.disable()
+        self.elapsed = time.perf_counter() - self.start
+        self.sampler.stop()
+        metrics.query_recorder.reset(self._token)
+
+    def report(self, request, user, response):
+        """Unsaved ``ProfileReport`` for the finished request."""
+        from .models import ProfileReport
+
+        if self.profiler:
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(60)
+            stats = out.getvalue()
+        else:
+            stats = self.sampler.top()
+        match = request.resolver_match
+        return ProfileReport(
+            user=user,
+            method=request.method,
+            path=request.get_full_path()[:500],
+            view_name=match.view_name[:200] if match else '',
+            status=response.status_code,
+            mode=self.mode,
+            duration_ms=self.elapsed * 1000,
+            query_count=len(self.recorder.statements),
+            query_ms=self.recorder.seconds * 1000,
+            collapsed=self.sampler.collapsed(),
+            sql=self.recorder.report(),
+            stats=stats,
+        )
+
+
+def profile(request, get_response, mode):
+    """Run ``get_response(request)`` under the profilers and store a ``ProfileReport``."""
+    run = _Run(mode)
+    try:
+        response = get_response(request)
+    finally:
+        run.stop()
+    report = run.report(request, request.user, response)
+    report.save()
+    prune()
+    response['X-Profile-Report'] = str(report.pk)
+    return response
+
+
+async def aprofile(request, get_response, mode):
+    """Async version of ``profile`` for the ASGI middleware chain."""
+    run = _Run(mode)
+    try:
+        response = await get_response(request)
+    finally:
+        run.stop()
+    report = run.report(request, await request.auser(), response)
+    await report.asave()
+    await sync_to_async(prune)()
+    response['X-Profile-Report'] = str(report.pk)
+    return response
+
+
+def prune():
+    """Keep only the newest ``PROFILE_REPORTS_KEEP`` reports."""
+    from .models import ProfileReport
+
+    keep = max(getattr(settings, 'PROFILE_REPORTS_KEEP', 100), 1)
+    oldest_kept = ProfileReport.objects.order_by('-pk').values_list('pk', flat=True)[keep - 1:keep].first()
+    if oldest_kept is not None:
+        ProfileReport.objects.filter(pk__lt=oldest_kept).delete()
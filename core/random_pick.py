@@ -0,0 +1,62 @@
+"""Constant-cost random profile selection.
+
+Instead of loading every candidate, a pick draws a random id between the
+gender's cached min/max ids and seeks to the first eligible user at or
+after it on the ``(gender, id)`` index, wrapping around once. Excluded ids
+(the viewer, blocked users, recently shown profiles) are skipped inside
+the same query.
+
+Settings: ``RANDOM_BOUNDS_TTL`` (seconds to cache id bounds, default 300)
+and ``RANDOM_RECENT_WINDOW`` (profiles not repeated per session, default 5).
+"""
+import random
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Max, Min
+
+BOUNDS_KEY = 'random:bounds:{}'
+RECENT_SESSION_KEY = 'random_recent'
+
+
+def id_bounds(gender):
+    """Return ``(min id, max id)`` for ``gender`` or ``None`` if there are no users."""
+    key = BOUNDS_KEY.format(gender)
+    bounds = cache.get(key)
+    if bounds is None:
+        agg = get_user_model().objects.filter(gender=gender).aggregate(lo=Min('pk'), hi=Max('pk'))
+        bounds = (agg['lo'], agg['hi']) if agg['lo'] is not None else ()
+        cache.set(key, bounds, getattr(settings, 'RANDOM_BOUNDS_TTL', 300))
+    return bounds or None
+
+
+def forget_bounds(gender):
+    """Drop cached bounds so a newly registered user can be drawn right away."""
+    cache.delete(BOUNDS_KEY.format(gender))
+
+
+def pick(gender, exclude_ids=()):
+    """Return a random user of ``gender`` not in ``exclude_ids``, or ``None``."""
+    bounds = id_bounds(gender)
+    if bounds is None:
+        return None
+    start = random.randint(*bounds)
+    qs = get_user_model().objects.filter(gender=gender).exclude(pk__in=exclude_ids).only(
+        'id', 'username', 'age', 'gender'
+    ).order_by('pk')
+    return qs.filter(pk__gte=start).first() or qs.filter(pk__lt=start).first()
+
+
+def pick_for(request, gender, exclude_ids=()):
+    """Pick for the current session, avoiding the last few profiles it was shown."""
+    window = getattr(settings, 'RANDOM_RECENT_WINDOW', 5)
+    recent = request.session.get(RECENT_SESSION_KEY, [])
+    exclude_ids = set(exclude_ids)
+    profile = pick(gender, exclude_ids | set(recent))
+    if profile is None and recent:
+        # Fewer candidates than the window: allow repeats rather than show nothing
+        profile = pick(gender, exclude_ids)
+    if profile is not None:
+        request.session[RECENT_SESSION_KEY] = (recent + [profile.pk])[-window:]
+    return profile
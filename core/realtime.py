@@ -0,0 +1,208 @@
+"""Server-push channel for conversation events.
+
+Views publish small JSON events per conversation with ``publish``; the
+``conversation_events`` view streams them to browsers as Server-Sent Events.
+The stream is an async view and only runs under the ASGI entry point
+(``friendproject.asgi``); under WSGI clients fall back to the HTTP endpoints.
+
+The broker is pluggable via ``REALTIME_BROKER`` (dotted path to a class).
+The default ``InProcessBroker`` fans out inside one process, which covers a
+single ASGI worker and the test suite; ``RedisBroker`` fans out across
+processes and nodes.
+
+Events on a conversation channel:
+
+- ``typing``: ``{typing_users, ttl}``
+- ``message`` / ``message_edited`` / ``message_deleted``: ``{message}`` (``Message.to_dict``)
+- ``read``: ``{user_id, last_read_id}`` when a participant's read cursor moves
+- ``presence``: ``{participants: [{id, status}]}``, sent by the stream itself
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Per-subscriber backlog; a client that falls this far behind starts losing events
+QUEUE_SIZE = 100
+# Seconds between presence frames on an idle stream (also the keepalive)
+PRESENCE_INTERVAL = 15
+
+
+def conversation_channel(conversation_id):
+    return f'conversation:{conversation_id}'
+
+
+class Subscription:
+    """Receiving end of a channel, bound to the event loop that created it."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def offer(self, message):
+        """Queue ``message``; must run on ``self.loop``."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning('Dropping realtime event for slow subscriber on %s', self.channel)
+
+    async def get(self, timeout=None):
+        """Wait for the next ``(event, data)`` pair; raises ``TimeoutError``."""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class BaseBroker:
+    """Interface for realtime brokers.
+
+    ``publish`` may be called from any thread (sync views run in a worker
+    thread under ASGI); async views call ``apublish``, which by default runs
+    ``publish`` in a worker thread. ``subscribe`` is an async context manager
+    yielding a ``Subscription``.
+    """
+
+    def publish(self, channel, event, data):
+        raise NotImplementedError
+
+    async def apublish(self, channel, event, data):
+        await sync_to_async(self.publish, thread_sensitive=False)(channel, event, data)
+
+    def subscribe(self, channel):
+        raise NotImplementedError
+
+
+class InProcessBroker(BaseBroker):
+    """Fan out to subscribers living in this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def publish(self, channel, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for sub in subscribers:
+            try:
+                sub.loop.call_soon_threadsafe(sub.offer, (event, data))
+            except RuntimeError:
+                # The subscriber's loop has shut down; it will unsubscribe itself
+                pass
+
+    async def apublish(self, channel, event, data):
+        # publish only schedules callbacks, so it is safe on the event loop
+        self.publish(channel, event, data)
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        sub = Subscription(channel)
+        with self._lock:
+            self._subscribers[channel].add(sub)
+        try:
+            yield sub
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(sub)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+
+class RedisBroker(BaseBroker):
+    """Fan out through Redis pub/sub so every node sees every event.
+
+    Needs the optional ``redis`` package; the server is taken from
+    ``REALTIME_REDIS_URL`` (default ``redis://localhost:6379/0``).
+    """
+
+    def __init__(self):
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError as exc:
+            raise ImproperlyConfigured('RedisBroker requires the "redis" package.') from exc
+        self.url = getattr(settings, 'REALTIME_REDIS_URL', 'redis://localhost:6379/0')
+        self._redis = redis
+        self._client = redis.Redis.from_url(self.url)
+
+    def publish(self, channel, event, data):
+        self._client.publish(channel, json.dumps([event, data]))
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        client = self._redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(channel)
+        sub = Subscription(channel)
+
+        async def pump():
+            async for item in pubsub.listen():
+                if item['type'] == 'message':
+                    event, data = json.loads(item['data'])
+                    sub.offer((event, data))
+
+        task = asyncio.create_task(pump())
+        try:
+            yield sub
+        finally:
+            task.cancel()
+            await pubsub.unsubscribe(channel)
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Return the process-wide broker configured by ``REALTIME_BROKER``."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                path = getattr(settings, 'REALTIME_BROKER', 'core.realtime.InProcessBroker')
+                _broker = import_string(path)()
+    return _broker
+
+
+def publish(conversation_id, event, **data):
+    """Publish ``event`` with a JSON-serializable payload to a conversation."""
+    try:
+        get_broker().publish(conversation_channel(conversation_id), event, data)
+    except Exception:
+        # Push is best effort; clients re-sync through the HTTP endpoints
+        logger.exception('Failed to publish %s event for conversation %s', event, conversation_id)
+
+
+async def apublish(conversation_id, event, **data):
+    """Async version of ``publish`` for async views."""
+    try:
+        await get_broker().apublish(conversation_channel(conversation_id), event, data)
+    except Exception:
+        logger.exception('Failed to publish %s event for conversation %s', event, conversation_id)
+
+
+def publish_message(message, event='message'):
+    """Publish ``message`` to its conversation once the surrounding transaction commits."""
+    conversation_id = message.conversation_id
+    payload = message.to_dict()
+    transaction.on_commit(lambda: publish(conversation_id, event, message=payload))
+
+
+async def apublish_message(message, event='message'):
+    """Publish ``message`` from an async view, where every save has already committed."""
+    await apublish(message.conversation_id, event, message=message.to_dict())
+
+
+def format_sse(event, data):
+    """Encode one Server-Sent Events frame."""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
@@ -0,0 +1,91 @@
+"""Resized renditions of ``User.photo``.
+
+Uploads are kept as the original, and small re-encoded variants are
+generated off the request thread for the places that actually show them:
+
+- ``avatar``: 96x96 square crop for the 24-80 px chat, list and nav avatars
+- ``profile``: fit within 480x480 for the profile page
+
+Rendition files are named after a hash of the source bytes and the variant
+spec (``user_photos/r/<hash>-<variant>.jpg``), so a given name never changes
+content and can be served with far-future cache headers. Their storage
+names are recorded in ``User.photo_renditions``; until a variant exists
+``url_for`` falls back to the original photo. ``generate`` runs on the
+background workers as part of processing an upload (see ``core.uploads``).
+"""
+import hashlib
+import io
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from . import fragments
+
+# name: (width, height, crop to fill)
+VARIANTS = {
+    'avatar': (96, 96, True),
+    'profile': (480, 480, False),
+}
+JPEG_QUALITY = 82
+NAME_TEMPLATE = 'user_photos/r/{hash}-{variant}.jpg'
+
+
+def url_for(user, variant):
+    """URL of ``user``'s ``variant`` rendition, the original photo until it exists, or ''."""
+    if not user.photo:
+        return ''
+    name = (user.photo_renditions or {}).get(variant)
+    return default_storage.url(name) if name else user.photo.url
+
+
+def render(source, variant):
+    """Return JPEG bytes of ``variant`` for the image bytes in ``source``."""
+    from PIL import Image, ImageOps
+
+    width, height, crop = VARIANTS[variant]
+    with Image.open(io.BytesIO(source)) as image:
+        image = ImageOps.exif_transpose(image)
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def build(source):
+    """Store every variant of the image bytes in ``source``; returns ``{variant: name}``."""
+    source_hash = hashlib.sha256(source)
+
+    names = {}
+    for variant, spec in VARIANTS.items():
+        digest = source_hash.copy()
+        digest.update(repr((spec, JPEG_QUALITY)).encode())
+        name = NAME_TEMPLATE.format(hash=digest.hexdigest()[:20], variant=variant)
+        if not default_storage.exists(name):
+            saved = default_storage.save(name, ContentFile(render(source, variant)))
+            if saved != name:
+                # Lost a race with an identical upload; keep the canonical name
+                default_storage.delete(saved)
+        names[variant] = name
+    return names
+
+
+def generate(user_id):
+    """Build every variant of ``user_id``'s current photo and record their names."""
+    from .models import User
+
+    user = User.objects.filter(pk=user_id).only('id', 'photo').first()
+    if user is None or not user.photo:
+        return {}
+    with user.photo.open('rb') as f:
+        names = build(f.read())
+
+    # Only record if the photo was not replaced meanwhile
+    if User.objects.filter(pk=user_id, photo=user.photo.name).update(photo_renditions=names):
+        fragments.profile_changed(user_id)
+    return names
+
@@ -0,0 +1,124 @@
+"""Profile search over username and bio.
+
+Every user carries a normalized ``search_text`` column (lower-cased,
+accent-stripped words of username and bio, maintained in ``User.save``).
+Where the database has a full-text index on it, that index does the
+matching and ranking:
+
+- MySQL: ``FULLTEXT`` index, ``MATCH ... AGAINST`` in boolean mode
+- PostgreSQL: GIN index on ``to_tsvector('simple', search_text)``
+
+Other backends (SQLite in tests) fall back to plain SQL ``LIKE`` matching
+with a username-first ranking. Results are paged with LIMIT/OFFSET and no
+``COUNT(*)``; ``SEARCH_PAGE_SIZE`` (default 20) sets the page size.
+"""
+import re
+import unicodedata
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import BooleanField, Case, FloatField, IntegerField, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+# InnoDB ignores shorter tokens (innodb_ft_min_token_size)
+MYSQL_MIN_TOKEN = 3
+
+# Columns a result row needs
+LIST_FIELDS = ('id', 'username', 'age', 'gender', 'photo', 'photo_renditions', 'profile_updated_at', 'last_activity')
+
+
+def normalize(text):
+    """Lower-case, strip accents and keep only word characters, space separated."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+def search_text_for(user):
+    return normalize(f"{user.username} {user.bio}")
+
+
+def page_size():
+    return getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+
+
+def _match(qs, terms):
+    """Filter ``qs`` to users matching every term and annotate a ``rank``."""
+    vendor = connection.vendor
+    if vendor == 'mysql' and all(len(t) >= MYSQL_MIN_TOKEN for t in terms):
+        against = ' '.join(f'+{t}*' for t in terms)
+        rank = RawSQL('MATCH (search_text) AGAINST (%s IN BOOLEAN MODE)', [against], output_field=FloatField())
+        return qs.annotate(rank=rank).filter(rank__gt=0)
+    if vendor == 'postgresql':
+        tsquery = ' & '.join(f'{t}:*' for t in terms)
+        matches = RawSQL(
+            "to_tsvector('simple', search_text) @@ to_tsquery('simple', %s)",
+            [tsquery], output_field=BooleanField(),
+        )
+        rank = RawSQL(
+            "ts_rank(to_tsvector('simple', search_text), to_tsquery('simple', %s))",
+            [tsquery], output_field=FloatField(),
+        )
+        return qs.annotate(matches=matches, rank=rank).filter(matches=True)
+
+    for term in terms:
+        qs = qs.filter(search_text__contains=term)
+    first = terms[0]
+    rank = Case(
+        When(username__iexact=first, then=Value(3)),
+        When(username__istartswith=first, then=Value(2)),
+        When(username__icontains=first, then=Value(1)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+    return qs.annotate(rank=rank)
+
+
+def apply_filters(qs, age_min=None, age_max=None, online=False):
+    """Narrow ``qs`` by age range and, if ``online``, recent activity."""
+    if age_min is not None:
+        qs = qs.filter(age__gte=age_min)
+    if age_max is not None:
+        qs = qs.filter(age__lte=age_max)
+    if online:
+        from .presence import thresholds
+        qs = qs.filter(last_activity__gte=timezone.now() - timedelta(seconds=thresholds()[0]))
+    return qs
+
+
+def search(qs, q='', age_min=None, age_max=None, online=False, page=1):
+    """Return ``(users, has_next)`` for one page of ranked results.
+
+    Ranked pages use LIMIT/OFFSET; unranked listings (no ``q``) should go
+    through ``core.listing`` instead, which seeks on the id.
+    """
+    qs = apply_filters(qs, age_min, age_max, online)
+    terms = normalize(q).split()
+    if terms:
+        qs = _match(qs, terms).order_by('-rank', 'pk')
+    else:
+        qs = qs.order_by('pk')
+
+    size = page_size()
+    offset = (max(page, 1) - 1) * size
+    users = list(qs.only(*LIST_FIELDS)[offset:offset + size + 1])
+    return users[:size], len(users) > size
+
+
+def filters_from(params):
+    """Parse search filters from a QueryDict, ignoring malformed values."""
+    def as_int(name):
+        try:
+            return int(params[name])
+        except (KeyError, ValueError):
+            return None
+
+    return {
+        'q': params.get('q', '').strip(),
+        'age_min': as_int('age_min'),
+        'age_max': as_int('age_max'),
+        'online': params.get('online') == '1',
+        'page': as_int('page') or 1,
+    }
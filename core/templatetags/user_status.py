@@ -1,20 +1,25 @@
 from django import template
-from django.utils import timezone
+
+from core import presence
 
 register = template.Library()
 
 @register.filter
 def online_status(user):
     """Return the user's online status as a Bootstrap class"""
-    if not user.last_activity:
-        return 'text-danger'  # offline
-        
-    now = timezone.now()
-    delta = now - user.last_activity
-    
-    if delta.total_seconds() < 300:  # 5 minutes
-        return 'text-success'  # online
-    elif delta.total_seconds() < 900:  # 15 minutes
-        return 'text-warning'  # away
-    else:
-        return 'text-danger'  # offline
\ No newline at end of file
+    return presence.STATUS_CLASSES[presence.status_of(user)]
+
+
+@register.simple_tag(takes_context=True)
+def status_class(context, user):
+    """Return the Bootstrap status class for ``user``, computed once per render.
+
+    Views may pass a precomputed ``presence_statuses`` dict ({user id: status});
+    anything missing is resolved once and memoized for the rest of the render.
+    """
+    memo = context.render_context.setdefault('presence_statuses', {})
+    if not memo:
+        memo.update(context.get('presence_statuses') or {})
+    if user.pk not in memo:
+        memo[user.pk] = presence.status_of(user)
+    return presence.STATUS_CLASSES[memo[user.pk]]
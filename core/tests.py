@@ -1,3 +1,1784 @@
-from django.test import TestCase
+"""Query and row budgets for the views in core/urls.py, then behaviour tests
+for the services behind them.
 
-# Create your tests here.
+Every view is requested by a logged-in user against datasets of 1, 100 and
+10,000 rows: as many opposite-gender users, conversations in the viewer's
+inbox and messages in the open conversation. A view must stay within the
+same number of SQL queries and fetched rows at every size, so an N+1 query
+or an unbounded fetch fails here with the offending SQL listed. Caches are
+cleared before each request, so budgets cover the cold-cache path. The
+native async endpoints (``core.async_views``) are held to the same budgets
+through the async middleware chain.
+
+Run with ``python manage.py test core``.
+"""
+import importlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from PIL import Image
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections, transaction
+from django.db.utils import ConnectionHandler
+from django.db.backends.utils import CursorDebugWrapper
+from django.db.models.query import QuerySet
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import async_views, blocking, fragments, history, inbox, listing, metrics, presence, random_pick, realtime, renditions, search, typing_state, unread, uploads, views
+from .db import pool
+from .management.commands import bench_message_indexes
+from .models import Conversation, ConversationReadState, Message, PhotoUpload, ProfileReport, User
+from .templatetags import user_status
+from .urls import urlconf_with
+
+# URL name (or "name:variant") -> (max queries, max rows fetched). Rows are
+# bounded by the page sizes (messages 50, inbox 20, listings 20). None exempts
+# a view whose cost is meant to grow with the data.
+BUDGETS = {
+    'signup': (0, 0),
+    'login': (0, 0),
+    'logout': (4, 3),
+    'account_delete': (3, 3),
+    # Deleting an account cascades over everything it ever sent
+    'account_delete:post': None,
+    'home': (6, 10),
+    'search': (6, 25),
+    'search:q': (6, 25),
+    'random': (11, 6),  # one more when the seek wraps around
+    'users_by_gender': (7, 26),
+    'profile_detail': (5, 4),
+    'profile_detail:own': (6, 4),
+    'profile_edit': (3, 3),
+    'photo_upload_status': (3, 2),
+    'block_user': (5, 3),
+    'metrics': (1, 1),
+    'conversations_list': (4, 43),
+    'inbox': (4, 43),
+    'start_conversation': (4, 4),
+    # Marking read upserts the viewer's read state before moving the cursor
+    'conversation_detail': (10, 59),
+    'conversation_detail:before': (6, 56),
+    'conversation_detail:after': (9, 58),
+    'conversation_detail:send': (9, 7),
+    'edit_message': (4, 3),
+    # Plus recounting the recipients' unread counters and their ids
+    'delete_message': (6, 5),
+    'update_typing_status': (3, 4),
+    'get_typing_users': (3, 4),
+    'conversation_statuses': (6, 8),
+    'read_receipts': (4, 6),
+    'conversation_events': (2, 2),
+}
+
+
+class RowCountingCursor(CursorDebugWrapper):
+    """Debug cursor that also counts the rows fetched for each statement."""
+
+    def __init__(self, cursor, db, statements):
+        super().__init__(cursor, db)
+        self.statements = statements
+        self.current = None
+
+    def execute(self, sql, params=None):
+        result = super().execute(sql, params)
+        self._record()
+        return result
+
+    def executemany(self, sql, param_list):
+        result = super().executemany(sql, param_list)
+        self._record()
+        return result
+
+    def _record(self):
+        self.current = {'sql': self.db.queries_log[-1]['sql'], 'rows': 0}
+        self.statements.append(self.current)
+
+    def _count(self, rows):
+        if self.current is not None:
+            self.current['rows'] += rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        self._count(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.cursor.fetchmany() if size is None else self.cursor.fetchmany(size)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self._count(1)
+            yield row
+
+
+class CaptureRows(CaptureQueriesContext):
+    """``CaptureQueriesContext`` that records ``{'sql', 'rows'}`` per statement."""
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.statements = []
+
+    def __enter__(self):
+        self.connection.make_debug_cursor = lambda cursor: RowCountingCursor(cursor, self.connection, self.statements)
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        del self.connection.make_debug_cursor
+        return super().__exit__(*exc_info)
+
+    @property
+    def rows(self):
+        return sum(statement['rows'] for statement in self.statements)
+
+
+class BudgetFixture:
+    """Dataset of ``size`` rows and the budget assertion."""
+    size = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user('viewer', 'viewer@example.com', 'pw', gender='M', age=30)
+        User.objects.bulk_create([
+            User(username=f'woman_{i}', email=f'woman_{i}@example.com', gender='F', age=18 + i % 40,
+                 bio='guitar coffee', search_text=f'woman_{i} guitar coffee')
+            for i in range(cls.size)
+        ])
+        women = list(User.objects.filter(gender='F').order_by('pk'))
+        cls.other = women[0]
+        cls.blocked = User.objects.create_user('blocked', 'blocked@example.com', 'pw', gender='F', age=30)
+        cls.viewer.blocked_users.add(cls.blocked)
+
+        # One conversation per woman in the viewer's inbox, each with a message
+        Conversation.objects.bulk_create([
+            Conversation(pair_key=Conversation.pair_key_for(cls.viewer.pk, woman.pk)) for woman in women
+        ])
+        conversations = dict(Conversation.objects.values_list('pair_key', 'pk'))
+        through = Conversation.participants.through
+        links, states, messages = [], [], []
+        for woman in women:
+            conv_id = conversations[Conversation.pair_key_for(cls.viewer.pk, woman.pk)]
+            for user in (cls.viewer, woman):
+                links.append(through(conversation_id=conv_id, user_id=user.pk))
+                states.append(ConversationReadState(conversation_id=conv_id, user_id=user.pk))
+            messages.append(Message(conversation_id=conv_id, sender=woman, content='hello'))
+        through.objects.bulk_create(links)
+        ConversationReadState.objects.bulk_create(states)
+
+        # The open conversation holds ``size`` messages
+        cls.conversation = Conversation.objects.get(pair_key=Conversation.pair_key_for(cls.viewer.pk, cls.other.pk))
+        senders = (cls.viewer, cls.other)
+        messages += [
+            Message(conversation=cls.conversation, sender=senders[i % 2], content=f'message {i}')
+            for i in range(cls.size - 1)
+        ]
+        Message.objects.bulk_create(messages, batch_size=2_000)
+        for conv in Conversation.objects.all():
+            newest = Message.objects.filter(conversation=conv).order_by('-pk').first()
+            Conversation.objects.filter(pk=conv.pk).update(last_message=newest, last_activity_at=newest.timestamp)
+        unread.recount_states(ConversationReadState.objects.all())
+
+        ids = list(Message.objects.filter(conversation=cls.conversation).order_by('pk').values_list('pk', flat=True))
+        cls.first_message_id, cls.last_message_id = ids[0], ids[-1]
+        cls.own_message_id = Message.objects.filter(conversation=cls.conversation, sender=cls.viewer).values_list(
+            'pk', flat=True
+        ).first() or Message.objects.create(conversation=cls.conversation, sender=cls.viewer, content='mine').pk
+
+    def setUp(self):
+        self.client.force_login(self.viewer)
+        # Async tests run on another thread, but their queries come back to this one
+        self.connection = connections[DEFAULT_DB_ALIAS]
+
+    def tearDown(self):
+        presence._buffer.drain()
+
+    def assertWithinBudget(self, name, method, url, data=None, status=200, **extra):
+        """Request ``url`` and fail, listing the SQL, if ``BUDGETS[name]`` is exceeded."""
+        cache.clear()
+        with CaptureRows(self.connection) as captured:
+            response = getattr(self.client, method)(url, data, **extra)
+        self.checkBudget(name, response, status, captured)
+        return response
+
+    async def aassertWithinBudget(self, name, method, url, data=None, status=200, **extra):
+        """``assertWithinBudget`` through ``self.async_client``."""
+        cache.clear()
+        captured = CaptureRows(self.connection)
+        # Entering connects, which is not allowed on the event loop
+        await sync_to_async(captured.__enter__)()
+        try:
+            response = await getattr(self.async_client, method)(url, data, **extra)
+        finally:
+            captured.__exit__(None, None, None)
+        self.checkBudget(name, response, status, captured)
+        return response
+
+    def checkBudget(self, name, response, status, captured):
+        self.assertEqual(response.status_code, status, f"{name} returned {response.status_code}")
+        if BUDGETS[name] is None:
+            return
+        max_queries, max_rows = BUDGETS[name]
+        if len(captured.statements) > max_queries or captured.rows > max_rows:
+            report = '\n'.join(
+                f"  {i}. [{statement['rows']} rows] {statement['sql']}"
+                for i, statement in enumerate(captured.statements, 1)
+            )
+            self.fail(
+                f"{name} at {self.size} rows: {len(captured.statements)} queries (budget {max_queries}), "
+                f"{captured.rows} rows fetched (budget {max_rows})\n{report}"
+            )
+
+
+class ViewBudgetTests(BudgetFixture):
+    """Mixed into one ``TestCase`` per dataset size."""
+
+    def post_json(self, name, url, payload, status=200):
+        return self.assertWithinBudget(
+            name, 'post', url, json.dumps(payload), status=status,
+            content_type='application/json', HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+
+    # Accounts
+
+    def test_signup(self):
+        self.client.logout()
+        self.assertWithinBudget('signup', 'get', reverse('signup'))
+
+    def test_login(self):
+        self.client.logout()
+        self.assertWithinBudget('login', 'get', reverse('login'))
+
+    def test_logout(self):
+        self.assertWithinBudget('logout', 'post', reverse('logout'), status=302)
+
+    def test_account_delete(self):
+        self.assertWithinBudget('account_delete', 'get', reverse('account_delete'))
+
+    def test_account_delete_confirmed(self):
+        self.assertWithinBudget('account_delete:post', 'post', reverse('account_delete'), status=302)
+        self.assertFalse(User.objects.filter(pk=self.viewer.pk).exists())
+
+    # Browsing
+
+    def test_home(self):
+        self.assertWithinBudget('home', 'get', reverse('home'))
+
+    def test_search(self):
+        self.assertWithinBudget('search', 'get', reverse('search'))
+
+    def test_search_query(self):
+        self.assertWithinBudget('search:q', 'get', reverse('search'), {'q': 'guitar'})
+
+    def test_random(self):
+        self.assertWithinBudget('random', 'get', reverse('random'))
+
+    def test_users_by_gender(self):
+        self.assertWithinBudget('users_by_gender', 'get', reverse('users_by_gender', args=['F']))
+
+    def test_profile_detail(self):
+        self.assertWithinBudget('profile_detail', 'get', reverse('profile_detail', args=[self.other.pk]))
+
+    def test_own_profile_detail(self):
+        self.assertWithinBudget('profile_detail:own', 'get', reverse('profile_detail', args=[self.viewer.pk]))
+
+    def test_profile_edit(self):
+        self.assertWithinBudget('profile_edit', 'get', reverse('profile_edit'))
+
+    def test_photo_upload_status(self):
+        self.assertWithinBudget('photo_upload_status', 'get', reverse('photo_upload_status'))
+
+    def test_block_user(self):
+        self.assertWithinBudget('block_user', 'post', reverse('block_user', args=[self.other.pk]))
+
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_metrics(self):
+        self.assertWithinBudget('metrics', 'get', reverse('metrics'), headers={'Authorization': 'Bearer scrape'})
+
+    # Conversations
+
+    def test_conversations_list(self):
+        self.assertWithinBudget('conversations_list', 'get', reverse('conversations_list'))
+
+    def test_inbox(self):
+        self.assertWithinBudget('inbox', 'get', reverse('inbox'))
+
+    def test_start_conversation(self):
+        self.assertWithinBudget('start_conversation', 'get', reverse('start_conversation', args=[self.other.pk]), status=302)
+
+    def test_conversation_detail(self):
+        self.assertWithinBudget('conversation_detail', 'get', reverse('conversation_detail', args=[self.conversation.pk]))
+
+    def test_conversation_history_page(self):
+        url = reverse('conversation_detail', args=[self.conversation.pk])
+        self.assertWithinBudget('conversation_detail:before', 'get', url, {'before': self.last_message_id})
+
+    def test_conversation_catch_up_page(self):
+        url = reverse('conversation_detail', args=[self.conversation.pk])
+        self.assertWithinBudget('conversation_detail:after', 'get', url, {'after': self.first_message_id})
+
+    def test_send_message(self):
+        url = reverse('conversation_detail', args=[self.conversation.pk])
+        self.post_json('conversation_detail:send', url, {'content': 'hi'})
+
+    def test_edit_message(self):
+        self.post_json('edit_message', reverse('edit_message', args=[self.own_message_id]), {'content': 'edited'})
+
+    def test_delete_message(self):
+        self.assertWithinBudget('delete_message', 'post', reverse('delete_message', args=[self.own_message_id]))
+
+    def test_update_typing_status(self):
+        url = reverse('update_typing_status', args=[self.conversation.pk])
+        self.post_json('update_typing_status', url, {'is_typing': True})
+
+    def test_get_typing_users(self):
+        self.assertWithinBudget('get_typing_users', 'get', reverse('get_typing_users', args=[self.conversation.pk]))
+
+    def test_conversation_statuses(self):
+        url = reverse('conversation_statuses', args=[self.conversation.pk])
+        self.assertWithinBudget('conversation_statuses', 'get', url)
+
+    def test_read_receipts(self):
+        self.assertWithinBudget('read_receipts', 'get', reverse('read_receipts', args=[self.conversation.pk]))
+
+    def test_conversation_events(self):
+        # The event stream needs ASGI; under the test client it answers 501 straight away
+        url = reverse('conversation_events', args=[self.conversation.pk])
+        self.assertWithinBudget('conversation_events', 'get', url, status=501)
+
+
+# Heartbeats stay buffered: a background flush would race the test transaction
+@override_settings(PRESENCE_FLUSH_INTERVAL=3600)
+class ViewBudgetsOneRowTests(ViewBudgetTests, TestCase):
+    size = 1
+
+
+@override_settings(PRESENCE_FLUSH_INTERVAL=3600)
+class ViewBudgetsHundredRowsTests(ViewBudgetTests, TestCase):
+    size = 100
+
+
+@override_settings(PRESENCE_FLUSH_INTERVAL=3600)
+class ViewBudgetsTenThousandRowsTests(ViewBudgetTests, TestCase):
+    size = 10_000
+
+
+@override_settings(PRESENCE_FLUSH_INTERVAL=3600, ROOT_URLCONF=urlconf_with(async_views))
+class AsyncViewBudgetsTests(BudgetFixture, TestCase):
+    size = 100
+
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.viewer)
+
+    async def test_block_user(self):
+        await self.aassertWithinBudget('block_user', 'post', reverse('block_user', args=[self.other.pk]))
+
+    async def test_edit_message(self):
+        url = reverse('edit_message', args=[self.own_message_id])
+        await self.aassertWithinBudget('edit_message', 'post', url, {'content': 'edited'}, content_type='application/json')
+
+    async def test_delete_message(self):
+        await self.aassertWithinBudget('delete_message', 'post', reverse('delete_message', args=[self.own_message_id]))
+
+    async def test_update_typing_status(self):
+        url = reverse('update_typing_status', args=[self.conversation.pk])
+        await self.aassertWithinBudget('update_typing_status', 'post', url, {'is_typing': True}, content_type='application/json')
+
+    async def test_get_typing_users(self):
+        url = reverse('get_typing_users', args=[self.conversation.pk])
+        await self.aassertWithinBudget('get_typing_users', 'get', url)
+
+    async def test_conversation_statuses(self):
+        url = reverse('conversation_statuses', args=[self.conversation.pk])
+        await self.aassertWithinBudget('conversation_statuses', 'get', url)
+
+
+class RandomPickTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+
+    def test_single_candidate_repeats(self):
+        only = User.objects.create_user('only', 'only@example.com', 'pw', gender='F', age=30)
+        picks = [random_pick.pick_for(self.request, 'F') for _ in range(4)]
+        self.assertEqual(picks, [only] * 4)
+
+    def test_avoids_recent_profiles(self):
+        users = [User.objects.create_user(f'w{i}', f'w{i}@example.com', 'pw', gender='F', age=30) for i in range(3)]
+        picks = [random_pick.pick_for(self.request, 'F').pk for _ in range(3)]
+        self.assertCountEqual(picks, [u.pk for u in users])
+
+
+# Heartbeats stay buffered: a background flush would race the test transaction
+@override_settings(PRESENCE_FLUSH_INTERVAL=3600)
+class RequestTestCase(TestCase):
+    """Base for behaviour tests that go through the test client."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(presence._buffer.drain)
+
+
+class MetricsAccessTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', 'user@example.com', 'pw', gender='M', age=30)
+        cls.staff = User.objects.create_user('staff', 'staff@example.com', 'pw', gender='F', age=30, is_staff=True)
+
+    def test_localhost_is_not_trusted(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+    def test_staff(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_bearer_token(self):
+        self.assertEqual(self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer scrape'}).status_code, 200)
+        self.assertEqual(self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+
+
+class ProfilingTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', 'user@example.com', 'pw', gender='M', age=30)
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw', gender='F', age=30)
+
+    def test_staff_header_stores_report(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('search'), {'q': 'secret-term'}, headers={'X-Profile': '1'})
+        report = ProfileReport.objects.get(pk=response['X-Profile-Report'])
+        self.assertEqual((report.mode, report.view_name, report.user), (ProfileReport.SAMPLE, 'search', self.admin))
+        self.assertGreater(report.query_count, 0)
+        # Statements are kept with placeholders, never their parameter values
+        self.assertNotIn('secret-term', report.sql)
+        self.assertNotIn(self.admin.password, report.sql)
+
+    def test_query_flag_selects_cprofile(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('home'), {'_profile': 'cprofile'})
+        report = ProfileReport.objects.get(pk=response['X-Profile-Report'])
+        self.assertEqual(report.mode, ProfileReport.CPROFILE)
+        self.assertIn('function calls', report.stats)
+
+    def test_shares_the_metrics_query_hook(self):
+        connection = connections[DEFAULT_DB_ALIAS]
+        connection.ensure_connection()
+        core_hooks = [hook for hook in connection.execute_wrappers if hook.__module__.startswith('core.')]
+        self.assertEqual(core_hooks, [metrics._query_hook])
+
+    def test_only_staff_can_profile(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('home'), headers={'X-Profile': '1'})
+        self.assertNotIn('X-Profile-Report', response)
+        self.assertFalse(ProfileReport.objects.exists())
+
+    def test_admin_downloads(self):
+        self.client.force_login(self.admin)
+        self.client.get(reverse('home'), headers={'X-Profile': '1'})
+        report = ProfileReport.objects.get()
+        for field, suffix in (('collapsed', 'folded'), ('sql', 'sql.txt'), ('stats', 'stats.txt')):
+            response = self.client.get(reverse('admin:core_profilereport_download', args=[report.pk, field]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Disposition'], f'attachment; filename="profile-{report.pk}.{suffix}"')
+            self.assertEqual(response.content.decode(), getattr(report, field))
+        response = self.client.get(reverse('admin:core_profilereport_download', args=[report.pk, 'path']))
+        self.assertEqual(response.status_code, 404)
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('admin:core_profilereport_download', args=[report.pk, 'sql']))
+        self.assertEqual(response.status_code, 302)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.usable = True
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        self.opened = []
+        self.clock = 1000.0
+        patcher = mock.patch('core.db.pool.time.monotonic', lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self):
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+    def make_pool(self, size=2, recycle=1800, ping_after=30):
+        return pool.ConnectionPool(self.connect, lambda conn: conn.usable, size, recycle, ping_after)
+
+    def test_returned_connection_is_reused_newest_first(self):
+        idle = self.make_pool()
+        first, second = idle.acquire(), idle.acquire()
+        idle.release(first)
+        idle.release(second)
+        self.assertIs(idle.acquire(), second)
+        self.assertIs(idle.acquire(), first)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_burst_beyond_size_is_closed_on_return(self):
+        idle = self.make_pool(size=1)
+        first, extra = idle.acquire(), idle.acquire()
+        idle.release(first)
+        idle.release(extra)
+        self.assertEqual((first.closed, extra.closed), (False, True))
+
+    def test_old_idleare_recycled(self):
+        idle = self.make_pool(recycle=60)
+        conn = idle.acquire()
+        idle.release(conn)
+        self.clock += 61
+        self.assertIsNot(idle.acquire(), conn)
+        self.assertTrue(conn.closed)
+
+    def test_idle_idleare_pinged(self):
+        idle = self.make_pool(ping_after=30)
+        conn = idle.acquire()
+        idle.release(conn)
+        conn.usable = False
+        # Recently returned: handed out without a ping
+        self.assertIs(idle.acquire(), conn)
+        idle.release(conn)
+        self.clock += 31
+        self.assertIsNot(idle.acquire(), conn)
+        self.assertTrue(conn.closed)
+
+    def test_close_all(self):
+        idle = self.make_pool()
+        conn = idle.acquire()
+        idle.release(conn)
+        idle.close_all()
+        self.assertTrue(conn.closed)
+
+
+class PooledBackendTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        handler = ConnectionHandler({DEFAULT_DB_ALIAS: {
+            'ENGINE': 'core.db.pooled_sqlite', 'NAME': os.path.join(directory, 'pool.sqlite3'), 'POOL': {'SIZE': 2},
+        }})
+        self.db = handler[DEFAULT_DB_ALIAS]
+        self.addCleanup(pool.close_all)
+        self.addCleanup(self.db.close)
+
+    def checkout(self):
+        self.db.ensure_connection()
+        return self.db.connection
+
+    def test_checkout_and_return(self):
+        raw = self.checkout()
+        self.db.close()
+        self.assertIsNone(self.db.connection)
+        # Still open in the pool, and handed out again
+        raw.execute('SELECT 1')
+        self.assertIs(self.checkout(), raw)
+
+    def test_connection_in_a_transaction_is_dropped(self):
+        raw = self.checkout()
+        self.db.set_autocommit(False)
+        self.db.in_atomic_block = True
+        self.db.close()
+        # Closed for good rather than returned
+        with self.assertRaises(sqlite3.ProgrammingError):
+            raw.execute('SELECT 1')
+        self.db.in_atomic_block = False
+        self.db.connection = None
+
+    def test_connection_after_an_error_is_dropped(self):
+        raw = self.checkout()
+        self.db.errors_occurred = True
+        self.db.close()
+        self.assertIsNot(self.checkout(), raw)
+
+
+class ConnectionSettingsTests(TestCase):
+    """``CONN_MAX_AGE`` as each entry point configures it (a fresh process each)."""
+
+    def conn_max_age(self, module, **env):
+        code = (
+            f'import {module}; from django.conf import settings; '
+            f"print(settings.DATABASES['default']['CONN_MAX_AGE'], settings.DATABASES['default']['ENGINE'])"
+        )
+        environ = {k: v for k, v in os.environ.items() if not k.startswith(('DB_', 'DJANGO_'))}
+        environ.update(env, DJANGO_SETTINGS_MODULE='friendproject.settings')
+        result = subprocess.run(
+            [sys.executable, '-c', code], env=environ, cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        )
+        age, engine = result.stdout.split()
+        return int(age), engine
+
+    def test_wsgi_keeps_connections(self):
+        self.assertEqual(self.conn_max_age('friendproject.wsgi'), (60, 'django.db.backends.mysql'))
+
+    def test_asgi_does_not_keep_connections(self):
+        self.assertEqual(self.conn_max_age('friendproject.asgi'), (0, 'django.db.backends.mysql'))
+
+    def test_asgi_pool(self):
+        self.assertEqual(self.conn_max_age('friendproject.asgi', DB_POOL='1'), (0, 'core.db.pooled_mysql'))
+
+    def test_explicit_setting_wins(self):
+        self.assertEqual(self.conn_max_age('friendproject.asgi', DB_CONN_MAX_AGE='30')[0], 30)
+
+
+@override_settings(PRESENCE_FLUSH_INTERVAL=3600, PRESENCE_WRITE_INTERVAL=60)
+class PresenceTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', 'user@example.com', 'pw', gender='M', age=30)
+
+    def setUp(self):
+        cache.clear()
+        presence._buffer.drain()
+        self.addCleanup(presence._buffer.drain)
+
+    def test_throttle_queues_one_write_per_interval(self):
+        start = timezone.now()
+        for seconds in range(3):
+            presence.record_heartbeat_for_id(self.user.pk, start + timedelta(seconds=seconds))
+        self.assertEqual(presence._buffer.drain(), {self.user.pk: start})
+        # Reads still see the latest heartbeat
+        self.assertEqual(presence.last_seen(self.user), start + timedelta(seconds=2))
+
+    def test_flush_writes_buffered_heartbeats(self):
+        now = timezone.now()
+        presence.record_heartbeat_for_id(self.user.pk, now)
+        self.assertEqual(presence.flush(), 1)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.last_activity, self.user.is_online), (now, True))
+        self.assertEqual(presence.flush(), 0)
+
+    def test_failed_flush_keeps_heartbeats(self):
+        older = timezone.now()
+        presence.record_heartbeat_for_id(self.user.pk, older)
+        with mock.patch.object(User.objects, 'bulk_update', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                presence.flush()
+        self.assertEqual(len(presence._buffer), 1)
+        # A heartbeat queued after the failed drain wins over the restored one
+        presence._buffer.drain()
+        presence._buffer.add(self.user.pk, older + timedelta(seconds=5))
+        presence._buffer.restore({self.user.pk: older})
+        self.assertEqual(presence._buffer.drain(), {self.user.pk: older + timedelta(seconds=5)})
+
+    @override_settings(PRESENCE_FLUSH_INTERVAL=0)
+    def test_write_through(self):
+        with self.assertNumQueries(1):
+            presence.record_heartbeat_for_id(self.user.pk)
+        with self.assertNumQueries(0):
+            presence.record_heartbeat_for_id(self.user.pk)
+
+
+@override_settings(PRESENCE_ONLINE_SECONDS=300, PRESENCE_AWAY_SECONDS=900)
+class PresenceStatusTests(RequestTestCase):
+    """The model, the template filter and the endpoint agree at every threshold."""
+
+    # Seconds idle -> status
+    CASES = ((0, 'online'), (299, 'online'), (300, 'away'), (899, 'away'), (900, 'offline'), (86400, 'offline'))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user('viewer', 'viewer@example.com', 'pw', gender='M', age=30)
+        cls.other = User.objects.create_user('other', 'other@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(cls.viewer.pk, cls.other.pk))
+        cls.conversation.participants.add(cls.viewer, cls.other)
+
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        patcher = mock.patch('django.utils.timezone.now', return_value=self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.viewer)
+
+    def idle_for(self, seconds):
+        cache.clear()
+        User.objects.filter(pk=self.other.pk).update(last_activity=self.now - timedelta(seconds=seconds))
+        return User.objects.get(pk=self.other.pk)
+
+    def endpoint_status(self, user):
+        response = self.client.get(reverse('conversation_statuses', args=[self.conversation.pk]))
+        return {p['id']: p['status'] for p in response.json()['participants']}[user.pk]
+
+    def test_thresholds(self):
+        for seconds, status in self.CASES:
+            with self.subTest(idle=seconds):
+                user = self.idle_for(seconds)
+                self.assertEqual(user.get_online_status()[0], status)
+                self.assertEqual(user_status.online_status(user), presence.STATUS_CLASSES[status])
+                self.assertEqual(self.endpoint_status(user), status)
+
+    @override_settings(ROOT_URLCONF=urlconf_with(async_views))
+    def test_async_endpoint_thresholds(self):
+        for seconds, status in self.CASES:
+            with self.subTest(idle=seconds):
+                self.assertEqual(self.endpoint_status(self.idle_for(seconds)), status)
+
+    def test_fresher_heartbeat_in_store_wins(self):
+        user = self.idle_for(3600)
+        presence.record_heartbeat_for_id(user.pk, self.now - timedelta(seconds=10))
+        self.assertEqual(user.get_online_status(), ('online', None))
+        self.assertEqual(self.endpoint_status(user), 'online')
+
+    def test_never_seen_is_offline(self):
+        self.assertEqual(presence.status_from(None, self.now), ('offline', None))
+
+    def test_idle_time_is_reported_when_not_online(self):
+        self.assertEqual(self.idle_for(600).get_online_status(), ('away', timedelta(seconds=600)))
+
+
+@override_settings(TYPING_TTL=6)
+class TypingStateTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.typist = User.objects.create_user('typist', 'typist@example.com', 'pw', gender='M', age=30)
+        cls.reader = User.objects.create_user('reader', 'reader@example.com', 'pw', gender='F', age=30)
+
+    def setUp(self):
+        cache.clear()
+        self.participant_ids = [self.typist.pk, self.reader.pk]
+
+    def typing(self, exclude_user_id=None):
+        return [u['id'] for u in typing_state.typing_users(1, self.participant_ids, exclude_user_id)]
+
+    def test_start_and_stop(self):
+        typing_state.set_typing(1, self.participant_ids, self.typist, True)
+        self.assertEqual(self.typing(), [self.typist.pk])
+        self.assertEqual(self.typing(exclude_user_id=self.typist.pk), [])
+        typing_state.set_typing(1, self.participant_ids, self.typist, False)
+        self.assertEqual(self.typing(), [])
+
+    def test_expires_after_ttl(self):
+        typing_state.set_typing(1, self.participant_ids, self.typist, True)
+        with mock.patch('time.time', return_value=time.time() + 5):
+            self.assertEqual(self.typing(), [self.typist.pk])
+        with mock.patch('time.time', return_value=time.time() + 7):
+            self.assertEqual(self.typing(), [])
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        def woman(username, bio='', email=None):
+            return User.objects.create_user(username, email or f'{username}@example.com', 'pw', gender='F', age=30, bio=bio)
+
+        cls.exact = woman('anna')
+        cls.prefix = woman('annabel')
+        cls.inside = woman('joanna')
+        cls.bio = woman('zoe', bio='Friends call me Anna')
+        cls.accented = woman('chloe', bio='Café in München')
+        cls.email_only = woman('mia', email='anna@example.com')
+
+    def names(self, q, **filters):
+        users, _ = search.search(User.objects.filter(gender='F'), q, **filters)
+        return [u.username for u in users]
+
+    def test_ranks_username_exact_then_prefix_then_substring_then_bio(self):
+        self.assertEqual(self.names('anna'), ['anna', 'annabel', 'joanna', 'zoe'])
+
+    def test_every_term_must_match(self):
+        self.assertEqual(self.names('anna friends'), ['zoe'])
+        self.assertEqual(self.names('anna nobody'), [])
+
+    def test_matching_ignores_case_and_accents(self):
+        self.assertEqual(self.names('CAFE munchen'), ['chloe'])
+        self.assertEqual(self.names('Café'), ['chloe'])
+
+    def test_email_is_not_searched(self):
+        self.assertNotIn('mia', self.names('example'))
+        self.assertNotIn('mia', self.names('anna'))
+
+    def test_search_text_follows_profile_edits(self):
+        self.bio.bio = 'Hiking'
+        self.bio.save()
+        self.assertEqual(self.names('anna'), ['anna', 'annabel', 'joanna'])
+        self.assertEqual(self.names('hiking'), ['zoe'])
+
+    @override_settings(SEARCH_PAGE_SIZE=2)
+    def test_pages(self):
+        first, has_next = search.search(User.objects.filter(gender='F'), 'anna')
+        second, has_more = search.search(User.objects.filter(gender='F'), 'anna', page=2)
+        self.assertEqual([u.username for u in first + second], ['anna', 'annabel', 'joanna', 'zoe'])
+        self.assertEqual((has_next, has_more), (True, False))
+
+    def test_short_terms_fall_back_to_like_on_mysql(self):
+        # InnoDB does not index tokens under three characters, so those queries skip MATCH
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            qs = search._match(User.objects.all(), ['an'])
+            self.assertNotIn('MATCH', str(qs.query))
+            self.assertEqual(sorted(u.username for u in qs), ['anna', 'annabel', 'joanna', 'zoe'])
+
+    def test_fallback_on_other_backends(self):
+        qs = search._match(User.objects.all(), ['anna'])
+        self.assertIn('LIKE', str(qs.query))
+        self.assertEqual(qs.get(pk=self.exact.pk).rank, 3)
+
+    def test_view_pages_ranked_results(self):
+        viewer = User.objects.create_user('viewer', 'viewer@example.com', 'pw', gender='M', age=30)
+        self.client.force_login(viewer)
+        response = self.client.get(reverse('search'), {'q': 'anna'})
+        self.assertEqual([u.username for u in response.context['users']], ['anna', 'annabel', 'joanna', 'zoe'])
+
+
+class KeysetPaginationTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user('viewer', 'viewer@example.com', 'pw', gender='M', age=30)
+        # Identical in everything but the id, interleaved with the other gender
+        same = timezone.now()
+        User.objects.bulk_create([
+            User(username=f'u{i}', email=f'u{i}@example.com', gender='FM'[i % 2], age=30, last_activity=same)
+            for i in range(50)
+        ])
+        cls.women = list(User.objects.filter(gender='F').order_by('pk').values_list('pk', flat=True))
+
+    def walk(self, qs, limit):
+        """Ids of every page, forward from the start and back from the end."""
+        forward, page = [], listing.paginate(qs, limit=limit)
+        pages = [page]
+        while True:
+            forward += [u.pk for u in page]
+            if not page.has_next:
+                break
+            page = listing.paginate(qs, after=page.next_cursor, limit=limit)
+            pages.append(page)
+        backward = []
+        page = listing.paginate(qs, before=forward[-1] + 1, limit=limit)
+        while True:
+            backward = [u.pk for u in page] + backward
+            if not page.has_previous:
+                break
+            page = listing.paginate(qs, before=page.previous_cursor, limit=limit)
+        return forward, backward, pages
+
+    def test_no_gaps_or_duplicates(self):
+        qs = User.objects.filter(gender='F')
+        for limit in (1, 5, 7, 25, 26):
+            with self.subTest(limit=limit):
+                forward, backward, pages = self.walk(qs, limit)
+                self.assertEqual(forward, self.women)
+                self.assertEqual(backward, self.women)
+                self.assertTrue(all(len(page) == limit for page in pages[:-1]))
+
+    def test_last_page_of_exact_multiple_has_no_next(self):
+        # 25 women: the fifth page of 5 is full and must still be the last
+        _, _, pages = self.walk(User.objects.filter(gender='F'), 5)
+        self.assertEqual(len(pages), 5)
+        self.assertFalse(pages[-1].has_next)
+        self.assertIsNone(pages[-1].next_cursor)
+
+    def test_first_page_has_no_previous(self):
+        page = listing.paginate(User.objects.filter(gender='F'), before=self.women[5], limit=5)
+        self.assertEqual([u.pk for u in page], self.women[:5])
+        self.assertFalse(page.has_previous)
+        self.assertTrue(page.has_next)
+
+    def test_cursor_past_the_end_is_empty(self):
+        page = listing.paginate(User.objects.filter(gender='F'), after=self.women[-1], limit=5)
+        self.assertEqual((list(page), page.has_next, page.has_previous), ([], False, True))
+
+    def test_view_links_cover_every_user(self):
+        self.client.force_login(self.viewer)
+        url = reverse('users_by_gender', args=['f'])
+        seen, query = [], ''
+        while True:
+            response = self.client.get(url + query)
+            page = response.context['page_obj']
+            seen += [u.pk for u in page]
+            if not page.has_next:
+                break
+            query = listing.page_link(response.wsgi_request.GET, after=page.next_cursor)
+        self.assertEqual(seen, self.women)
+
+    def test_malformed_cursor_is_ignored(self):
+        self.assertEqual(listing.cursor_from({'after': 'x', 'before': '3'}), (None, 3))
+
+
+class BenchMessageIndexesTests(TestCase):
+
+    @override_settings(DEBUG=False)
+    def test_refuses_without_debug_or_confirmation(self):
+        for args in ([], ['--yes'], ['--database', DEFAULT_DB_ALIAS]):
+            with self.subTest(args=args), self.assertRaisesMessage(CommandError, 'scratch database'):
+                call_command('bench_message_indexes', '--seed', *args, stdout=io.StringIO())
+        self.assertFalse(Message.objects.exists())
+
+    def test_seeded_rows_are_deleted(self):
+        User.objects.create_user('bench_existing', 'existing@example.com', 'pw', gender='M', age=30)
+        command = bench_message_indexes.Command(stdout=io.StringIO())
+        command.using = DEFAULT_DB_ALIAS
+        seeded = command.seed(n_users=6, n_conversations=4, n_messages=30)
+        self.assertEqual(Message.objects.count(), 30)
+        command.unseed(*seeded)
+        self.assertEqual(list(User.objects.values_list('username', flat=True)), ['bench_existing'])
+        self.assertFalse(Conversation.objects.exists())
+        self.assertFalse(Message.objects.exists())
+
+
+class HistoryPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(a.pk, b.pk))
+        start = timezone.now()
+        # Pairs of messages share a timestamp, so pages must break ties on id
+        Message.objects.bulk_create([
+            Message(conversation=cls.conversation, sender=(a, b)[i % 2], content=str(i),
+                    timestamp=start + timedelta(seconds=i // 2))
+            for i in range(25)
+        ])
+        cls.ids = list(Message.objects.filter(conversation=cls.conversation).values_list('pk', flat=True))
+
+    def test_before_walks_back_without_gaps_or_duplicates(self):
+        page, has_more = history.latest(self.conversation, limit=7)
+        seen = [m.pk for m in page]
+        while has_more:
+            page, has_more = history.before(self.conversation, seen[0], limit=7)
+            seen = [m.pk for m in page] + seen
+        self.assertEqual(seen, self.ids)
+
+    def test_after_walks_forward_without_gaps_or_duplicates(self):
+        seen = [self.ids[0]]
+        has_more = True
+        while has_more:
+            page, has_more = history.after(self.conversation, seen[-1], limit=7)
+            seen += [m.pk for m in page]
+        self.assertEqual(seen, self.ids)
+
+    def test_unknown_cursor(self):
+        self.assertEqual(history.before(self.conversation, 0), ([], False))
+
+
+class DirectConversationTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+
+    def test_concurrent_starts_share_one_conversation(self):
+        self.client.force_login(self.a)
+        first = self.client.get(reverse('start_conversation', args=[self.b.pk]))
+        # The second request looked before the first one committed: its insert
+        # loses on the unique pair key and it opens the winner's conversation
+        self.client.force_login(self.b)
+        with mock.patch.object(QuerySet, 'first', return_value=None):
+            second = self.client.get(reverse('start_conversation', args=[self.a.pk]))
+        conversation = Conversation.objects.get()
+        self.assertEqual(first.url, reverse('conversation_detail', args=[conversation.pk]))
+        self.assertEqual(second.url, first.url)
+        self.assertCountEqual(conversation.participant_ids(), [self.a.pk, self.b.pk])
+
+    def test_migration_merges_duplicate_pairs(self):
+        older, newer = Conversation.objects.bulk_create([Conversation(), Conversation()])
+        for conversation, unread_for_a in ((older, 1), (newer, 2)):
+            conversation.participants.add(self.a, self.b)
+            Message.objects.create(conversation=conversation, sender=self.b, content=f'in {conversation.pk}')
+            ConversationReadState.objects.filter(conversation=conversation, user=self.a).update(unread_count=unread_for_a)
+        latest = Message.objects.get(conversation=newer)
+
+        migration = importlib.import_module('core.migrations.0008_conversation_pair_key')
+        migration.merge_direct_conversations(apps, None)
+
+        merged = Conversation.objects.get()
+        self.assertEqual(merged.pk, older.pk)
+        self.assertEqual(merged.pair_key, Conversation.pair_key_for(self.a.pk, self.b.pk))
+        self.assertEqual(merged.last_message_id, latest.pk)
+        self.assertEqual(Message.objects.filter(conversation=merged).count(), 2)
+        self.assertEqual(ConversationReadState.objects.get(conversation=merged, user=self.a).unread_count, 3)
+
+
+class PollingETagTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(cls.a.pk, cls.b.pk))
+        cls.conversation.participants.add(cls.a, cls.b)
+        unread.ensure_states(cls.conversation, [cls.a.pk, cls.b.pk])
+        cls.first = Message.objects.create(conversation=cls.conversation, sender=cls.b, content='hi')
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.a)
+        self.url = reverse('conversation_detail', args=[self.conversation.pk])
+
+    def poll(self, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get(self.url, {'after': self.first.pk}, headers=headers)
+
+    def test_unchanged_poll_is_not_modified(self):
+        etag = self.poll()['ETag']
+        # Only the session read: the view and the user load are skipped
+        with self.assertNumQueries(1):
+            self.assertEqual(self.poll(etag).status_code, 304)
+
+    def test_new_message_changes_etag(self):
+        etag = self.poll()['ETag']
+        self.client.force_login(self.b)
+        self.client.post(self.url, json.dumps({'content': 'again'}), content_type='application/json',
+                         headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.client.force_login(self.a)
+        response = self.poll(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([m['content'] for m in response.json()['messages']], ['again'])
+
+    def test_typing_etag_follows_typing_state(self):
+        url = reverse('get_typing_users', args=[self.conversation.pk])
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        typing_state.set_typing(self.conversation.pk, [self.a.pk, self.b.pk], self.b, True)
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+
+class ReadCursorTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(cls.a.pk, cls.b.pk))
+        cls.conversation.participants.add(cls.a, cls.b)
+        unread.ensure_states(cls.conversation, [cls.a.pk, cls.b.pk])
+        cls.messages = [
+            Message.objects.create(conversation=cls.conversation, sender=sender, content=str(i))
+            for i, sender in enumerate((cls.b, cls.b, cls.a, cls.b))
+        ]
+        Conversation.objects.filter(pk=cls.conversation.pk).update(last_message=cls.messages[-1])
+        cls.conversation.refresh_from_db()
+
+    def state(self, user):
+        return ConversationReadState.objects.get(conversation=self.conversation, user=user)
+
+    def test_cursor_only_moves_forward(self):
+        self.assertTrue(unread.mark_read(self.conversation, self.a, upto=self.messages[2].pk))
+        self.assertFalse(unread.mark_read(self.conversation, self.a, upto=self.messages[0].pk))
+        self.assertEqual(self.state(self.a).last_read_id, self.messages[2].pk)
+
+    def test_unread_count_is_recomputed_from_cursor(self):
+        # Whatever the counter says, marking read counts other people's messages after the cursor
+        ConversationReadState.objects.filter(conversation=self.conversation, user=self.a).update(unread_count=99)
+        unread.mark_read(self.conversation, self.a, upto=self.messages[1].pk)
+        self.assertEqual(self.state(self.a).unread_count, 1)
+        self.assertEqual(unread.total_for(self.a), 1)
+        unread.mark_read(self.conversation, self.a)
+        self.assertEqual(self.state(self.a).unread_count, 0)
+
+    def test_missing_state_is_created(self):
+        ConversationReadState.objects.filter(conversation=self.conversation, user=self.a).delete()
+        self.assertTrue(unread.mark_read(self.conversation, self.a, upto=self.messages[1].pk))
+        state = self.state(self.a)
+        self.assertEqual(state.last_read_id, self.messages[1].pk)
+        self.assertEqual(state.unread_count, 1)
+
+    def test_receipts_json(self):
+        unread.mark_read(self.conversation, self.b, upto=self.messages[2].pk)
+        self.client.force_login(self.a)
+        response = self.client.get(reverse('read_receipts', args=[self.conversation.pk]))
+        read_at = self.state(self.b).read_at.isoformat()
+        self.assertEqual(response.json(), {'status': 'ok', 'receipts': [
+            {'user_id': self.a.pk, 'username': 'a', 'last_read_id': None, 'read_at': None},
+            {'user_id': self.b.pk, 'username': 'b', 'last_read_id': self.messages[2].pk, 'read_at': read_at},
+        ]})
+
+    def test_receipts_hidden_from_non_participants(self):
+        outsider = User.objects.create_user('c', 'c@example.com', 'pw', gender='F', age=30)
+        self.client.force_login(outsider)
+        self.assertEqual(self.client.get(reverse('read_receipts', args=[self.conversation.pk])).status_code, 404)
+
+
+class InboxTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.c = User.objects.create_user('c', 'c@example.com', 'pw', gender='F', age=30)
+
+    def inbox_ids(self, user):
+        return [conv.pk for conv in inbox.page(user)[0]]
+
+    def test_conversation_added_through_participants_is_listed(self):
+        conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(self.a.pk, self.b.pk))
+        conversation.participants.add(self.a, self.b)
+        self.assertEqual(self.inbox_ids(self.a), [conversation.pk])
+        self.assertEqual(self.inbox_ids(self.b), [conversation.pk])
+
+    def test_conversation_joined_from_the_user_side_is_listed(self):
+        conversation = Conversation.objects.create()
+        self.c.conversations.add(conversation)
+        self.assertEqual(self.inbox_ids(self.c), [conversation.pk])
+        self.assertEqual(self.inbox_ids(self.a), [])
+
+    def start(self, other):
+        self.client.force_login(self.a)
+        self.client.get(reverse('start_conversation', args=[other.pk]))
+        return Conversation.objects.get(pair_key=Conversation.pair_key_for(self.a.pk, other.pk))
+
+    def send(self, sender, conversation, content):
+        self.client.force_login(sender)
+        self.client.post(reverse('conversation_detail', args=[conversation.pk]), json.dumps({'content': content}),
+                         content_type='application/json', headers={'X-Requested-With': 'XMLHttpRequest'})
+        return Message.objects.filter(conversation=conversation).latest('pk')
+
+    def entries(self, user, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse('inbox'), params).json()
+
+    def test_entry_contents(self):
+        with_b = self.start(self.b)
+        self.send(self.b, with_b, 'one')
+        last = self.send(self.b, with_b, 'two')
+        entry = self.entries(self.a)['conversations'][0]
+        self.assertEqual(entry['id'], with_b.pk)
+        self.assertEqual(entry['other'], {'id': self.b.pk, 'username': 'b', 'photo': ''})
+        self.assertEqual(entry['last_message'], {
+            'id': last.pk, 'sender_id': self.b.pk, 'preview': 'two', 'is_deleted': False,
+        })
+        self.assertEqual(entry['unread_count'], 2)
+        # The sender sees the same conversation from the other side, nothing unread
+        entry = self.entries(self.b)['conversations'][0]
+        self.assertEqual((entry['other']['id'], entry['unread_count']), (self.a.pk, 0))
+
+    def test_deleted_last_message_has_no_preview(self):
+        with_b = self.start(self.b)
+        last = self.send(self.b, with_b, 'secret')
+        self.client.post(reverse('delete_message', args=[last.pk]))
+        self.assertEqual(self.entries(self.a)['conversations'][0]['last_message']['preview'], '')
+
+    def test_newest_activity_first_across_pages(self):
+        with_b, with_c = self.start(self.b), self.start(self.c)
+        self.send(self.c, with_c, 'older')
+        self.send(self.b, with_b, 'newer')
+        with override_settings(INBOX_PAGE_SIZE=1):
+            first = self.entries(self.a)
+            second = self.entries(self.a, before=first['conversations'][0]['id'])
+        self.assertEqual([e['id'] for e in first['conversations'] + second['conversations']], [with_b.pk, with_c.pk])
+        self.assertEqual((first['has_more'], second['has_more']), (True, False))
+
+    def test_page_query_count_does_not_grow(self):
+        for other in (self.b, self.c):
+            self.send(other, self.start(other), 'hi')
+        with self.assertNumQueries(2):
+            conversations, _ = inbox.page(self.a)
+            self.assertEqual({conv.other_participant.pk for conv in conversations}, {self.b.pk, self.c.pk})
+            [conv.last_message.content for conv in conversations]
+
+    def test_list_page_renders_entries(self):
+        self.send(self.b, self.start(self.b), 'hello there')
+        self.client.force_login(self.a)
+        response = self.client.get(reverse('conversations_list'))
+        conversation = response.context['conversations'][0]
+        self.assertEqual((conversation.other_participant, conversation.unread_count), (self.b, 1))
+        self.assertContains(response, 'hello there')
+
+
+class UnreadCounterTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(cls.a.pk, cls.b.pk))
+        cls.conversation.participants.add(cls.a, cls.b)
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('conversation_detail', args=[self.conversation.pk])
+
+    def send(self, sender, content):
+        self.client.force_login(sender)
+        response = self.client.post(self.url, json.dumps({'content': content}), content_type='application/json',
+                                    headers={'X-Requested-With': 'XMLHttpRequest'})
+        return response.json()['message']['id']
+
+    def counts(self):
+        return (
+            ConversationReadState.objects.get(conversation=self.conversation, user=self.a).unread_count,
+            unread.total_for(self.a),
+        )
+
+    def test_send_counts_for_recipients_only(self):
+        self.assertEqual(self.counts(), (0, 0))
+        self.send(self.b, 'one')
+        self.send(self.b, 'two')
+        self.send(self.a, 'mine')
+        # The cached total was dropped on every send
+        self.assertEqual(self.counts(), (2, 2))
+        self.assertEqual(unread.total_for(self.b), 1)
+
+    def test_opening_the_conversation_reads_everything(self):
+        self.send(self.b, 'one')
+        self.send(self.b, 'two')
+        self.assertEqual(unread.total_for(self.a), 2)
+        self.client.force_login(self.a)
+        self.client.get(self.url)
+        self.assertEqual(self.counts(), (0, 0))
+        self.send(self.b, 'three')
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_deleting_an_unread_message_recounts(self):
+        first = self.send(self.b, 'one')
+        self.send(self.b, 'two')
+        self.assertEqual(unread.total_for(self.a), 2)
+        self.client.post(reverse('delete_message', args=[first]))
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_deleting_a_read_message_changes_nothing(self):
+        first = self.send(self.b, 'one')
+        self.client.force_login(self.a)
+        self.client.get(self.url)
+        self.send(self.b, 'two')
+        self.client.post(reverse('delete_message', args=[first]))
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_recount_ignores_the_stored_counter(self):
+        self.send(self.b, 'one')
+        ConversationReadState.objects.filter(conversation=self.conversation, user=self.a).update(unread_count=42)
+        unread.recount(self.conversation, self.a.pk)
+        self.assertEqual(self.counts(), (1, 1))
+
+    @override_settings(ROOT_URLCONF=urlconf_with(async_views))
+    def test_async_delete_recounts(self):
+        first = self.send(self.b, 'one')
+        self.assertEqual(unread.total_for(self.a), 1)
+        self.client.post(reverse('delete_message', args=[first]))
+        self.assertEqual(self.counts(), (0, 0))
+
+
+class RenditionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', 'user@example.com', 'pw', gender='M', age=30)
+
+    def setUp(self):
+        cache.clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        overrides = override_settings(MEDIA_ROOT=media, MEDIA_URL='/media/')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def image(self, color='red', size=(640, 320)):
+        out = io.BytesIO()
+        Image.new('RGB', size, color).save(out, 'PNG')
+        return out.getvalue()
+
+    def set_photo(self, user, content):
+        user.photo.save('me.png', ContentFile(content), save=False)
+        User.objects.filter(pk=user.pk).update(photo=user.photo.name, photo_renditions={})
+
+    def test_variant_sizes(self):
+        names = renditions.build(self.image())
+        with default_storage.open(names['avatar']) as f, Image.open(f) as avatar:
+            self.assertEqual((avatar.format, avatar.size), ('JPEG', (96, 96)))
+        with default_storage.open(names['profile']) as f, Image.open(f) as profile:
+            self.assertEqual(profile.size, (480, 240))
+
+    def test_names_hash_the_source_and_the_variant(self):
+        red = renditions.build(self.image('red'))
+        self.assertEqual(renditions.build(self.image('red')), red)
+        blue = renditions.build(self.image('blue'))
+        self.assertNotEqual(blue['avatar'], red['avatar'])
+        self.assertNotEqual(red['avatar'].split('-')[0], red['profile'].split('-')[0])
+        self.assertRegex(red['avatar'], r'^user_photos/r/[0-9a-f]{20}-avatar\.jpg$')
+
+    def test_identical_source_reuses_stored_files(self):
+        names = renditions.build(self.image())
+        with mock.patch.object(renditions, 'render') as render:
+            self.assertEqual(renditions.build(self.image()), names)
+        render.assert_not_called()
+
+    def test_url_for_falls_back_to_the_original(self):
+        self.assertEqual(renditions.url_for(self.user, 'avatar'), '')
+        self.set_photo(self.user, self.image())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_url, self.user.photo.url)
+        names = renditions.generate(self.user.pk)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.photo_renditions, names)
+        self.assertEqual(self.user.avatar_url, default_storage.url(names['avatar']))
+        self.assertEqual(self.user.profile_photo_url, default_storage.url(names['profile']))
+
+    def test_generate_skips_a_replaced_photo(self):
+        self.set_photo(self.user, self.image('red'))
+        build = renditions.build
+
+        def replace_meanwhile(source):
+            names = build(source)
+            self.set_photo(self.user, self.image('blue'))
+            return names
+
+        with mock.patch.object(renditions, 'build', replace_meanwhile):
+            renditions.generate(self.user.pk)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.photo_renditions, {})
+
+
+class PhotoUploadTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', 'user@example.com', 'pw', gender='M', age=30)
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        overrides = override_settings(
+            MEDIA_ROOT=media, PHOTO_UPLOAD_SPOOL_DIR=f'{media}/spool', BACKGROUND_INLINE=True,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def upload(self, content=None, name='me.png'):
+        if content is None:
+            out = io.BytesIO()
+            Image.new('RGB', (64, 48), 'red').save(out, 'PNG')
+            content = out.getvalue()
+        return SimpleUploadedFile(name, content, content_type='image/png')
+
+    def test_job_moves_from_pending_through_processing_to_done(self):
+        seen = []
+        validate = uploads.validate
+
+        def spy(path):
+            seen.append(PhotoUpload.objects.get().status)
+            validate(path)
+
+        with mock.patch.object(uploads, 'validate', spy), self.captureOnCommitCallbacks(execute=True):
+            job = uploads.enqueue(self.user, self.upload())
+            seen.insert(0, job.status)
+        job.refresh_from_db()
+        self.assertEqual(seen, [PhotoUpload.PENDING, PhotoUpload.PROCESSING])
+        self.assertEqual((job.status, job.error), (PhotoUpload.DONE, ''))
+        self.assertIsNotNone(job.finished_at)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.photo.name.endswith('.png'))
+        self.assertFalse(os.path.exists(job.spool_path))
+
+    def test_invalid_image_fails(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            job = uploads.enqueue(self.user, self.upload(b'not an image'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (PhotoUpload.FAILED, "The file is not a valid image."))
+        self.assertFalse(os.path.exists(job.spool_path))
+
+    def test_recovery_picks_up_stuck_jobs(self):
+        # Queued while the workers were down, and claimed by a worker that then died
+        with mock.patch.object(uploads.workers, 'defer'):
+            pending = uploads.enqueue(self.user, self.upload())
+            stuck = uploads.enqueue(self.user, self.upload())
+            running = uploads.enqueue(self.user, self.upload())
+        PhotoUpload.objects.filter(pk=stuck.pk).update(
+            status=PhotoUpload.PROCESSING, claimed_at=timezone.now() - timedelta(hours=1),
+        )
+        PhotoUpload.objects.filter(pk=running.pk).update(status=PhotoUpload.PROCESSING, claimed_at=timezone.now())
+
+        call_command('process_photo_uploads', stdout=io.StringIO())
+        statuses = dict(PhotoUpload.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {
+            pending.pk: PhotoUpload.DONE, stuck.pk: PhotoUpload.DONE, running.pk: PhotoUpload.PROCESSING,
+        })
+
+    def test_recovery_leaves_long_queued_job_that_was_just_claimed(self):
+        with mock.patch.object(uploads.workers, 'defer'):
+            job = uploads.enqueue(self.user, self.upload())
+        PhotoUpload.objects.filter(pk=job.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        validate = uploads.validate
+
+        def overlapping_run(path):
+            # A cron run starting while this worker holds the job must not take it back
+            self.assertEqual(uploads.recover(), [])
+            validate(path)
+
+        with mock.patch.object(uploads, 'validate', overlapping_run):
+            uploads.process(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PhotoUpload.DONE)
+        self.assertIsNotNone(job.claimed_at)
+
+
+class CacheInvalidationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+
+    def setUp(self):
+        cache.clear()
+
+    def assertBlocks(self, blocked_by_a):
+        self.assertEqual(blocking.blocked_ids(self.a.pk), blocked_by_a)
+        self.assertEqual(blocking.blocked_by_ids(self.b.pk), {self.a.pk} if blocked_by_a else set())
+
+    def test_orm_block_changes(self):
+        self.assertBlocks(set())
+        self.a.blocked_users.add(self.b)
+        self.assertBlocks({self.b.pk})
+        self.b.blocked_by.remove(self.a)
+        self.assertBlocks(set())
+
+    def test_clear_in_either_direction(self):
+        self.a.blocked_users.add(self.b)
+        self.assertBlocks({self.b.pk})
+        self.a.blocked_users.clear()
+        self.assertBlocks(set())
+        self.a.blocked_users.add(self.b)
+        self.assertBlocks({self.b.pk})
+        self.b.blocked_by.clear()
+        self.assertBlocks(set())
+
+    def test_deleting_a_user(self):
+        self.a.blocked_users.add(self.b)
+        self.assertEqual(blocking.blocked_ids(self.a.pk), {self.b.pk})
+        self.b.delete()
+        self.assertEqual(blocking.blocked_ids(self.a.pk), set())
+
+    def test_reverse_participant_clear(self):
+        conversation = Conversation.objects.create()
+        conversation.participants.add(self.a, self.b)
+        self.assertCountEqual(Conversation.participant_ids_for(conversation.pk), [self.a.pk, self.b.pk])
+        self.b.conversations.clear()
+        self.assertEqual(Conversation.participant_ids_for(conversation.pk), [self.a.pk])
+
+
+class FragmentCacheTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30, bio='first bio')
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(cls.a.pk, cls.b.pk))
+        cls.conversation.participants.add(cls.a, cls.b)
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('conversation_detail', args=[self.conversation.pk])
+        self.message = self.send(self.a, 'original text')
+
+    def send(self, sender, content):
+        self.client.force_login(sender)
+        response = self.client.post(self.url, json.dumps({'content': content}), content_type='application/json',
+                                    headers={'X-Requested-With': 'XMLHttpRequest'})
+        return Message.objects.get(pk=response.json()['message']['id'])
+
+    def page(self, viewer):
+        self.client.force_login(viewer)
+        return self.client.get(self.url).content.decode()
+
+    def test_list_is_served_from_the_cache(self):
+        self.assertIn('original text', self.page(self.b))
+        # Bypassing the views leaves the stamp alone, so the cached list is reused
+        Message.objects.filter(pk=self.message.pk).update(content='changed behind its back')
+        self.assertIn('original text', self.page(self.b))
+
+    def test_edit_invalidates(self):
+        self.assertIn('original text', self.page(self.b))
+        self.client.force_login(self.a)
+        self.client.post(reverse('edit_message', args=[self.message.pk]), json.dumps({'content': 'edited text'}),
+                         content_type='application/json')
+        page = self.page(self.b)
+        self.assertIn('edited text', page)
+        self.assertNotIn('original text', page)
+
+    def test_delete_invalidates(self):
+        self.assertIn('original text', self.page(self.b))
+        self.client.force_login(self.a)
+        self.client.post(reverse('delete_message', args=[self.message.pk]))
+        page = self.page(self.b)
+        self.assertIn('Message deleted', page)
+        self.assertNotIn('original text', page)
+
+    @override_settings(ROOT_URLCONF=urlconf_with(async_views))
+    def test_async_edit_and_delete_invalidate(self):
+        self.assertIn('original text', self.page(self.b))
+        self.client.force_login(self.a)
+        self.client.post(reverse('edit_message', args=[self.message.pk]), json.dumps({'content': 'edited text'}),
+                         content_type='application/json')
+        self.assertIn('edited text', self.page(self.b))
+        self.client.force_login(self.a)
+        self.client.post(reverse('delete_message', args=[self.message.pk]))
+        self.assertIn('Message deleted', self.page(self.b))
+
+    def test_new_message_invalidates(self):
+        self.assertIn('original text', self.page(self.b))
+        self.send(self.b, 'a reply')
+        self.assertIn('a reply', self.page(self.a))
+        self.assertIn('a reply', self.page(self.b))
+
+    def test_each_viewer_has_their_own_copy(self):
+        # The list renders an edit button only on the viewer's own messages (the script holds one more)
+        self.assertEqual(self.page(self.a).count('edit-message'), self.page(self.b).count('edit-message') + 1)
+
+    def test_profile_card_follows_saves(self):
+        url = reverse('profile_detail', args=[self.a.pk])
+        self.client.force_login(self.b)
+        self.assertIn('first bio', self.client.get(url).content.decode())
+        User.objects.filter(pk=self.a.pk).update(bio='second bio')
+        self.assertIn('first bio', self.client.get(url).content.decode())
+        fragments.profile_changed(self.a.pk)
+        self.assertIn('second bio', self.client.get(url).content.decode())
+        user = User.objects.get(pk=self.a.pk)
+        user.bio = 'third bio'
+        user.save()
+        self.assertIn('third bio', self.client.get(url).content.decode())
+
+
+@override_settings(ROOT_URLCONF=urlconf_with(async_views))
+class AsyncEndpointTests(RequestTestCase):
+    """The async JSON endpoints, through the ASGI test client."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.outsider = User.objects.create_user('c', 'c@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(cls.a.pk, cls.b.pk))
+        cls.conversation.participants.add(cls.a, cls.b)
+        cls.message = Message.objects.create(conversation=cls.conversation, sender=cls.a, content='hello')
+
+    def urls(self):
+        pk = self.conversation.pk
+        return {
+            'update_typing_status': reverse('update_typing_status', args=[pk]),
+            'get_typing_users': reverse('get_typing_users', args=[pk]),
+            'conversation_statuses': reverse('conversation_statuses', args=[pk]),
+            'edit_message': reverse('edit_message', args=[self.message.pk]),
+            'delete_message': reverse('delete_message', args=[self.message.pk]),
+            'block_user': reverse('block_user', args=[self.b.pk]),
+        }
+
+    async def post_json(self, url, data):
+        return await self.async_client.post(url, json.dumps(data), content_type='application/json')
+
+    async def test_anonymous_is_sent_to_login(self):
+        for name, url in self.urls().items():
+            with self.subTest(name):
+                response = await self.async_client.post(url)
+                self.assertEqual(response.status_code, 302)
+                self.assertTrue(response.url.startswith(reverse('login')))
+
+    async def test_outsider_gets_404(self):
+        await self.async_client.aforce_login(self.outsider)
+        for name, url in self.urls().items():
+            if name == 'block_user':
+                continue
+            with self.subTest(name):
+                response = await self.async_client.post(url, '{}', content_type='application/json')
+                self.assertEqual(response.status_code, 404)
+        for name in ('get_typing_users', 'conversation_statuses'):
+            with self.subTest(name):
+                self.assertEqual((await self.async_client.get(self.urls()[name])).status_code, 404)
+        self.assertEqual(await Message.objects.aget(pk=self.message.pk), self.message)
+
+    async def test_typing(self):
+        await self.async_client.aforce_login(self.a)
+        response = await self.post_json(self.urls()['update_typing_status'], {'is_typing': True})
+        self.assertEqual(response.json(), {'status': 'ok', 'typing_users': []})
+        await self.async_client.aforce_login(self.b)
+        response = await self.async_client.get(self.urls()['get_typing_users'])
+        self.assertEqual(response.json(), {'status': 'ok', 'typing_users': [
+            {'id': self.a.pk, 'username': 'a', 'photo': ''},
+        ]})
+        self.assertEqual(
+            (await self.async_client.get(self.urls()['get_typing_users'], headers={'If-None-Match': response['ETag']})).status_code,
+            304,
+        )
+
+    async def test_statuses(self):
+        await self.async_client.aforce_login(self.a)
+        response = await self.async_client.get(self.urls()['conversation_statuses'])
+        self.assertEqual(response.status_code, 200)
+        self.assertCountEqual(response.json()['participants'], [
+            # The request itself is a heartbeat
+            {'id': self.a.pk, 'username': 'a', 'status': 'online'},
+            {'id': self.b.pk, 'username': 'b', 'status': presence.status_of(self.b)},
+        ])
+
+    async def test_edit_and_delete(self):
+        await self.async_client.aforce_login(self.a)
+        response = await self.post_json(self.urls()['edit_message'], {'content': ' changed '})
+        self.assertEqual(response.json()['message']['content'], 'changed')
+        self.assertEqual((await self.post_json(self.urls()['edit_message'], {'content': ' '})).status_code, 400)
+        response = await self.async_client.post(self.urls()['edit_message'], 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((await self.async_client.get(self.urls()['edit_message'])).status_code, 405)
+        self.assertEqual((await self.async_client.post(self.urls()['delete_message'])).json(), {'status': 'ok'})
+        message = await Message.objects.aget(pk=self.message.pk)
+        self.assertEqual((message.content, message.is_deleted), ('changed', True))
+
+    async def test_only_the_sender_may_edit(self):
+        await self.async_client.aforce_login(self.b)
+        self.assertEqual((await self.post_json(self.urls()['edit_message'], {'content': 'x'})).status_code, 404)
+        self.assertEqual((await self.async_client.post(self.urls()['delete_message'])).status_code, 404)
+
+    async def test_block_toggles(self):
+        await self.async_client.aforce_login(self.a)
+        url = self.urls()['block_user']
+        self.assertEqual((await self.async_client.post(url)).json(), {'status': 'blocked'})
+        self.assertEqual(await sync_to_async(blocking.blocked_ids)(self.a.pk), {self.b.pk})
+        self.assertEqual((await self.async_client.post(url)).json(), {'status': 'unblocked'})
+        self.assertEqual(await sync_to_async(blocking.blocked_ids)(self.a.pk), set())
+        self.assertEqual((await self.async_client.get(url)).status_code, 405)
+        self.assertEqual((await self.async_client.post(reverse('block_user', args=[self.a.pk]))).status_code, 400)
+        self.assertEqual((await self.async_client.post(reverse('block_user', args=[0]))).status_code, 404)
+
+
+class EventStreamTests(RequestTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = User.objects.create_user('a', 'a@example.com', 'pw', gender='M', age=30)
+        cls.b = User.objects.create_user('b', 'b@example.com', 'pw', gender='F', age=30)
+        cls.conversation = Conversation.objects.create(pair_key=Conversation.pair_key_for(cls.a.pk, cls.b.pk))
+        cls.conversation.participants.add(cls.a, cls.b)
+
+    @asynccontextmanager
+    async def open_stream(self):
+        request = AsyncRequestFactory().get(reverse('conversation_events', args=[self.conversation.pk]))
+        request.user = self.a
+
+        async def auser():
+            return self.a
+        request.auser = auser
+        response = await views.conversation_events(request, self.conversation.pk)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        # The view's generator itself, so closing it ends the subscription on this loop
+        frames = response._iterator
+        try:
+            self.assertEqual(await anext(frames), 'retry: 3000\n\n')
+            yield frames
+        finally:
+            await frames.aclose()
+
+    async def next_event(self, frames):
+        frame = await anext(frames)
+        event, data = frame.strip().split('\n')
+        return event.removeprefix('event: '), json.loads(data.removeprefix('data: '))
+
+    def statuses(self, data):
+        return {p['id']: p['status'] for p in data['participants']}
+
+    @override_settings(PRESENCE_ONLINE_SECONDS=300)
+    async def test_open_stream_keeps_viewer_online(self):
+        async with self.open_stream() as frames:
+            event, data = await self.next_event(frames)
+            self.assertEqual((event, self.statuses(data)[self.a.pk]), ('presence', presence.ONLINE))
+            # Ten minutes later with nothing but the stream open
+            later = timezone.now() + timedelta(seconds=600)
+            with mock.patch.object(realtime, 'PRESENCE_INTERVAL', 0.01), \
+                    mock.patch('django.utils.timezone.now', return_value=later):
+                event, data = await self.next_event(frames)
+            self.assertEqual((event, self.statuses(data)[self.a.pk]), ('presence', presence.ONLINE))
+
+    def send(self, content):
+        """Send as ``b`` through the view; returns the on-commit callbacks it queued."""
+        self.client.force_login(self.b)
+        with self.captureOnCommitCallbacks() as callbacks, mock.patch.object(realtime, 'publish') as publish:
+            response = self.client.post(
+                reverse('conversation_detail', args=[self.conversation.pk]), json.dumps({'content': content}),
+                content_type='application/json', headers={'X-Requested-With': 'XMLHttpRequest'},
+            )
+            self.assertEqual(response.status_code, 200)
+            # Nothing goes out while the transaction may still roll back
+            publish.assert_not_called()
+        return callbacks
+
+    def test_message_is_published_after_commit(self):
+        callbacks = self.send('hi')
+        with mock.patch.object(realtime, 'publish') as publish:
+            for callback in callbacks:
+                callback()
+        message = Message.objects.get()
+        publish.assert_called_once_with(self.conversation.pk, 'message', message=message.to_dict())
+
+    def test_rolled_back_message_is_never_published(self):
+        with mock.patch.object(realtime, 'publish') as publish, self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    message = Message.objects.create(conversation=self.conversation, sender=self.b, content='hi')
+                    realtime.publish_message(message)
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+        publish.assert_not_called()
+
+    async def test_stream_delivers_messages_edits_and_deletes(self):
+        async with self.open_stream() as frames:
+            self.assertEqual((await self.next_event(frames))[0], 'presence')
+            callbacks = await sync_to_async(self.send)('hi')
+            for callback in callbacks:
+                callback()
+            event, data = await self.next_event(frames)
+            message = await Message.objects.select_related('sender').aget()
+            self.assertEqual((event, data), ('message', {'message': message.to_dict()}))
+
+            await self.async_client.aforce_login(self.b)
+            with override_settings(ROOT_URLCONF=urlconf_with(async_views)):
+                await self.async_client.post(reverse('edit_message', args=[message.pk]), {'content': 'edited'},
+                                             content_type='application/json')
+                await self.async_client.post(reverse('delete_message', args=[message.pk]))
+            event, data = await self.next_event(frames)
+            self.assertEqual((event, data['message']['content']), ('message_edited', 'edited'))
+            event, data = await self.next_event(frames)
+            self.assertEqual((event, data['message']['is_deleted']), ('message_deleted', True))
+
+    async def test_stream_only_carries_its_own_conversation(self):
+        other = await Conversation.objects.acreate()
+        async with self.open_stream() as frames:
+            await self.next_event(frames)
+            realtime.publish(other.pk, 'typing', typing_users=[], ttl=6)
+            realtime.publish(self.conversation.pk, 'typing', typing_users=[{'id': self.b.pk}], ttl=6)
+            self.assertEqual(await self.next_event(frames), ('typing', {'typing_users': [{'id': self.b.pk}], 'ttl': 6}))
@@ -0,0 +1,76 @@
+"""Ephemeral typing indicators.
+
+Each typing user is a single cache key with a short TTL (``TYPING_TTL``
+seconds, default 6), so a tab that crashes mid-sentence stops showing as
+typing on its own without any cleanup job. Changes are pushed to the
+conversation channel in ``core.realtime``.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from . import realtime
+
+TYPING_KEY = 'typing:{}:{}'
+
+
+def ttl():
+    return getattr(settings, 'TYPING_TTL', 6)
+
+
+def user_payload(user):
+    """The JSON shape used for typing users everywhere."""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'photo': user.avatar_url,
+    }
+
+
+def typing_users(conversation_id, participant_ids, exclude_user_id=None):
+    """Return payloads of participants currently typing, with one cache multi-get."""
+    keys = [TYPING_KEY.format(conversation_id, pk) for pk in participant_ids if pk != exclude_user_id]
+    found = cache.get_many(keys)
+    return [found[key] for key in keys if key in found]
+
+
+async def atyping_users(conversation_id, participant_ids, exclude_user_id=None):
+    """Async version of ``typing_users``."""
+    keys = [TYPING_KEY.format(conversation_id, pk) for pk in participant_ids if pk != exclude_user_id]
+    found = await cache.aget_many(keys)
+    return [found[key] for key in keys if key in found]
+
+
+def _store(conversation_id, user, is_typing):
+    key = TYPING_KEY.format(conversation_id, user.pk)
+    if is_typing:
+        cache.set(key, user_payload(user), timeout=ttl())
+    else:
+        cache.delete(key)
+
+
+async def _astore(conversation_id, user, is_typing):
+    key = TYPING_KEY.format(conversation_id, user.pk)
+    if is_typing:
+        await cache.aset(key, user_payload(user), timeout=ttl())
+    else:
+        await cache.adelete(key)
+
+
+def set_typing(conversation_id, participant_ids, user, is_typing):
+    """Start or stop ``user`` typing and push the new typing list to the conversation."""
+    _store(conversation_id, user, is_typing)
+    realtime.publish(
+        conversation_id, 'typing',
+        typing_users=typing_users(conversation_id, participant_ids),
+        ttl=ttl(),
+    )
+
+
+async def aset_typing(conversation_id, participant_ids, user, is_typing):
+    """Async version of ``set_typing``."""
+    await _astore(conversation_id, user, is_typing)
+    await realtime.apublish(
+        conversation_id, 'typing',
+        typing_users=await atyping_users(conversation_id, participant_ids),
+        ttl=ttl(),
+    )
@@ -0,0 +1,131 @@
+"""Read cursors and denormalized unread counters.
+
+Each participant has a ``ConversationReadState`` row holding a read cursor
+(``last_read_id``, the newest message they have seen) and an
+``unread_count``. Sending bumps the recipients' counters; marking read moves
+the cursor forward with a single-row UPDATE, whatever the backlog size, and
+recomputes the counter from the messages after the cursor (normally none).
+Deleted messages do not count, so deleting one recounts the recipients that
+have not read it yet. Messages themselves are never updated on read.
+
+The per-user badge total is cached under ``UNREAD_TOTAL_KEY`` and dropped
+whenever one of the user's counters changes.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import realtime
+from .models import Conversation, ConversationReadState, Message
+
+UNREAD_TOTAL_KEY = 'unread:total:{}'
+
+
+def ensure_states(conversation, user_ids):
+    """Create missing read-state rows for ``user_ids`` in ``conversation``."""
+    ConversationReadState.objects.bulk_create(
+        [ConversationReadState(conversation=conversation, user_id=pk) for pk in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def _unread_after(cursor):
+    """Subquery counting other people's messages after ``cursor`` in the row's conversation."""
+    counted = (
+        Message.objects.filter(conversation=OuterRef('conversation_id'), pk__gt=cursor, is_deleted=False)
+        .exclude(sender=OuterRef('user_id'))
+        .order_by()
+        .values('conversation')
+        .annotate(n=Count('pk'))
+        .values('n')
+    )
+    return Coalesce(Subquery(counted), 0)
+
+
+def message_sent(message, recipient_ids):
+    """Bump the unread counter of every recipient of ``message``."""
+    recipient_ids = list(recipient_ids)
+    updated = ConversationReadState.objects.filter(
+        conversation_id=message.conversation_id, user_id__in=recipient_ids
+    ).update(unread_count=F('unread_count') + 1)
+    if updated < len(recipient_ids):
+        # Conversations created before read states existed; count from scratch
+        ensure_states(message.conversation, recipient_ids)
+        for pk in recipient_ids:
+            recount(message.conversation, pk)
+    cache.delete_many([UNREAD_TOTAL_KEY.format(pk) for pk in recipient_ids])
+
+
+def message_deleted(message):
+    """Recount the counters of the recipients that had not read ``message`` yet."""
+    recount_states(ConversationReadState.objects.filter(
+        Q(last_read_id__isnull=True) | Q(last_read_id__lt=message.pk),
+        conversation_id=message.conversation_id,
+    ).exclude(user_id=message.sender_id))
+    recipient_ids = [pk for pk in Conversation.participant_ids_for(message.conversation_id) if pk != message.sender_id]
+    cache.delete_many([UNREAD_TOTAL_KEY.format(pk) for pk in recipient_ids])
+
+
+def mark_read(conversation, user, upto=None):
+    """Move ``user``'s cursor forward to message ``upto`` (default: the newest).
+
+    Cursors only move forward, so a stale page cannot un-read messages.
+    A missing read state is created first, so the cursor is never lost.
+    Returns whether the cursor moved; if so the other participants get a
+    ``read`` event.
+    """
+    if upto is None:
+        upto = conversation.last_message_id
+        if upto is None:
+            return False
+    ensure_states(conversation, [user.pk])
+    moved = ConversationReadState.objects.filter(
+        Q(last_read_id__isnull=True) | Q(last_read_id__lt=upto),
+        conversation=conversation,
+        user=user,
+    ).update(last_read_id=upto, read_at=timezone.now(), unread_count=_unread_after(upto))
+    if moved:
+        cache.delete(UNREAD_TOTAL_KEY.format(user.pk))
+        transaction.on_commit(lambda: realtime.publish(conversation.pk, 'read', user_id=user.pk, last_read_id=upto))
+    return bool(moved)
+
+
+def recount(conversation, user_id):
+    """Recompute one counter from the messages after the user's cursor."""
+    recount_states(ConversationReadState.objects.filter(conversation=conversation, user_id=user_id))
+    cache.delete(UNREAD_TOTAL_KEY.format(user_id))
+
+
+def recount_states(states):
+    """Recompute the counters of every row in the ``states`` queryset in one UPDATE."""
+    return states.update(unread_count=_unread_after(Coalesce(OuterRef('last_read_id'), 0)))
+
+
+def receipts(conversation_id):
+    """Every participant's read cursor in ``conversation_id``."""
+    rows = ConversationReadState.objects.filter(conversation_id=conversation_id).order_by('user_id').values(
+        'user_id', 'user__username', 'last_read_id', 'read_at'
+    )
+    return [
+        {
+            'user_id': row['user_id'],
+            'username': row['user__username'],
+            'last_read_id': row['last_read_id'],
+            'read_at': row['read_at'].isoformat() if row['read_at'] else None,
+        }
+        for row in rows
+    ]
+
+
+def total_for(user):
+    """Return ``user``'s total unread count: a cache hit, or one indexed SUM."""
+    key = UNREAD_TOTAL_KEY.format(user.pk)
+    total = cache.get(key)
+    if total is None:
+        total = ConversationReadState.objects.filter(user=user).aggregate(
+            total=Sum('unread_count')
+        )['total'] or 0
+        cache.set(key, total, 3600)
+    return total
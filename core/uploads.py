@@ -0,0 +1,143 @@
+"""Off-request processing of profile photo uploads.
+
+``profile_edit`` spools the upload to disk in chunks (it never sits in
+memory) and returns as soon as a ``PhotoUpload`` job row exists. A
+background worker (``core.workers``) then claims the job, validates the
+image with Pillow, stores it as ``User.photo`` and renders its variants
+(``core.renditions``). Job rows make the queue restart-safe: the
+``process_photo_uploads`` command finishes anything left pending.
+
+Settings: ``PHOTO_UPLOAD_SPOOL_DIR`` (default ``photo-uploads`` under
+``FILE_UPLOAD_TEMP_DIR`` or the system temp dir), ``PHOTO_UPLOAD_MAX_BYTES``
+(default 10 MB) and ``PHOTO_UPLOAD_MAX_PIXELS`` (default 40 million).
+"""
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from . import fragments, renditions, workers
+from .models import PhotoUpload
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+
+class InvalidPhoto(Exception):
+    pass
+
+
+def spool_dir():
+    default = os.path.join(settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(), 'photo-uploads')
+    path = getattr(settings, 'PHOTO_UPLOAD_SPOOL_DIR', default)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def max_bytes():
+    return getattr(settings, 'PHOTO_UPLOAD_MAX_BYTES', 10 * 1024 * 1024)
+
+
+def check(uploaded):
+    """Cheap request-time checks; the image itself is only decoded by the worker."""
+    if uploaded.size > max_bytes():
+        return f"Photo must be smaller than {max_bytes() // (1024 * 1024)} MB."
+    if uploaded.content_type and not uploaded.content_type.startswith('image/'):
+        return "Please upload an image file."
+    return None
+
+
+def spool(uploaded):
+    """Move (or copy in chunks) ``uploaded`` into the spool dir and return its path."""
+    path = os.path.join(spool_dir(), uuid.uuid4().hex)
+    if hasattr(uploaded, 'temporary_file_path'):
+        # Already on disk from TemporaryFileUploadHandler: just move it
+        shutil.move(uploaded.temporary_file_path(), path)
+    else:
+        with open(path, 'wb') as out:
+            for chunk in uploaded.chunks():
+                out.write(chunk)
+    return path
+
+
+def enqueue(user, uploaded):
+    """Spool ``uploaded`` for ``user`` and queue it; returns the ``PhotoUpload``."""
+    job = PhotoUpload.objects.create(
+        user=user,
+        spool_path=spool(uploaded),
+        original_name=os.path.basename(uploaded.name)[:255],
+    )
+    workers.defer(process, job.pk)
+    return job
+
+
+def validate(path):
+    """Raise ``InvalidPhoto`` unless ``path`` is a supported, sanely sized image."""
+    from PIL import Image, UnidentifiedImageError
+
+    max_pixels = getattr(settings, 'PHOTO_UPLOAD_MAX_PIXELS', 40_000_000)
+    try:
+        with Image.open(path) as image:
+            if image.format not in ALLOWED_FORMATS:
+                raise InvalidPhoto("Unsupported image format.")
+            if image.width * image.height > max_pixels:
+                raise InvalidPhoto("Image dimensions are too large.")
+            image.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as exc:
+        raise InvalidPhoto("The file is not a valid image.") from exc
+
+
+def process(job_id):
+    """Validate and store one pending upload; safe to call twice for the same job."""
+    claimed = PhotoUpload.objects.filter(pk=job_id, status=PhotoUpload.PENDING).update(
+        status=PhotoUpload.PROCESSING, claimed_at=timezone.now(),
+    )
+    if not claimed:
+        return
+    job = PhotoUpload.objects.get(pk=job_id)
+    status, error = PhotoUpload.DONE, ''
+    try:
+        validate(job.spool_path)
+        User = get_user_model()
+        field = User._meta.get_field('photo')
+        user = User.objects.only('id').get(pk=job.user_id)
+        with open(job.spool_path, 'rb') as f:
+            name = default_storage.save(field.generate_filename(user, job.original_name), File(f))
+        User.objects.filter(pk=job.user_id).update(photo=name, photo_renditions={})
+        fragments.profile_changed(job.user_id)
+        renditions.generate(job.user_id)
+    except InvalidPhoto as exc:
+        status, error = PhotoUpload.FAILED, str(exc)
+    except Exception:
+        logger.exception("Photo upload %s failed", job_id)
+        status, error = PhotoUpload.FAILED, "Something went wrong while processing the photo."
+    finally:
+        if os.path.exists(job.spool_path):
+            os.remove(job.spool_path)
+    PhotoUpload.objects.filter(pk=job_id).update(status=status, error=error, finished_at=timezone.now())
+
+
+def latest_for(user):
+    """The user's most recent upload job, or ``None``."""
+    return PhotoUpload.objects.filter(user=user).order_by('-id').first()
+
+
+def recover(stale_after=timedelta(minutes=10)):
+    """Re-queue jobs a crashed worker left in ``processing`` and return pending ids.
+
+    Staleness is measured from the claim, not from the upload, so a job that
+    waited long in the queue is not taken from the worker that just claimed it.
+    """
+    PhotoUpload.objects.filter(
+        status=PhotoUpload.PROCESSING, claimed_at__lt=timezone.now() - stale_after
+    ).update(status=PhotoUpload.PENDING)
+    return list(PhotoUpload.objects.filter(status=PhotoUpload.PENDING).order_by('created_at').values_list('pk', flat=True))
@@ -1,8 +1,35 @@
-from django.urls import path
-from . import views
+import types
+
+from django.conf import settings
+from django.urls import include, path
+from . import async_views, views
 from django.contrib.auth import views as auth_views
 
 
+def endpoint_patterns(endpoints):
+    """URLs of the JSON endpoints that ``core.async_views`` also implements, taken from ``endpoints``."""
+    return [
+        path('messages/<int:message_id>/delete/', endpoints.delete_message, name='delete_message'),
+        path('messages/<int:message_id>/edit/', endpoints.edit_message, name='edit_message'),
+        path('conversations/<int:conversation_id>/typing/', endpoints.update_typing_status, name='update_typing_status'),
+        path('conversations/<int:conversation_id>/typing-users/', endpoints.get_typing_users, name='get_typing_users'),
+        path('conversations/<int:conversation_id>/statuses/', endpoints.conversation_statuses, name='conversation_statuses'),
+        path('users/<int:pk>/block/', endpoints.block_user, name='block_user'),
+    ]
+
+
+def urlconf_with(endpoints):
+    """A root URLconf serving those endpoints from ``endpoints`` regardless of ASYNC_VIEWS.
+
+    For the tests and bench_asgi. Call it before overriding ROOT_URLCONF.
+    """
+    urlconf = types.ModuleType(f'urlconf_with_{endpoints.__name__}')
+    # The first match wins, so these shadow the configured implementations
+    urlconf.urlpatterns = [*endpoint_patterns(endpoints), path('', include(settings.ROOT_URLCONF))]
+    return urlconf
+
+
+
 urlpatterns = [
     path('', views.home, name='home'),
     path('signup/', views.signup_view, name='signup'),
@@ -13,19 +40,21 @@ urlpatterns = [
     path('random/', views.random_profile, name='random'),
     path('profile/<int:pk>/', views.profile_detail, name='profile_detail'),
     path('profile/edit/', views.profile_edit, name='profile_edit'),
+    path('profile/photo-status/', views.photo_upload_status, name='photo_upload_status'),
     path('users/gender/<str:gender>/', views.users_by_gender, name='users_by_gender'),
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
 
 # Conversations and Messages
 urlpatterns += [
     path('conversations/', views.conversations_list, name='conversations_list'),
+    path('conversations/inbox/', views.inbox_json, name='inbox'),
     path('conversations/<int:pk>/', views.conversation_detail, name='conversation_detail'),
     path('start-conversation/<int:pk>/', views.start_conversation, name='start_conversation'),
-    path('messages/<int:message_id>/delete/', views.delete_message, name='delete_message'),
-    path('messages/<int:message_id>/edit/', views.edit_message, name='edit_message'),
-    path('conversations/<int:conversation_id>/typing/', views.update_typing_status, name='update_typing_status'),
-    path('conversations/<int:conversation_id>/typing-users/', views.get_typing_users, name='get_typing_users'),
-    path('conversations/<int:conversation_id>/statuses/', views.conversation_statuses, name='conversation_statuses'),
-    path('users/<int:pk>/block/', views.block_user, name='block_user'),
+    path('conversations/<int:conversation_id>/events/', views.conversation_events, name='conversation_events'),
+    path('conversations/<int:conversation_id>/receipts/', views.read_receipts, name='read_receipts'),
     
-]
\ No newline at end of file
+]
+
+# Native async implementations under ASGI (ASYNC_VIEWS, see core.async_views)
+urlpatterns += endpoint_patterns(async_views if getattr(settings, 'ASYNC_VIEWS', False) else views)
\ No newline at end of file
@@ -2,22 +2,27 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition, require_http_methods
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
 from django.contrib import messages
 from django.contrib.auth import views as auth_views
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, Http404, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
 from django.utils.dateformat import format as date_format
 from django.utils import timezone
+import asyncio
+import functools
 import json
 
 from .forms import SignUpForm, LoginForm, ProfileEditForm
 from .models import User
-from django.db.models import Q
-import random
+from django.db import IntegrityError, transaction
 from .models import Conversation, Message
 from .forms import MessageForm
+from . import blocking, fragments, history, inbox, listing, metrics, polling, presence, random_pick, realtime, search, typing_state, unread, uploads
 from django.shortcuts import reverse
-from django.core.paginator import Paginator
 from django.core.cache import cache
 from django.utils import timezone
 
@@ -28,31 +33,23 @@ from django.utils import timezone
     
 @login_required
 def update_typing_status(request, conversation_id):
-    """Update the typing status of a user in a conversation"""
+    """Update the typing status of a user in a conversation.
+
+    Typing state lives in the cache with a short TTL and changes are pushed
+    over the conversation event stream; this endpoint and get_typing_users
+    remain as the HTTP fallback.
+    """
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
             is_typing = data.get('is_typing', False)
-            snippet = data.get('snippet', '')
             
-            conversation = get_object_or_404(
-                Conversation.objects.filter(participants=request.user), 
-                pk=conversation_id
-            )
-            
-            if is_typing:
-                conversation.typing_users.add(request.user)
-            else:
-                conversation.typing_users.remove(request.user)
-            
-            typing_users = conversation.get_typing_users(exclude_user=request.user)
-            result = []
-            for user in typing_users:
-                result.append({
-                    'id': user.id,
-                    'username': user.username,
-                    'photo': user.photo.url if getattr(user, 'photo', None) else '',
-                })
+            participant_ids = Conversation.participant_ids_for(conversation_id)
+            if request.user.pk not in participant_ids:
+                raise Http404
+
+            typing_state.set_typing(conversation_id, participant_ids, request.user, is_typing)
+            result = typing_state.typing_users(conversation_id, participant_ids, exclude_user_id=request.user.pk)
 
             return JsonResponse({'status': 'ok', 'typing_users': result})
             
@@ -62,48 +59,90 @@ def update_typing_status(request, conversation_id):
     return JsonResponse({'status': 'error', 'message': 'Invalid method'}, status=405)
 
 
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=polling.typing_etag)
 @login_required
 def get_typing_users(request, conversation_id):
     """Get the list of users currently typing in a conversation"""
-    conversation = get_object_or_404(
-        Conversation.objects.filter(participants=request.user), 
-        pk=conversation_id
-    )
-    typing_users = conversation.get_typing_users(exclude_user=request.user)
-    result = []
-    for user in typing_users:
-        result.append({
-            'id': user.id,
-            'username': user.username,
-            'photo': user.photo.url if getattr(user, 'photo', None) else '',
-        })
+    participant_ids = Conversation.participant_ids_for(conversation_id)
+    if request.user.pk not in participant_ids:
+        raise Http404
+    result = typing_state.typing_users(conversation_id, participant_ids, exclude_user_id=request.user.pk)
 
     return JsonResponse({'status': 'ok', 'typing_users': result})
 
 
+@login_required
+async def conversation_events(request, conversation_id):
+    """Stream conversation events as Server-Sent Events.
+
+    One connection per open chat carries new/edited/deleted messages, typing
+    changes and participant presence (sent on connect and every 15 s, which
+    doubles as the keepalive). The page makes no other requests while the
+    stream is open, so each presence frame also records a heartbeat for the
+    viewer. Only available under the ASGI server; the page falls back to
+    polling when the stream cannot be opened.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'status': 'error', 'message': 'Event stream requires ASGI'}, status=501)
+    user = await request.auser()
+    participant_ids = await Conversation.aparticipant_ids_for(conversation_id)
+    if user.pk not in participant_ids:
+        raise Http404
+
+    async def presence_frame():
+        await presence.arecord_heartbeat_for_id(user.pk)
+        statuses = await presence.astatuses_for_ids(participant_ids)
+        return realtime.format_sse('presence', {
+            'participants': [{'id': pk, 'status': status} for pk, status in statuses.items()],
+        })
+
+    async def stream():
+        async with realtime.get_broker().subscribe(realtime.conversation_channel(conversation_id)) as sub:
+            yield 'retry: 3000\n\n'
+            yield await presence_frame()
+            while True:
+                try:
+                    event, data = await sub.get(timeout=realtime.PRESENCE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield await presence_frame()
+                    continue
+                yield realtime.format_sse(event, data)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def read_receipts(request, conversation_id):
+    """Return every participant's read cursor (last read message id) in a conversation."""
+    if request.user.pk not in Conversation.participant_ids_for(conversation_id):
+        raise Http404
+    return JsonResponse({'status': 'ok', 'receipts': unread.receipts(conversation_id)})
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=polling.statuses_etag)
 @login_required
 def conversation_statuses(request, conversation_id):
     """Return online status for participants in a conversation."""
     conv = get_object_or_404(Conversation.objects.filter(participants=request.user), pk=conversation_id)
-    participants = conv.participants.all()
-    statuses = []
-    now = timezone.now()
-    for u in participants:
-        if not u.last_activity:
-            status = 'offline'
-        else:
-            delta = now - u.last_activity
-            if delta.total_seconds() < 300:
-                status = 'online'
-            elif delta.total_seconds() < 900:
-                status = 'away'
-            else:
-                status = 'offline'
-        statuses.append({'id': u.id, 'username': u.username, 'status': status})
+    participants = list(conv.participants.all())
+    status_by_id = presence.statuses(participants)
+    statuses = [{'id': u.id, 'username': u.username, 'status': status_by_id[u.pk]} for u in participants]
 
     return JsonResponse({'status': 'ok', 'participants': statuses})
 
 
+def prometheus_metrics(request):
+    """Per-view request metrics for Prometheus; staff or METRICS_TOKEN only."""
+    if not metrics.can_scrape(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def home(request):
     """
     Renders the home page.
@@ -130,6 +169,7 @@ def signup_view(request):
             # age check is enforced in SignUpForm.clean_age
             user = form.save(commit=False)
             user.save()
+            random_pick.forget_bounds(user.gender)
             login(request, user)
             return redirect("home")
     else:
@@ -162,8 +202,11 @@ def home(request):
     # Show a short list of opposite-gender users to quickly start conversations
     me = request.user
     opp_gender = me.opposite_gender()
-    opposites = User.objects.filter(gender=opp_gender).exclude(pk=me.pk)[:5]
-    return render(request, "core/home.html", {"opposites": opposites})
+    opposites = listing.paginate(
+        User.objects.filter(gender=opp_gender).exclude(pk=me.pk).exclude(pk__in=blocking.hidden_ids(me.pk)),
+        limit=5,
+    )
+    return render(request, "core/home.html", {"opposites": opposites, "opposite_gender": opp_gender})
 
 
 # Search opposite gender users (requires login)
@@ -171,41 +214,106 @@ def home(request):
 def search_opposite(request):
     me = request.user
     opp_gender = me.opposite_gender()
-    q = request.GET.get("q", "").strip()
-    users = User.objects.filter(gender=opp_gender).exclude(pk=me.pk)
-    if q:
-        users = users.filter(Q(username__icontains=q) | Q(email__icontains=q))
-    return render(request, "core/search.html", {"users": users, "q": q})
+    filters = search.filters_from(request.GET)
+    users = User.objects.filter(gender=opp_gender).exclude(pk=me.pk).exclude(pk__in=blocking.hidden_ids(me.pk))
+    prev_link = next_link = None
+    if filters['q']:
+        # Ranked results page by offset; matches username and bio only, never email
+        results, has_next = search.search(users, **filters)
+        page = filters['page']
+        if page > 1:
+            prev_link = listing.page_link(request.GET, page=page - 1)
+        if has_next:
+            next_link = listing.page_link(request.GET, page=page + 1)
+    else:
+        # Plain browsing seeks on (gender, id) like users_by_gender
+        after, before = listing.cursor_from(request.GET)
+        results = listing.paginate(
+            search.apply_filters(users, filters['age_min'], filters['age_max'], filters['online']).only(*search.LIST_FIELDS),
+            after, before, limit=search.page_size(),
+        )
+        if results.has_previous:
+            prev_link = listing.page_link(request.GET, before=results.previous_cursor)
+        if results.has_next:
+            next_link = listing.page_link(request.GET, after=results.next_cursor)
+    return render(request, "core/search.html", {
+        "users": results,
+        "q": filters['q'],
+        "filters": filters,
+        "prev_link": prev_link,
+        "next_link": next_link,
+    })
 
 
 # Profile views
 @login_required
 def profile_detail(request, pk):
+    # Users who blocked the viewer are hidden from them entirely
+    if pk in blocking.blocked_by_ids(request.user.pk):
+        raise Http404
     profile = get_object_or_404(User, pk=pk)
-    return render(request, "core/profile_detail.html", {"profile": profile})
+    photo_upload = uploads.latest_for(request.user) if profile == request.user else None
+    return render(request, "core/profile_detail.html", {
+        "profile": profile,
+        "photo_upload": photo_upload,
+        "fragment_ttl": fragments.ttl(),
+    })
 
 
 @login_required
+@csrf_exempt
 def profile_edit(request):
+    # Spool uploads to disk in chunks; must be set before CSRF reads the body
+    request.upload_handlers = [TemporaryFileUploadHandler(request)]
+    return _profile_edit(request)
+
+
+@csrf_protect
+def _profile_edit(request):
     if request.method == 'POST':
-        form = ProfileEditForm(request.POST, request.FILES, instance=request.user)
+        # The photo is validated and stored by a background worker (core.uploads)
+        form = ProfileEditForm(request.POST, instance=request.user)
+        photo = request.FILES.get('photo')
+        photo_error = uploads.check(photo) if photo else None
+        if photo_error:
+            form.add_error('photo', photo_error)
         if form.is_valid():
             form.save()
-            messages.success(request, 'Profile updated successfully!')
+            if photo:
+                uploads.enqueue(request.user, photo)
+                messages.info(request, 'Profile updated. Your new photo is being processed.')
+            else:
+                messages.success(request, 'Profile updated successfully!')
             return redirect('profile_detail', pk=request.user.pk)
     else:
         form = ProfileEditForm(instance=request.user)
     return render(request, 'core/profile_edit.html', {'form': form})
 
 
+@login_required
+def photo_upload_status(request):
+    """Status of the viewer's latest photo upload, polled by the profile page."""
+    job = uploads.latest_for(request.user)
+    if job is None:
+        return JsonResponse({'status': 'ok', 'upload': None})
+    return JsonResponse({
+        'status': 'ok',
+        'upload': {
+            'id': job.pk,
+            'state': job.status,
+            'error': job.error,
+            'photo': request.user.profile_photo_url if job.status == job.DONE else None,
+        },
+    })
+
+
 
 # Random opposite profile
 @login_required
 def random_profile(request):
     me = request.user
     opp_gender = me.opposite_gender()
-    candidates = list(User.objects.filter(gender=opp_gender).exclude(pk=me.pk))
-    profile = random.choice(candidates) if candidates else None
+    profile = random_pick.pick_for(request, opp_gender, exclude_ids={me.pk} | blocking.hidden_ids(me.pk))
     return render(request, "core/random.html", {"profile": profile})
 
 
@@ -217,25 +325,33 @@ def users_by_gender(request, gender):
         messages.error(request, "Invalid gender filter.")
         return redirect('home')
 
-    users_qs = User.objects.filter(gender=gender).exclude(pk=request.user.pk)
-    paginator = Paginator(users_qs, 20)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    return render(request, 'core/users_by_gender.html', {'page_obj': page_obj, 'gender': gender})
+    users_qs = User.objects.filter(gender=gender).exclude(pk=request.user.pk).exclude(pk__in=blocking.hidden_ids(request.user.pk))
+    # Keyset pages on (gender, id): no COUNT(*) and no growing OFFSET
+    after, before = listing.cursor_from(request.GET)
+    page_obj = listing.paginate(users_qs, after, before, limit=20)
+    return render(request, 'core/users_by_gender.html', {
+        'page_obj': page_obj,
+        'gender': gender,
+        'approx_total': listing.approx_total(f'gender:{gender}', User.objects.filter(gender=gender)),
+        'fragment_ttl': fragments.ttl(),
+    })
 
 
 # Message management
 @login_required
 def delete_message(request, message_id):
-    message = get_object_or_404(Message, id=message_id, sender=request.user)
+    message = get_object_or_404(Message.objects.select_related('sender'), id=message_id, sender=request.user)
     message.is_deleted = True
     message.save()
+    unread.message_deleted(message)
+    fragments.messages_changed(message.conversation_id)
+    realtime.publish_message(message, 'message_deleted')
     return JsonResponse({'status': 'ok'})
 
 
 @login_required
 def edit_message(request, message_id):
-    message = get_object_or_404(Message, id=message_id, sender=request.user)
+    message = get_object_or_404(Message.objects.select_related('sender'), id=message_id, sender=request.user)
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
@@ -244,6 +360,8 @@ def edit_message(request, message_id):
                 message.content = new_content
                 message.edited_at = timezone.now()
                 message.save()
+                fragments.messages_changed(message.conversation_id)
+                realtime.publish_message(message, 'message_edited')
                 return JsonResponse({
                     'status': 'ok',
                     'message': {
@@ -260,13 +378,32 @@ def edit_message(request, message_id):
 # Conversations and messaging
 @login_required
 def conversations_list(request):
-    conversations = request.user.conversations.all().prefetch_related('participants')
-    # Annotate each conversation with the other participant before rendering
-    conversations_with_other = []
-    for conv in conversations:
-        conv.other_participant = conv.other_participant(request.user)
-        conversations_with_other.append(conv)
-    return render(request, 'core/conversation_list.html', {'conversations': conversations_with_other})
+    """Inbox ordered by recent activity; each entry already carries the other
+    participant, last message and unread count (see core.inbox)."""
+    try:
+        before = int(request.GET['before']) if 'before' in request.GET else None
+    except ValueError:
+        before = None
+    conversations, has_more = inbox.page(request.user, before=before)
+    return render(request, 'core/conversation_list.html', {
+        'conversations': conversations,
+        'next_before': conversations[-1].pk if has_more else None,
+    })
+
+
+@login_required
+def inbox_json(request):
+    """JSON inbox page; pass ?before=<conversation id> for the next page."""
+    try:
+        before = int(request.GET['before']) if 'before' in request.GET else None
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid cursor'}, status=400)
+    conversations, has_more = inbox.page(request.user, before=before)
+    return JsonResponse({
+        'status': 'ok',
+        'conversations': [inbox.to_dict(conv) for conv in conversations],
+        'has_more': has_more,
+    })
 
 
 @login_required
@@ -276,14 +413,23 @@ def start_conversation(request, pk):
     if other == request.user:
         return redirect('profile_detail', pk=pk)
 
-    # Try to find an existing conversation with exactly these two participants
-    conv = Conversation.objects.filter(participants=request.user).filter(participants=other).distinct().first()
+    # Direct conversations are unique per user pair: a single indexed lookup,
+    # and a concurrent double click loses the race on the unique index instead
+    # of creating a second conversation
+    key = Conversation.pair_key_for(request.user.pk, other.pk)
+    conv = Conversation.objects.filter(pair_key=key).first()
     if conv is None:
-        conv = Conversation.objects.create()
-        conv.participants.add(request.user, other)
+        try:
+            with transaction.atomic():
+                conv = Conversation.objects.create(pair_key=key)
+                conv.participants.add(request.user, other)
+        except IntegrityError:
+            conv = Conversation.objects.get(pair_key=key)
     return redirect('conversation_detail', pk=conv.pk)
 
 
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=polling.messages_after_etag)
 @login_required
 def conversation_detail(request, pk):
     conv = get_object_or_404(Conversation, pk=pk)
@@ -291,9 +437,28 @@ def conversation_detail(request, pk):
         messages.error(request, "You are not a participant in that conversation.")
         return redirect('home')
 
-    # When a user opens the conversation (GET), mark incoming unread messages as read
+    # Scroll-back (?before=<id>) and catch-up (?after=<id>) pages as JSON
+    if request.method == 'GET' and ('before' in request.GET or 'after' in request.GET):
+        try:
+            before_id = int(request.GET['before']) if 'before' in request.GET else None
+            after_id = int(request.GET['after']) if 'after' in request.GET else None
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid cursor'}, status=400)
+        if before_id is not None:
+            page, has_more = history.before(conv, before_id)
+        else:
+            page, has_more = history.after(conv, after_id)
+            if page:
+                unread.mark_read(conv, request.user, upto=page[-1].pk)
+        return JsonResponse({
+            'status': 'ok',
+            'messages': [m.to_dict() for m in page],
+            'has_more': has_more,
+        })
+
+    # When a user opens the conversation (GET), move their read cursor to the newest message
     if request.method == 'GET':
-        Message.objects.filter(conversation=conv, read=False).exclude(sender=request.user).update(read=True)
+        unread.mark_read(conv, request.user)
 
     if request.method == 'POST':
         if request.headers.get('x-requested-with') == 'XMLHttpRequest':
@@ -302,24 +467,20 @@ def conversation_detail(request, pk):
                 form = MessageForm({'content': data.get('content', '')})
                 if form.is_valid():
                     # Prevent sending if any other participant has blocked the sender
-                    other_participants = conv.participants.exclude(pk=request.user.pk)
-                    for oth in other_participants:
-                        if oth.blocked_users.filter(pk=request.user.pk).exists():
-                            return JsonResponse({'status': 'error', 'message': 'You are blocked by this user. Message not sent.'}, status=403)
+                    if blocking.is_blocked_by_any(request.user.pk, conv.participant_ids()):
+                        return JsonResponse({'status': 'error', 'message': 'You are blocked by this user. Message not sent.'}, status=403)
 
                     msg = form.save(commit=False)
                     msg.conversation = conv
                     msg.sender = request.user
                     msg.save()
+                    unread.message_sent(msg, [pk for pk in conv.participant_ids() if pk != request.user.pk])
+                    inbox.record_message(msg)
+                    fragments.messages_changed(conv.pk)
+                    realtime.publish_message(msg)
                     return JsonResponse({
                         'status': 'ok',
-                        'message': {
-                            'id': msg.id,
-                            'content': msg.content,
-                            'timestamp': date_format(msg.timestamp, 'g:i A'),
-                            'sender': msg.sender.username,
-                            'is_mine': True
-                        }
+                        'message': {**msg.to_dict(), 'is_mine': True},
                     })
                 return JsonResponse({'status': 'error', 'errors': form.errors}, status=400)
             except json.JSONDecodeError:
@@ -328,28 +489,40 @@ def conversation_detail(request, pk):
             form = MessageForm(request.POST)
             if form.is_valid():
                 # Prevent sending if any other participant has blocked the sender
-                other_participants = conv.participants.exclude(pk=request.user.pk)
-                for oth in other_participants:
-                    if oth.blocked_users.filter(pk=request.user.pk).exists():
-                        messages.error(request, 'You are blocked by this user. Message not sent.')
-                        return redirect(reverse('conversation_detail', kwargs={'pk': conv.pk}))
+                if blocking.is_blocked_by_any(request.user.pk, conv.participant_ids()):
+                    messages.error(request, 'You are blocked by this user. Message not sent.')
+                    return redirect(reverse('conversation_detail', kwargs={'pk': conv.pk}))
 
                 msg = form.save(commit=False)
                 msg.conversation = conv
                 msg.sender = request.user
                 msg.save()
+                unread.message_sent(msg, [pk for pk in conv.participant_ids() if pk != request.user.pk])
+                inbox.record_message(msg)
+                fragments.messages_changed(conv.pk)
+                realtime.publish_message(msg)
                 return redirect(reverse('conversation_detail', kwargs={'pk': conv.pk}))
     else:
         form = MessageForm()
 
-    messages_qs = conv.messages.select_related('sender')
-    
+    # Only the newest page is rendered; older messages load on scroll-back.
+    # Lazy, so a cached message list fragment skips the query entirely
+    latest = functools.cache(lambda: history.latest(conv))
+
     # IDs of users the current user has blocked (for template checks)
-    blocked_ids = list(request.user.blocked_users.values_list('id', flat=True)) if request.user.is_authenticated else []
+    blocked_ids = list(blocking.blocked_ids(request.user.pk))
+
+    # Participant statuses in one pass, reused by every status dot in the template
+    participants = list(conv.participants.all())
 
     return render(request, 'core/conversation_detail.html', {
         'conversation': conv,
-        'conversation_messages': messages_qs,
+        'participants': participants,
+        'presence_statuses': presence.statuses(participants),
+        'conversation_messages': lambda: latest()[0],
+        'has_more_messages': lambda: latest()[1],
+        'messages_version': fragments.message_list_version(conv, participants),
+        'fragment_ttl': fragments.ttl(),
         'form': form,
         'blocked_ids': blocked_ids,
     })
@@ -363,12 +536,7 @@ def block_user(request, pk):
     if target == request.user:
         return JsonResponse({'status': 'error', 'message': 'Cannot block yourself'}, status=400)
 
-    if target in request.user.blocked_users.all():
-        request.user.blocked_users.remove(target)
-        return JsonResponse({'status': 'unblocked'})
-    else:
-        request.user.blocked_users.add(target)
-        return JsonResponse({'status': 'blocked'})
+    return JsonResponse({'status': blocking.toggle(request.user, target)})
 
 
 @login_required
@@ -0,0 +1,56 @@
+"""Local background work queue.
+
+A process-wide thread pool for work that should not hold up a request,
+such as photo processing. Anything that has to survive a restart keeps its
+own database row (see ``core.uploads``) and is picked up again by a
+management command; this module only runs callables.
+
+Settings: ``BACKGROUND_WORKERS`` (threads, default 2) and
+``BACKGROUND_INLINE`` (default False; True runs jobs synchronously, which
+is handy in tests).
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'BACKGROUND_WORKERS', 2),
+                thread_name_prefix='background',
+            )
+    return _executor
+
+
+def _run(fn, *args):
+    try:
+        fn(*args)
+    except Exception:
+        logger.exception("Background job %s%r failed", fn.__name__, args)
+    finally:
+        # Worker threads are not request-scoped, so nothing else closes this
+        connection.close()
+
+
+def submit(fn, *args):
+    """Run ``fn(*args)`` on the worker pool (or inline with ``BACKGROUND_INLINE``)."""
+    if getattr(settings, 'BACKGROUND_INLINE', False):
+        fn(*args)
+    else:
+        _get_executor().submit(_run, fn, *args)
+
+
+def defer(fn, *args):
+    """``submit`` once the current transaction commits, so the job sees its rows."""
+    transaction.on_commit(lambda: submit(fn, *args))
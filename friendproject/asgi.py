@@ -3,6 +3,16 @@ ASGI config for friendproject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the site through this entry point (e.g. ``uvicorn friendproject.asgi:application``)
+to enable the conversation event stream (``core.views.conversation_events``),
+which pushes typing updates instead of having every open tab poll for them,
+and the native async JSON endpoints in ``core.async_views`` (set
+``DJANGO_ASYNC_VIEWS=0`` to serve the sync ones instead).
+
+Connections are not kept between requests here (``DB_CONN_MAX_AGE`` defaults
+to 0): sync code runs on short-lived executor threads, and a persistent
+connection left on one is never closed. Set ``DB_POOL=1`` to reuse them.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -12,5 +22,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'friendproject.settings')
+os.environ.setdefault('DJANGO_ASYNC_VIEWS', '1')
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
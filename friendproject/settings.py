@@ -10,29 +10,51 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+from importlib.util import find_spec
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
+def env_bool(name, default=False):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_list(name, default=()):
+    value = os.environ.get(name)
+    return [item.strip() for item in value.split(',') if item.strip()] if value else list(default)
+
+
+# Settings profile: "development" (default) or "production", from DJANGO_PROFILE.
+# Production turns DEBUG off and enables the cached template loader, cached
+# sessions and hashed static files; individual DJANGO_* variables override.
+PROFILE = os.environ.get('DJANGO_PROFILE', 'development')
+PRODUCTION = PROFILE == 'production'
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'django-insecure-13+5aqp!x1v=ch!fh8=w7j8e%8(k=dylafs3q2rn*&-2@eq5%b'
+SECRET_KEY = os.environ.get(
+    'DJANGO_SECRET_KEY', 'django-insecure-13+5aqp!x1v=ch!fh8=w7j8e%8(k=dylafs3q2rn*&-2@eq5%b'
+)
+if PRODUCTION and SECRET_KEY.startswith('django-insecure-'):
+    raise ImproperlyConfigured("Set DJANGO_SECRET_KEY for the production profile.")
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
-
+# (DEBUG also keeps every executed SQL query in memory for the request)
+DEBUG = env_bool('DJANGO_DEBUG', not PRODUCTION)
 
+ALLOWED_HOSTS = env_list('DJANGO_ALLOWED_HOSTS')
 
 
 AUTH_USER_MODEL = 'core.User' # our custom user model
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/accounts/login/'
-STATIC_URL = '/static/'
-# Optionally configure templates & static dirs if needed
 
 
 # Application definition
@@ -48,11 +70,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Per-view metrics served on /metrics (core.metrics); METRICS_ENABLED = False turns it off
+    'core.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    # Serves hashed static files with far-future caching when whitenoise is installed (production)
+    *(['whitenoise.middleware.WhiteNoiseMiddleware'] if PRODUCTION and find_spec('whitenoise') else []),
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Staff can profile a request with "X-Profile: 1" or ?_profile=1 (core.profiling)
+    'core.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'core.middleware.UserActivityMiddleware',
@@ -64,7 +92,8 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
+        # Production lists the loaders explicitly (wrapped in the cached loader)
+        'APP_DIRS': not PRODUCTION,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.request',
@@ -78,6 +107,14 @@ TEMPLATES = [
     },
 ]
 
+if PRODUCTION:
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'friendproject.wsgi.application'
 
 
@@ -122,8 +159,61 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = Path(os.environ.get('DJANGO_STATIC_ROOT', BASE_DIR / 'staticfiles'))
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_ROOT = Path(os.environ.get('DJANGO_MEDIA_ROOT', BASE_DIR / 'media'))
+
+# Production serves content-hashed file names (collectstatic writes a manifest),
+# so they can be cached forever: by whitenoise when installed, otherwise by the
+# front-end server for STATIC_URL.
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': (
+            'django.contrib.staticfiles.storage.StaticFilesStorage' if not PRODUCTION
+            else 'whitenoise.storage.CompressedManifestStaticFilesStorage' if find_spec('whitenoise')
+            else 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
+        ),
+    },
+}
+WHITENOISE_MAX_AGE = 365 * 24 * 3600
+
+
+# Cache: DJANGO_CACHE = "locmem" (development default), "file" or "redis"
+# (production default); DJANGO_CACHE_LOCATION is the directory or redis:// URL.
+# Block lists, participant ids, unread totals, fragment stamps and the presence
+# throttle are invalidated through the cache, so every worker process has to
+# share it: the production profile refuses locmem, which is per process.
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'friendproject'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', '/var/tmp/friendproject_cache'),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://127.0.0.1:6379/1'),
+}
+_cache = os.environ.get('DJANGO_CACHE', 'redis' if PRODUCTION else 'locmem')
+if PRODUCTION and _cache == 'locmem':
+    raise ImproperlyConfigured("The production profile needs a shared cache: set DJANGO_CACHE to redis or file.")
+_cache_backend, _cache_location = CACHE_BACKENDS[_cache]
+CACHES = {
+    'default': {
+        'BACKEND': _cache_backend,
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', _cache_location),
+        'TIMEOUT': 300,
+        # Django culls locmem and file caches past MAX_ENTRIES (default 300). Redis
+        # passes OPTIONS to its client instead; bound it with maxmemory on the server.
+        'OPTIONS': {} if _cache == 'redis' else {
+            'MAX_ENTRIES': int(os.environ.get('DJANGO_CACHE_MAX_ENTRIES', 10_000)),
+        },
+    }
+}
+
+# Sessions: DJANGO_SESSION_ENGINE = "db", "cached_db" or "signed_cookies". The
+# cached variants avoid the per-request session SELECT.
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + os.environ.get(
+    'DJANGO_SESSION_ENGINE', 'cached_db' if PRODUCTION else 'db'
+)
+
+# Prometheus scrapers read /metrics with "Authorization: Bearer $METRICS_TOKEN"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -131,21 +221,32 @@ MEDIA_ROOT = BASE_DIR / 'media'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# DB_POOL=1 borrows connections from core.db.pool, which is what to use under
+# ASGI; otherwise connections persist per thread for DB_CONN_MAX_AGE seconds
+# (default 60). Django does not support persistent connections under ASGI, so
+# friendproject.asgi defaults DB_CONN_MAX_AGE to 0. Health checks ping a
+# reused connection before the first query of a request.
+DB_POOL = env_bool('DB_POOL')
 
-
-AUTH_USER_MODEL = 'core.User'
-
-
-# settings.py
+# Route the polling and message JSON endpoints to the native async views in
+# core.async_views. friendproject.asgi turns this on unless DJANGO_ASYNC_VIEWS
+# says otherwise; keep it off under WSGI.
+ASYNC_VIEWS = env_bool('DJANGO_ASYNC_VIEWS')
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
-        'NAME': 'talk_app_db',
-        'USER': 'root',
-        'PASSWORD': 'root',
-        'HOST': 'localhost',
-        'PORT': '3306',
+        'ENGINE': 'core.db.pooled_mysql' if DB_POOL else 'django.db.backends.mysql',
+        'NAME': os.environ.get('DB_NAME', 'talk_app_db'),
+        'USER': os.environ.get('DB_USER', 'root'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', 'root'),
+        'HOST': os.environ.get('DB_HOST', 'localhost'),
+        'PORT': os.environ.get('DB_PORT', '3306'),
+        'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': env_bool('DB_CONN_HEALTH_CHECKS', True),
+        'POOL': {
+            'SIZE': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        },
     }
 }
 